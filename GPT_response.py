@@ -1,13 +1,33 @@
-import base64
+import email.utils
+import hashlib
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import requests
-import io
-from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from image_cache import default_image_cache, image_payload
+from no_change import change_ratio
+from response_cache import default_cache, payload_key
+
+API_URL = "https://api.openai.com/v1/chat/completions"
+# API key 从环境变量中读取
+API_KEY_ENV = "OPENAI_API_KEY"
 
+# 并发请求数、每个请求的超时(秒)和最多重试次数
+CONCURRENCY = 8
+TIMEOUT = 60
+MAX_RETRIES = 5
+# 重试间隔从 BACKOFF_SECONDS 开始每次翻倍，最多 MAX_BACKOFF_SECONDS；服务器返回 Retry-After 时按它等待
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+# 这些状态码(限流和服务器错误)会重试，其他错误直接失败
+RETRY_STATUSES = (429, 500, 502, 503, 504)
 
-def gpt4_chat_2images(image1, image2, llm="gpt-4o-mini", max_tokens=100, temperature=0, stop=None, resolution="low", action=None):
-    # OpenAI API Key
-    api_key = 'please input your OPENAI api key here'
-    prompt = f'''You are an AI assistant tasked with describing the actions and purposes in GUI video clips, where the actions in the images are produced by mouse and keyboard interactions.
+PROMPT_TEMPLATE = '''You are an AI assistant tasked with describing the actions and purposes in GUI video clips, where the actions in the images are produced by mouse and keyboard interactions.
 
 Your mission is to understand what the user did by analyzing two screenshots—one taken before and one after the user’s action.
 
@@ -51,93 +71,57 @@ Examples of your response might include:
 Each set of images contains only one action.
 '''
 
+# 前后两张图没有变化时(见 no_change.py)不发送完整的请求:
+# template 直接用 NO_CHANGE_CAPTION 作为结果，cheap 只发送动作后的一张低分辨率图片和 NO_CHANGE_PROMPT
+NO_CHANGE_ROUTES = ('template', 'cheap')
+NO_CHANGE_CAPTION = 'The user performed the action "{description}"{location}, but no response occurred.'
+NO_CHANGE_PROMPT = '''You are an AI assistant tasked with describing the actions and purposes in GUI video clips, where the actions are produced by mouse and keyboard interactions.
+
+The screenshot was taken after the user's action. The screen looked the same before the action, so the action caused no visible change.
+
+The record of the mouse and keyboard action is: {action}.
+
+In one sentence, describe what the user did and the likely purpose, and mention that no response occurred (e.g., "The user clicked on the button, but no response occurred").
+'''
+
+# prompt 的版本，prompt 改动后自动变化，保存的结果按版本区分
+PROMPT_VERSION = hashlib.sha1(PROMPT_TEMPLATE.encode('utf-8')).hexdigest()[:12]
+
+
+def build_prompt(action):
+    return PROMPT_TEMPLATE.format(action=action)
+
+
+def no_change_caption(action):
+    location = f" at ({action[1]['x']}, {action[1]['y']})" if action[1] is not None else ""
+    return NO_CHANGE_CAPTION.format(description=action[0], location=location)
+
+
+# 以鼠标为中心裁剪时的鼠标位置 (x, y)，不裁剪或没有坐标时为 None
+def payload_mouse(action, crop=True):
     # Extract mouse coordinates if available in action
     mouse_x, mouse_y = None, None
     if action[1] is not None:
         mouse_x = action[1]['x']
         mouse_y = action[1]['y']
+    return (mouse_x, mouse_y) if crop and mouse_x and mouse_y else None
 
-    def crop_image_to_mouse(image_path, mouse_x, mouse_y, width=960, height=512):
-        image = Image.open(image_path)
-        img_width, img_height = image.size
-
-        # Calculate the cropping box
-        left = mouse_x - width // 2
-        top = mouse_y - height // 2
-        right = mouse_x + width // 2
-        bottom = mouse_y + height // 2
-
-        # Adjust the cropping box to ensure it stays within image bounds
-        if left < 0:
-            left = 0
-            right = min(width, img_width)
-        if right > img_width:
-            right = img_width
-            left = max(0, img_width - width)
-        if top < 0:
-            top = 0
-            bottom = min(height, img_height)
-        if bottom > img_height:
-            bottom = img_height
-            top = max(0, img_height - height)
-
-        # Crop the image with the adjusted box
-        cropped_image = image.crop((left, top, right, bottom))
-        return cropped_image
-    
-    # Encode the image to base64
-    def crop_image_to_mouse(image, mouse_x, mouse_y, width=1024, height=684):
-        img_width, img_height = image.size
-
-        # Calculate the cropping box
-        left = mouse_x - width // 2
-        top = mouse_y - height // 2
-        right = mouse_x + width // 2
-        bottom = mouse_y + height // 2
-
-        # Adjust the cropping box to ensure it stays within image bounds
-        if left < 0:
-            left = 0
-            right = min(width, img_width)
-        if right > img_width:
-            right = img_width
-            left = max(0, img_width - width)
-        if top < 0:
-            top = 0
-            bottom = min(height, img_height)
-        if bottom > img_height:
-            bottom = img_height
-            top = max(0, img_height - height)
-
-        # Crop the image with the adjusted box
-        cropped_image = image.crop((left, top, right, bottom))
-        return cropped_image
-    
-    # Encode the image to base64
-    def encode_image(image):
-        # Convert image object to bytes and then to base64
-        buffered = io.BytesIO()
-        image.save(buffered, format="JPEG")
-        return base64.b64encode(buffered.getvalue()).decode('utf-8')
 
+# 构造请求内容，image1、image2 为 PIL 图片或文件路径，action 为 (动作描述, 坐标)
+# crop 为 False 时图片已经裁剪好(例如 cut_keyframe 截取的 before_XXXX/after_XXXX)，不再裁剪
+# 图片缩小到 resolution 实际使用的大小再编码(见 image_cache.py)，resize 为 False 时与以前一样按原图大小编码
+# image_cache 默认为 image_cache.default_image_cache()，相邻两对图片共用的帧只编码一次，为 False 时不用缓存
+def build_payload(image1, image2, action, llm="gpt-4o-mini", max_tokens=100, temperature=0, resolution="low", crop=True,
+                  resize=True, image_cache=None):
     # Crop the images around the mouse if coordinates are provided
-    if mouse_x and mouse_y:
-        cropped_image1 = crop_image_to_mouse(image1, mouse_x, mouse_y)
-        cropped_image2 = crop_image_to_mouse(image2, mouse_x, mouse_y)
-    else:
-        cropped_image1 = image1  # Use the full image if no coordinates
-        cropped_image2 = image2
-
-    base64_image1 = encode_image(cropped_image1)
-    base64_image2 = encode_image(cropped_image2)
-
-    # Create headers for OpenAI API
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {api_key}"
-    }
+    mouse = payload_mouse(action, crop)
+    if image_cache is None:
+        image_cache = default_image_cache()
+    cache = image_cache if image_cache is not False else None
+    base64_image1 = image_payload(image1, mouse, resolution, resize, cache)
+    base64_image2 = image_payload(image2, mouse, resolution, resize, cache)
 
-    payload = {
+    return {
     "model": llm,
     "messages": [
         {
@@ -145,7 +129,7 @@ Each set of images contains only one action.
             "content": [
                 {
                     "type": "text",
-                    "text": prompt
+                    "text": build_prompt(action)
                 },
                 {
                     "type": "image_url",
@@ -168,9 +152,224 @@ Each set of images contains only one action.
     "max_tokens": max_tokens,
     "temperature": temperature
     }
-    response = requests.post(
-        "https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
 
-    print(response.json())
-    return response.json()['choices'][0]['message']['content']
 
+# 画面没有变化时的请求: 只有动作后的一张图片，固定为低分辨率，参数与 build_payload 相同
+def build_no_change_payload(image1, image2, action, llm="gpt-4o-mini", max_tokens=100, temperature=0, resolution="low",
+                            crop=True, resize=True, image_cache=None):
+    if image_cache is None:
+        image_cache = default_image_cache()
+    base64_image = image_payload(image2, payload_mouse(action, crop), "low", resize,
+                                 image_cache if image_cache is not False else None)
+    return {
+        "model": llm,
+        "messages": [{
+            "role": "user",
+            "content": [
+                {"type": "text", "text": NO_CHANGE_PROMPT.format(action=action)},
+                {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_image}", "detail": "low"}},
+            ]
+        }],
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }
+
+
+# attempts 为失败前发送的请求次数
+class CaptionError(Exception):
+    def __init__(self, message, attempts=0):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+# Retry-After 可以是秒数或 HTTP 日期，无法解析时返回 None
+def _retry_after(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# 并发打 caption 的客户端，所有请求共用一个连接池，同时进行的请求最多 concurrency 个
+# 超时、连接错误、限流(429)和服务器错误会按指数退避重试，限流时所有线程一起暂停
+# cache 为 response_cache.ResponseCache 时先查缓存，命中时不发请求，成功的回复写入缓存
+# no_change 为阈值(例如 no_change.NO_CHANGE_RATIO)时，先在本地比较两张图，变化的像素比例不超过阈值时按 no_change_route 处理，
+# stats 中 checked 为比较的对数，unchanged 为没有变化的对数，templated 为因此没有发请求的对数，cheap 为改发单张图片请求的对数
+class CaptionClient:
+    def __init__(self, api_key=None, url=API_URL, concurrency=CONCURRENCY, timeout=TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff=BACKOFF_SECONDS, max_backoff=MAX_BACKOFF_SECONDS, cache=None, no_change=None,
+                 no_change_route='template'):
+        if no_change_route not in NO_CHANGE_ROUTES:
+            raise ValueError(f"unsupported no_change_route: {no_change_route}")
+        api_key = api_key or os.environ.get(API_KEY_ENV)
+        if not api_key:
+            raise CaptionError(f"please set the {API_KEY_ENV} environment variable")
+        self.url = url
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.cache = cache
+        self.no_change = no_change
+        self.no_change_route = no_change_route
+        self.stats = {'checked': 0, 'unchanged': 0, 'templated': 0, 'cheap': 0}
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Create headers for OpenAI API
+        self.session.headers.update({
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {api_key}"
+        })
+        self._lock = threading.Lock()
+        # 限流时在这个时间(time.monotonic())之前不发新的请求
+        self._paused_until = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    def _wait_for_rate_limit(self):
+        with self._lock:
+            delay = self._paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def _pause(self, delay):
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+
+    # 发送一个请求，返回 (caption, 请求次数)，缓存命中时请求次数为 0，重试之后仍失败时抛出 CaptionError
+    def request(self, payload):
+        if self.cache is None:
+            return self._send(payload)
+        key = payload_key(payload)
+        caption = self.cache.get(key)
+        if caption is not None:
+            return caption, 0
+        caption, attempts = self._send(payload)
+        self.cache.put(key, caption)
+        return caption, attempts
+
+    def _send(self, payload):
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_rate_limit()
+            delay = None
+            try:
+                response = self.session.post(self.url, json=payload, timeout=self.timeout)
+            except requests.RequestException as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if response.status_code == 200:
+                    try:
+                        return response.json()['choices'][0]['message']['content'], attempt + 1
+                    except (ValueError, KeyError, IndexError, TypeError) as e:
+                        raise CaptionError(f"unexpected response: {response.text[:200]}", attempt + 1) from e
+                error = f"HTTP {response.status_code}: {response.text[:200]}"
+                if response.status_code not in RETRY_STATUSES:
+                    raise CaptionError(error, attempt + 1)
+                delay = _retry_after(response)
+                if response.status_code == 429:
+                    self._pause(delay if delay is not None else self._backoff(attempt))
+            if attempt == self.max_retries:
+                raise CaptionError(f"{error} (after {attempt + 1} attempts)", attempt + 1)
+            time.sleep(delay if delay is not None else self._backoff(attempt))
+
+    # 指数退避，加上随机抖动，避免所有线程同时重试
+    def _backoff(self, attempt):
+        return min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    # 给一对图片打 caption，图片可以是 PIL 图片或文件路径(编码时才读取)，options 为 build_payload 的参数
+    # 返回 (caption, 请求次数, route)，route 为 'full'、'template' 或 'cheap'，失败时抛出 CaptionError
+    def caption(self, image1, image2, action, **options):
+        build, route = build_payload, 'full'
+        if self.no_change is not None:
+            self._count('checked')
+            if change_ratio(image1, image2, payload_mouse(action, options.get('crop', True))) <= self.no_change:
+                self._count('unchanged')
+                route = self.no_change_route
+                if route == 'template':
+                    self._count('templated')
+                    return no_change_caption(action), 0, route
+                self._count('cheap')
+                build = build_no_change_payload
+        caption, attempts = self.request(build(image1, image2, action, **options))
+        return caption, attempts, route
+
+    # 处理一个 (image1, image2, action)，不抛出异常
+    def _caption_one(self, index, item, options):
+        start = time.perf_counter()
+        result = {'index': index, 'status': 'failed', 'caption': None, 'error': None, 'attempts': 0, 'route': None}
+        try:
+            result['caption'], result['attempts'], result['route'] = self.caption(*item, **options)
+            result['status'] = 'ok'
+        except Exception as e:
+            result['error'] = f"{type(e).__name__}: {e}"
+            result['attempts'] = getattr(e, 'attempts', 0)
+        result['seconds'] = round(time.perf_counter() - start, 3)
+        return result
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    # 并发处理 items 中的每个 (image1, image2, action)，options 为 build_payload 的参数(llm、resolution、crop 等)
+    # 按 items 的顺序返回每一项的结果 {'index', 'status': 'ok' / 'failed', 'caption', 'error', 'attempts', 'seconds',
+    # 'route': 'full' / 'template' / 'cheap'}，某一项失败不影响其他项；
+    # 图片在工作线程中才读取和编码，内存中最多同时有 concurrency 对图片
+    # on_result 不为 None 时每完成一项就在调用线程中调用 on_result(result)，例如立即保存结果
+    def caption_pairs(self, items, on_result=None, **options):
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = [executor.submit(self._caption_one, index, item, options) for index, item in enumerate(items)]
+            if on_result is not None:
+                for future in as_completed(futures):
+                    on_result(future.result())
+            return [future.result() for future in futures]
+
+
+# cut_keyframe 截取的图片和 sequence 中的动作配对，第 idx 个动作对应上一帧和这一帧
+# 裁剪模式(有 before_XXXX/after_XXXX)时使用裁剪好的图片，返回 [(动作序号, (image1, image2, action), cropped), ...]
+# cropped 为 True 时图片已经以鼠标为中心裁剪好，构造请求时要用 pair_options 去掉裁剪
+def session_pairs(image_dir, sequence, extension='.jpg'):
+    pairs = []
+    for idx in range(1, len(sequence)):
+        before = os.path.join(image_dir, f"before_{idx:04d}{extension}")
+        after = os.path.join(image_dir, f"after_{idx:04d}{extension}")
+        cropped = os.path.exists(before) and os.path.exists(after)
+        if not cropped:
+            before = os.path.join(image_dir, f"frame_{idx - 1:04d}{extension}")
+            after = os.path.join(image_dir, f"frame_{idx:04d}{extension}")
+        if os.path.exists(before) and os.path.exists(after):
+            pairs.append((idx, (before, after, sequence[idx][1:]), cropped))
+    return pairs
+
+
+# 一对图片的 build_payload 参数，已经裁剪好的图片坐标是整个屏幕的，不能再按鼠标裁剪一次
+def pair_options(cropped, options):
+    return dict(options, crop=False) if cropped else options
+
+
+# 同样的请求直接返回缓存的回复，cache 默认为 response_cache.default_cache()，为 False 时不用缓存
+# no_change 和 no_change_route 与 CaptionClient 相同，默认不比较
+def gpt4_chat_2images(image1, image2, llm="gpt-4o-mini", max_tokens=100, temperature=0, stop=None, resolution="low", action=None, crop=True, cache=None,
+                      no_change=None, no_change_route='template'):
+    if cache is None:
+        cache = default_cache()
+    with CaptionClient(concurrency=1, cache=cache if cache is not False else None, no_change=no_change,
+                       no_change_route=no_change_route) as client:
+        return client.caption(image1, image2, action, llm=llm, max_tokens=max_tokens, temperature=temperature,
+                              resolution=resolution, crop=crop)[0]
@@ -1,223 +1,117 @@
-import cv2
-from datetime import datetime, timedelta
 import os
-# from dect_frame import find_key_frame
-import glob
-import numpy as np
-
-def find_key_frame(video_path):
-    cap = cv2.VideoCapture(video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
-    total_frames = int(fps * 100)  # 读取前100秒
-    frame_count = 0
-
-    # 定义目标颜色 (BGR格式)
-    target_color = np.array([231, 216, 173])  # 注意顺序是 BGR
-    tolerance = 30  # 允许的颜色误差范围
-
-    # 定义检测区域 (屏幕中心往上50像素为中心的20x20区域)
-    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    center_x = frame_width // 2
-    center_y = frame_height // 2 - 100
-    check_region = (slice(center_y - 10, center_y + 10), slice(center_x - 10, center_x + 10))
-
-    block_present = False  # 假设色块最初是不存在的
-    appearance_frame = None
-    disappearance_frame = None
-
-    for i in range(total_frames):
-        ret, current_frame = cap.read()
-        if not ret:
-            break
-        
-        frame_count += 1
-
-        # 提取检测区域
-        region = current_frame[check_region]
-
-        # 计算区域的平均颜色
-        average_color = region.mean(axis=(0, 1)).astype(int)
-
-        # 检查平均颜色是否在目标颜色范围内
-        if not block_present and np.all(np.abs(average_color - target_color) <= tolerance):
-            # 色块首次出现
-            block_present = True
-            appearance_frame = frame_count
-            print(f"色块首次出现于第 {appearance_frame} 帧")
-        
-        elif block_present and not np.all(np.abs(average_color - target_color) <= tolerance):
-            # 色块消失
-            block_present = False
-            disappearance_frame = frame_count - 1
-            print(f"色块消失在第 {disappearance_frame} 帧")
-            break
-
-    if disappearance_frame is None:
-        if block_present:
-            print("色块未在检测范围内消失")
-        else:
-            print("色块未出现在检测范围内")
-
-    cap.release()
-    return disappearance_frame
-
-def convert_to_relative_time(file_path):
+from video_probe import probe_video
+from batch import run_batch
+from dect_frame import SEARCH_STRIDE, TARGET_COLOR, TOLERANCE
+from manifest import find_session_files
+from events import EventTable
+from compaction import compact_events
+from sequence_bin import sequence_bin_path, write_sequence_bin
+from time_utils import DAY_MS, format_time_ms, parse_times_ms, subtract_offset_ms
+
+# 读取一次原始日志，把时间戳换成相对第一行的时间(毫秒)
+# 返回 (相对时间, 原始时间戳字符串, 原始行) 的列表，以及第一次出现 <Ctrl> 的相对时间(秒)
+def read_log(file_path):
     with open(file_path, 'r') as file:
-        lines = file.readlines()
-
-    base_time = None
-    relative_lines = []
-    ctrl_time = None
-
-    for line in lines:
-        if not line.strip():
-            continue
-
-        timestamp_str = line.split()[1]
-        timestamp = datetime.strptime(timestamp_str, '%H:%M:%S.%f')
+        lines = [line for line in file if line.strip()]
+    if not lines:
+        return [], None
 
-        if base_time is None:
-            base_time = timestamp
+    timestamp_strs = [line.split()[1] for line in lines]
+    timestamps = parse_times_ms(timestamp_strs)
+    relative_times = (timestamps - timestamps[0]) % DAY_MS
 
-        relative_time = (timestamp - base_time).total_seconds()
-        
-        if "<Ctrl>" in line and ctrl_time is None:
-            ctrl_time = relative_time
-
-        relative_timestamp_str = (datetime.min + timedelta(seconds=relative_time)).time().strftime('%H:%M:%S.%f')[:-3]
-        relative_line = line.replace(timestamp_str, relative_timestamp_str)
-        relative_lines.append(relative_line)
-
-    new_file_path = file_path.replace('.txt', '_relative.txt')
-    with open(new_file_path, 'w') as new_file:
-        new_file.writelines(relative_lines)
-
-    print(f"Relative time file saved as {new_file_path}")
-    return new_file_path, ctrl_time
-
-def adjust_timestamps(file_path, offset):
-    with open(file_path, 'r') as file:
-        lines = file.readlines()
-
-    adjusted_lines = []
-
-    for line in lines[1:]:
-        if not line.strip():
-            continue
+    ctrl_time = None
+    for line, relative_time in zip(lines, relative_times):
+        if "<Ctrl>" in line:
+            ctrl_time = int(relative_time) / 1000
+            break
 
-        timestamp_str = line.split()[1]
-        timestamp = datetime.strptime(timestamp_str, '%H:%M:%S.%f')
+    return list(zip(relative_times.tolist(), timestamp_strs, lines)), ctrl_time
 
-        # 将时间戳转换为毫秒数
-        timestamp_ms = timestamp.hour * 3600000 + timestamp.minute * 60000 + timestamp.second * 1000 + timestamp.microsecond / 1000
+# 第一行之后的时间戳减去 offset(毫秒)，只保留时间大于 offset 的行
+def adjust_timestamps(entries, offset):
+    adjusted_entries = []
 
+    for timestamp_ms, timestamp_str, line in entries[1:]:
         if timestamp_ms > offset:
-            adjusted_timestamp = timestamp - timedelta(milliseconds=offset)
-            adjusted_timestamp_str = adjusted_timestamp.time().strftime('%H:%M:%S.%f')[:-3]
-            adjusted_line = line.replace(timestamp_str, adjusted_timestamp_str)
-            adjusted_lines.append(adjusted_line)
-
-
-    new_file_path = file_path.replace('_relative.txt', '_adjusted.txt')
-    with open(new_file_path, 'w') as new_file:
-        new_file.writelines(adjusted_lines)
-
-    print(f"Adjusted time file saved as {new_file_path}")
-    return new_file_path
-
-# 解析操作日志文件
-def parse_log(log_path):
-    actions = []
-    with open(log_path, "r") as f:
-        for line in f:
-            parts = line.strip().split(" ")
-            if len(parts) >= 3:
-                _, time, *action_parts = parts
-                timestamp = datetime.strptime(time, "%H:%M:%S.%f")
-                action = " ".join(action_parts)
-                actions.append((timestamp, action))
+            adjusted_entries.append((subtract_offset_ms(timestamp_ms, offset), timestamp_str, line))
+
+    return adjusted_entries
+
+# 把日志中的时间戳替换成 entries 中的时间后写入文件，用于调试
+def write_log(entries, file_path):
+    with open(file_path, 'w') as new_file:
+        for timestamp_ms, timestamp_str, line in entries:
+            new_file.write(line.replace(timestamp_str, format_time_ms(timestamp_ms)))
+
+# 解析操作日志，得到按列存储的动作表
+def parse_log(entries):
+    actions = EventTable()
+    for timestamp, _, line in entries:
+        parts = line.strip().split(" ")
+        if len(parts) >= 3:
+            action = " ".join(parts[2:])
+            actions.append(timestamp, action)
     return actions
 
 
+# 两个时间的中点，unit 为 1 时为毫秒(向下取整，与按微秒计算中点后截断到毫秒相同)，
+# 为 1000 时为微秒(与 timedelta / 2 一样四舍五入到偶数)
+def _midpoint(a, b, unit):
+    if unit == 1:
+        return (a + b) // 2
+    half = (b - a) // 2
+    if (b - a) % 2 and half % 2:
+        half += 1
+    return a + half
+
+
+# 合并后的一条动作的开始和结束时间，previous_time 和 next_time 为前一个和后一个动作的时间，没有时为 None
+# 开始时间为与前一个动作的中点和开始前 150ms 中较晚的一个，结束时间同理
+# unit 为每毫秒的时间单位数: 1 时所有时间都是毫秒，1000 时都是微秒
+def entry_span(start_time, end_time, previous_time, next_time, unit=1):
+    margin, day = 150 * unit, DAY_MS * unit
+    if previous_time is None:
+        before_time = (start_time - margin) % day
+    else:
+        midpoint = _midpoint(previous_time, start_time, unit)
+        before_time = max(midpoint, (start_time - margin) % day)
 
-def generate_subtitles_and_sequence(video_path, actions, output_file, sequence_file):
-    cap = cv2.VideoCapture(video_path)
-    if not cap.isOpened():
-        print(f"无法打开视频文件: {video_path}")
-        return
-    
+    if next_time is None:
+        after_time = end_time
+    else:
+        midpoint = _midpoint(end_time, next_time, unit)
+        after_time = max(midpoint, (next_time - margin) % day)
+    return before_time, after_time
+
+
+def generate_subtitles_and_sequence(actions, output_file, sequence_file):
     subtitles = []
     sequence = []
-    i = 0
+    # 与 sequence 每一行对应的 (时间, 动作, 屏幕)，写入 sequence.bin
+    records = []
     subtitle_index = 1
     
-    while i < len(actions) - 1:
-        timestamp, action = actions[i]
+    times = actions.ts.tolist()
+    screens = actions.screen.tolist()
 
-        if action == "HEARTBEAT":
-            i += 1
-            continue
+    for start, end, action in compact_events(actions):
+        before_time, after_time = entry_span(times[start], times[end], times[start - 1] if start > 0 else None,
+                                             times[end + 1] if end < len(actions) - 1 else None)
 
-        if i == 0:
-            before_time = (timestamp - timedelta(milliseconds=150)).time()
-        else:
-            midpoint = (actions[i - 1][0] + (actions[i][0] - actions[i - 1][0]) / 2).time()
-            before_time = max(midpoint, (actions[i][0] - timedelta(milliseconds=150)).time())
-
-        # 合并连续键入
-        if len(action) == 1:
-            word = action
-            while i < len(actions) - 1 and len(actions[i+1][1]) == 1:
-                word += actions[i+1][1]
-                i += 1
-            if word:
-                action = f"<Type '{word}'>"
-
-        # 处理连续删除
-        if action == "<Backspace>":
-            while i < len(actions) - 1 and actions[i+1][1] == "<Backspace>":
-                i += 1
-            action = "<Backspace>"
-        
-        # 处理拖拽
-        if i < len(actions) - 1 and action.startswith("<LButtonDown") and actions[i+1][1].startswith("<LButtonUp"):
-            # 提取第一个操作的坐标
-            coordinate1 = tuple(map(int, action.split("(")[1].split(")")[0].split(", ")))
-            # 提取第二个操作的坐标
-            coordinate2 = tuple(map(int, actions[i+1][1].split("(")[1].split(")")[0].split(", ")))
-            i += 1
-            action = f"<Drag From {coordinate1} To {coordinate2}>"
-
-        # 处理鼠标点击
-        if i < len(actions) - 1 and ((action.startswith("<LButtonDown") and (actions[i+1][1].startswith("<LClick") or actions[i+1][1].startswith("<LDblClick"))) or (action.startswith("<RButtonDown") and (actions[i+1][1].startswith("<RClick") or actions[i+1][1].startswith("<RDblClick")))):
-            # 提取第一个操作的坐标
-            coordinate1 = tuple(map(int, action.split("(")[1].split(")")[0].split(", ")))
-            # 提取第二个操作的坐标
-            coordinate2 = tuple(map(int, actions[i+1][1].split("(")[1].split(")")[0].split(", ")))
-            if coordinate1 == coordinate2:
-                i += 1
-                action = actions[i][1]
-        
-        if i == len(actions) - 1:
-            after_time = actions[i][0].time()
-        else:
-            midpoint = (actions[i][0] + (actions[i+1][0] - actions[i][0]) / 2).time()
-            after_time = max(midpoint, (actions[i+1][0] - timedelta(milliseconds=150)).time())  
-    
-        i += 1
-        
         # 生成字幕条目
-        start_time = datetime.combine(datetime.min, before_time).strftime('%H:%M:%S,%f')[:-3]
-        end_time = datetime.combine(datetime.min, after_time).strftime('%H:%M:%S,%f')[:-3]
+        start_time = format_time_ms(before_time, sep=',')
+        end_time = format_time_ms(after_time, sep=',')
         subtitle_entry = f"{subtitle_index}\n{start_time} --> {end_time}\n{action}\n"
         subtitles.append(subtitle_entry)
         subtitle_index += 1
 
         if sequence == []:
-            sequence.append(f"{before_time.strftime('%H:%M:%S.%f')[:-3]}\n{action}, {after_time.strftime('%H:%M:%S.%f')[:-3]}\n")
+            sequence.append(f"{format_time_ms(before_time)}\n{action}, {format_time_ms(after_time)}\n")
+            records.append((before_time, '', screens[end]))
         else:
-            sequence.append(f"{action}, {after_time.strftime('%H:%M:%S.%f')[:-3]}\n")
+            sequence.append(f"{action}, {format_time_ms(after_time)}\n")
+        records.append((after_time, action, screens[end]))
 
     # 写入字幕文件
     with open(output_file, 'w') as f:
@@ -226,16 +120,17 @@ def generate_subtitles_and_sequence(video_path, actions, output_file, sequence_f
     # 写入序列文件
     with open(sequence_file, 'w') as f:
         f.writelines(sequence)
-    
-    cap.release()
+    sequence_bin_file = write_sequence_bin(sequence_bin_path(sequence_file), records)
+
     print(f"Subtitles file saved as {output_file}")
-    print(f"Sequence file saved as {sequence_file}")
+    print(f"Sequence file saved as {sequence_file} and {sequence_bin_file}")
+    return [output_file, sequence_file, sequence_bin_file]
 
-def process_folder(folder_path):
+# debug 为 True 时额外写出 *_relative.txt 和 *_adjusted.txt 两个中间文件
+def process_folder(folder_path, debug=False):
     print("Now processing folder :", folder_path)
 
-    video_files = glob.glob(os.path.join(folder_path, "*.mp4")) + glob.glob(os.path.join(folder_path, "*.mkv"))
-    txt_files = glob.glob(os.path.join(folder_path, "*.txt"))
+    video_files, txt_files = find_session_files(folder_path)
 
     if not video_files or not txt_files:
         print(f"No video or txt files found in {folder_path}")
@@ -248,32 +143,51 @@ def process_folder(folder_path):
     output_dir = folder_path
     os.makedirs(output_dir, exist_ok=True)
 
-    relative_log_path, ctrl_time = convert_to_relative_time(log_path)
+    entries, ctrl_time = read_log(log_path)
+    outputs = []
+    if debug:
+        relative_log_path = log_path.replace('.txt', '_relative.txt')
+        write_log(entries, relative_log_path)
+        print(f"Relative time file saved as {relative_log_path}")
+        outputs.append(relative_log_path)
 
-    key_frame = find_key_frame(video_path=video_path)
+    # 没有 <Ctrl> 时不需要检测同步色块
+    if ctrl_time is None:
+        print("No <Ctrl> action found in the log file.")
+        return
 
-    cap = cv2.VideoCapture(video_path)
-    fps = cap.get(cv2.CAP_PROP_FPS)
+    probe = probe_video(video_path)
+    if probe is None:
+        return
+    key_frame = probe['key_frame']
+    fps = probe['fps']
     print("fps:", fps)
+    if key_frame is None:
+        raise RuntimeError(f"No sync marker found in {video_path}")
 
-    if ctrl_time is not None:
-        t1 = ctrl_time * 1000  # Convert to milliseconds
-        key_frame_time = key_frame / fps * 1000  # Convert frame number to milliseconds
-        OFFSET = t1 - key_frame_time
-        print(f"Calculated OFFSET: {OFFSET} ms")
+    t1 = ctrl_time * 1000  # Convert to milliseconds
+    key_frame_time = key_frame / fps * 1000  # Convert frame number to milliseconds
+    OFFSET = t1 - key_frame_time
+    print(f"Calculated OFFSET: {OFFSET} ms")
 
-        adjusted_log_path = adjust_timestamps(relative_log_path, OFFSET)
+    adjusted_entries = adjust_timestamps(entries, OFFSET)
+    if debug:
+        adjusted_log_path = log_path.replace('.txt', '_adjusted.txt')
+        write_log(adjusted_entries, adjusted_log_path)
+        print(f"Adjusted time file saved as {adjusted_log_path}")
+        outputs.append(adjusted_log_path)
 
-        actions = parse_log(adjusted_log_path)
-        generate_subtitles_and_sequence(video_path, actions, os.path.join(output_dir, "subtitles.srt"), os.path.join(output_dir, "sequence.txt"))
-
-    else:
-        print("No <Ctrl> action found in the log file.")
+    actions = parse_log(adjusted_entries)
+    subtitles_path = os.path.join(output_dir, "subtitles.srt")
+    sequence_path = os.path.join(output_dir, "sequence.txt")
+    return outputs + generate_subtitles_and_sequence(actions, subtitles_path, sequence_path)
 
 
 if __name__ == "__main__":
     base_folder = "./Pikalab/save"
-    subfolders = [f.path for f in os.scandir(base_folder) if f.is_dir()]
+    workers = os.cpu_count()  # 并行处理的进程数
+
+    # 参数或输入文件变化时才会重新处理对应的文件夹
+    params = {'aligner': 'align', 'target_color': TARGET_COLOR, 'tolerance': TOLERANCE, 'stride': SEARCH_STRIDE}
 
-    for folder in subfolders:
-        process_folder(folder)
+    run_batch(base_folder, process_folder, workers=workers, params=params)
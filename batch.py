@@ -0,0 +1,103 @@
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import cv2
+
+from manifest import compact_manifest, record_folder, split_stale_folders
+
+BATCH_STATUS_NAME = 'batch_status.json'
+
+
+# 每个进程只用一个 OpenCV 线程，避免多进程时线程数超过核数
+def init_worker():
+    cv2.setNumThreads(1)
+
+
+# 在子进程中处理一个文件夹，异常只记录不抛出
+def _run_folder(process_func, folder):
+    start = time.time()
+    try:
+        result = process_func(folder)
+        status = 'ok' if result is not None else 'skipped'
+        error = None
+    except Exception:
+        result = None
+        status = 'failed'
+        error = traceback.format_exc()
+    return {'folder': folder, 'status': status, 'result': result, 'error': error,
+            'seconds': round(time.time() - start, 3)}
+
+
+def _folder_size(folder):
+    return sum(f.stat().st_size for f in os.scandir(folder) if f.is_file())
+
+
+def list_subfolders(base_folder):
+    return [f.path for f in os.scandir(base_folder) if f.is_dir()]
+
+
+# 用进程池并行处理 base_folder 下的每个文件夹，某个文件夹出错不影响其他文件夹
+# process_func(folder) 返回生成的文件列表，返回 None 表示跳过，抛出异常表示失败
+# 处理结果汇总写入 base_folder/batch_status.json
+# 传入 params 时启用增量处理: 输入文件和参数都没有变化的文件夹直接跳过，
+# 处理完成的文件夹记录到 base_folder/align_manifest.jsonl
+def run_batch(base_folder, process_func, workers=None, folders=None, status_file=BATCH_STATUS_NAME, params=None):
+    if folders is None:
+        folders = list_subfolders(base_folder)
+    fingerprints = None
+    up_to_date = 0
+    if params is not None:
+        total = len(folders)
+        folders, fingerprints = split_stale_folders(base_folder, folders, params)
+        up_to_date = total - len(folders)
+        print(f"{up_to_date} of {total} folders are up to date, {len(folders)} to process")
+    # 大的文件夹先处理，减少最后只剩一个进程在跑的时间
+    folders = sorted(folders, key=_folder_size, reverse=True)
+    workers = min(workers or os.cpu_count() or 1, max(len(folders), 1))
+
+    statuses = []
+    start = time.time()
+
+    def finish(status):
+        statuses.append(status)
+        _report(status, len(statuses), len(folders))
+        if fingerprints is not None and status['status'] != 'failed':
+            record_folder(base_folder, status['folder'], fingerprints[status['folder']], status['result'])
+
+    if workers == 1:
+        for folder in folders:
+            finish(_run_folder(process_func, folder))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+            futures = {executor.submit(_run_folder, process_func, folder): folder for folder in folders}
+            for future in as_completed(futures):
+                try:
+                    status = future.result()
+                except Exception:
+                    # 子进程异常退出(例如解码器崩溃)
+                    status = {'folder': futures[future], 'status': 'failed', 'result': None,
+                              'error': traceback.format_exc(), 'seconds': None}
+                finish(status)
+
+    if fingerprints is not None:
+        compact_manifest(base_folder)
+    statuses.sort(key=lambda s: s['folder'])
+    counts = {'up_to_date': up_to_date} if up_to_date else {}
+    for status in statuses:
+        counts[status['status']] = counts.get(status['status'], 0) + 1
+    summary = {'base_folder': base_folder, 'workers': workers, 'seconds': round(time.time() - start, 3),
+               'counts': counts, 'folders': statuses}
+    if status_file:
+        with open(os.path.join(base_folder, status_file), 'w') as f:
+            json.dump(summary, f, indent=1, ensure_ascii=False)
+    print(f"Batch finished in {summary['seconds']}s with {workers} workers: {counts}")
+    return statuses
+
+
+def _report(status, done, total):
+    print(f"[{done}/{total}] {status['status']}: {status['folder']}")
+    if status['error']:
+        print(status['error'])
@@ -0,0 +1,446 @@
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+from PIL import Image, ImageDraw
+
+from captions import CaptionStore, batch_custom_id, import_batch
+from compaction import DEFAULT_RULES, ScrollRunRule, compact_events
+from cut_keyframe import SEEK_THRESHOLD, load_sequence, parse_sequence_file, process_videos
+from dect_frame import find_key_frame
+from GPT_response import CaptionClient, build_payload, session_pairs
+from events import EventTable
+from image_cache import ImageCache
+from no_change import NO_CHANGE_RATIO
+from response_cache import ResponseCache
+from sequence_bin import sequence_bin_path, write_sequence_bin
+from shards import SHARD_SIZE, ShardDataset
+from time_utils import DAY_MS, format_time_ms, parse_time_ms, parse_times_ms, subtract_offset_ms
+from tests.mock_api import start_mock_api
+
+
+# 对比逐帧检测与稀疏检测解码的帧数和耗时
+def bench_find_key_frame(video_path, stride=8):
+    results = {}
+    for mode, s in (("exact", 1), ("sparse", stride)):
+        stats = {}
+        start = time.perf_counter()
+        key_frame = find_key_frame(video_path, stride=s, stats=stats)
+        elapsed = time.perf_counter() - start
+        results[mode] = key_frame
+        print(f"[{mode}] key_frame={key_frame} retrieved={stats['retrieved']} "
+              f"grabbed={stats['grabbed']} seeks={stats['seeks']} time={elapsed:.2f}s")
+    if results["exact"] != results["sparse"]:
+        print(f"结果不一致: exact={results['exact']} sparse={results['sparse']}")
+    return results
+
+
+def _synthetic_timestamps(count, seed=0):
+    rng = random.Random(seed)
+    t = 9 * 3600000
+    timestamps = []
+    for _ in range(count):
+        t += rng.randint(0, 60)
+        timestamps.append(format_time_ms(t))
+    return timestamps
+
+
+# 对比 strptime/timedelta 与整数毫秒两种方式计算相对时间、减去偏移并格式化的耗时，输出必须完全一致
+def bench_timestamps(count=1000000, offset=1234.5678):
+    timestamp_strs = _synthetic_timestamps(count)
+
+    start = time.perf_counter()
+    base_time = None
+    legacy = []
+    for timestamp_str in timestamp_strs:
+        timestamp = datetime.strptime(timestamp_str, '%H:%M:%S.%f')
+        if base_time is None:
+            base_time = timestamp
+        relative_time = (timestamp - base_time).total_seconds()
+        relative = datetime.combine(timestamp.date(), (datetime.min + timedelta(seconds=relative_time)).time())
+        timestamp_ms = relative.hour * 3600000 + relative.minute * 60000 + relative.second * 1000 + relative.microsecond / 1000
+        if timestamp_ms > offset:
+            legacy.append((relative - timedelta(milliseconds=offset)).time().strftime('%H:%M:%S.%f')[:-3])
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    timestamps = parse_times_ms(timestamp_strs)
+    relative_times = ((timestamps - timestamps[0]) % DAY_MS).tolist()
+    current = [format_time_ms(subtract_offset_ms(t, offset)) for t in relative_times if t > offset]
+    current_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for timestamp_str in timestamp_strs:
+        parse_time_ms(timestamp_str)
+    scalar_time = time.perf_counter() - start
+
+    print(f"{count} timestamps: datetime {legacy_time:.2f}s, int ms {current_time:.2f}s "
+          f"({legacy_time / current_time:.1f}x), scalar parse only {scalar_time:.2f}s")
+    if legacy != current:
+        print("输出不一致")
+    return legacy_time, current_time
+
+
+def _synthetic_actions(count, seed=0):
+    rng = random.Random(seed)
+    choices = ['HEARTBEAT', '<Backspace>', '<Ctrl>', '<Space>', '<Enter>']
+    for _ in range(count):
+        r = rng.random()
+        if r < 0.3:
+            yield rng.choice('abcdefghijklmnopqrstuvwxyz')
+        elif r < 0.7:
+            button = rng.choice(['LButtonDown', 'LButtonUp', 'LClick', 'RButtonDown', 'RClick', 'Scroll'])
+            yield f"<{button} ({rng.randint(0, 3839)}, {rng.randint(0, 2159)})>"
+        else:
+            yield rng.choice(choices)
+
+
+# 对比 (datetime, str) 元组列表和 EventTable 每个动作占用的内存
+def bench_event_memory(count=1000000):
+    actions = list(_synthetic_actions(count))
+    timestamps = [datetime(1900, 1, 1) + timedelta(milliseconds=i * 37) for i in range(count)]
+
+    tracemalloc.start()
+    legacy = [(timestamp, "".join(action)) for timestamp, action in zip(timestamps, actions)]
+    legacy_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # datetime 对象本身也算在每个动作里
+    legacy_bytes += sum(map(sys.getsizeof, timestamps[:1000])) / 1000 * count
+    del legacy
+
+    tracemalloc.start()
+    table = EventTable()
+    for i, action in enumerate(actions):
+        table.append(i * 37, action)
+    table.text_buffer
+    table_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    print(f"{count} actions: tuples {legacy_bytes / count:.0f} bytes/action, "
+          f"EventTable {table_bytes / count:.0f} bytes/action (columns {table.nbytes() / count:.0f})")
+    return legacy_bytes, table_bytes
+
+
+# 原来 generate_subtitles_and_sequence 中的合并循环，作为对照
+def _legacy_compact(names):
+    entries = []
+    i = 0
+    while i < len(names) - 1:
+        start, action = i, names[i]
+        if action == "HEARTBEAT":
+            i += 1
+            continue
+        if len(action) == 1:
+            word = action
+            while i < len(names) - 1 and len(names[i+1]) == 1:
+                word += names[i+1]
+                i += 1
+            action = f"<Type '{word}'>"
+        if action == "<Backspace>":
+            while i < len(names) - 1 and names[i+1] == "<Backspace>":
+                i += 1
+        if i < len(names) - 1 and action.startswith("<LButtonDown") and names[i+1].startswith("<LButtonUp"):
+            coordinate1 = tuple(map(int, action.split("(")[1].split(")")[0].split(", ")))
+            coordinate2 = tuple(map(int, names[i+1].split("(")[1].split(")")[0].split(", ")))
+            i += 1
+            action = f"<Drag From {coordinate1} To {coordinate2}>"
+        if i < len(names) - 1 and ((action.startswith("<LButtonDown") and (names[i+1].startswith("<LClick") or names[i+1].startswith("<LDblClick"))) or (action.startswith("<RButtonDown") and (names[i+1].startswith("<RClick") or names[i+1].startswith("<RDblClick")))):
+            coordinate1 = tuple(map(int, action.split("(")[1].split(")")[0].split(", ")))
+            coordinate2 = tuple(map(int, names[i+1].split("(")[1].split(")")[0].split(", ")))
+            if coordinate1 == coordinate2:
+                i += 1
+                action = names[i]
+        entries.append((start, i, action))
+        i += 1
+    return entries
+
+
+# 对比原来的合并循环和规则引擎的耗时，默认规则下两者输出必须完全一致
+def bench_compaction(count=1000000):
+    table = EventTable()
+    for i, action in enumerate(_synthetic_actions(count)):
+        table.append(i * 37, action)
+
+    # 原来的函数也要先还原出每个动作的文本
+    start = time.perf_counter()
+    legacy = _legacy_compact([table.action(i) for i in range(len(table))])
+    legacy_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    current = compact_events(table)
+    current_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scroll = compact_events(table, DEFAULT_RULES + [ScrollRunRule()])
+    scroll_time = time.perf_counter() - start
+
+    print(f"{count} actions -> {len(current)} entries: loop {legacy_time:.2f}s, rules {current_time:.2f}s "
+          f"({legacy_time / current_time:.1f}x); with scroll runs {len(scroll)} entries {scroll_time:.2f}s")
+    if legacy != current:
+        print("输出不一致")
+    return legacy_time, current_time
+
+
+# 对比解析 sequence.txt 和映射 sequence.bin 的耗时和内存，随机访问的结果必须一致
+def bench_sequence_load(count=500000, samples=1000):
+    rng = random.Random(0)
+    records = [(0, '', 0)]
+    t = 0
+    for action in _synthetic_actions(count):
+        t += rng.randint(0, 2000)
+        records.append((t, action, 0))
+    lines = [f"{format_time_ms(records[0][0])}\n"] + [f"{action}, {format_time_ms(ts)}\n" for ts, action, _ in records[1:]]
+    indices = [rng.randrange(len(records)) for _ in range(samples)]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        sequence_file = os.path.join(tmp_dir, 'sequence.txt')
+        with open(sequence_file, 'w') as f:
+            f.writelines(lines)
+        write_sequence_bin(sequence_bin_path(sequence_file), records)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        legacy = parse_sequence_file(sequence_file)
+        legacy_rows = [legacy[i] for i in indices]
+        legacy_time = time.perf_counter() - start
+        legacy_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del legacy
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        sequence = load_sequence(sequence_file)
+        rows = [sequence[i] for i in indices]
+        current_time = time.perf_counter() - start
+        current_bytes = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        del sequence
+
+    print(f"{len(records)} lines, {samples} random rows: sequence.txt {legacy_time:.2f}s {legacy_bytes / 2 ** 20:.1f}MB, "
+          f"sequence.bin {current_time * 1000:.1f}ms {current_bytes / 2 ** 20:.2f}MB")
+    if legacy_rows != rows:
+        print("输出不一致")
+    return legacy_time, current_time
+
+
+# 对比每个动作都跳转(原来的方式)和按帧号顺序读一遍视频截帧的耗时，两者截出的图片必须完全一致
+def bench_extraction(video_dir, sequence_file, seek_threshold=SEEK_THRESHOLD):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for mode, threshold in (("seek", -1), ("sequential", seek_threshold)):
+            output_dir = os.path.join(tmp_dir, mode)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                stats = process_videos(video_dir, sequence_file, output_dir, seek_threshold=threshold)
+            elapsed = time.perf_counter() - start
+            results[mode] = {name: hashlib.md5(open(os.path.join(output_dir, name), 'rb').read()).hexdigest()
+                             for name in os.listdir(output_dir)}
+            print(f"[{mode}] frames={len(results[mode])} retrieved={stats['retrieved']} grabbed={stats['grabbed']} "
+                  f"seeks={stats['seeks']} time={elapsed:.2f}s (decode {stats['decode_seconds']:.2f}s, "
+                  f"encode {stats['encode_seconds']:.2f}s, wait {stats['wait_seconds']:.2f}s)")
+    if results["seek"] != results["sequential"]:
+        print("截出的图片不一致")
+    return results
+
+
+# 对比单独的图片文件和打包的数据集: 写出的文件数和耗时，以及读取所有样本的吞吐量
+# 单独的图片文件读取时需要列目录并逐个打开，数据集按 index.npy 中的偏移直接读
+def bench_dataset(video_dir, sequence_file, shard_size=SHARD_SIZE, rounds=3):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        loose_dir = os.path.join(tmp_dir, "loose")
+        shard_dir = os.path.join(tmp_dir, "shards")
+        for mode, output_dir, size in (("loose", loose_dir, None), ("shards", shard_dir, shard_size)):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                process_videos(video_dir, sequence_file, output_dir, shard_size=size)
+            elapsed = time.perf_counter() - start
+            files = sum(len(names) for _, _, names in os.walk(output_dir))
+            print(f"[{mode}] write time={elapsed:.2f}s files={files}")
+
+        start = time.perf_counter()
+        for _ in range(rounds):
+            loose = {}
+            for name in sorted(os.listdir(loose_dir)):
+                if name.startswith("frame_"):
+                    with open(os.path.join(loose_dir, name), 'rb') as f:
+                        loose[os.path.splitext(name)[0]] = f.read()
+        loose_time = (time.perf_counter() - start) / rounds
+
+        start = time.perf_counter()
+        with ShardDataset(shard_dir) as dataset:
+            open_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(rounds):
+                packed = {meta['name']: dataset.read(i) for i, meta in enumerate(dataset.meta)}
+        shard_time = (time.perf_counter() - start) / rounds
+
+    size = sum(len(data) for data in packed.values())
+    print(f"[loose] read {len(loose)} samples in {loose_time * 1000:.1f}ms "
+          f"({len(loose) / loose_time:.0f} samples/s, {size / loose_time / 2 ** 20:.0f} MB/s)")
+    print(f"[shards] read {len(packed)} samples in {shard_time * 1000:.1f}ms "
+          f"({len(packed) / shard_time:.0f} samples/s, {size / shard_time / 2 ** 20:.0f} MB/s), "
+          f"open {open_time * 1000:.1f}ms")
+    if loose != packed:
+        print("数据集与单独的图片文件不一致")
+    return loose_time, shard_time
+
+
+# 对比不同并发数下给 n 对图片打 caption 的耗时(模拟 API 每个请求 delay 秒)
+def bench_captioning(n=40, delay=0.2, error_rate=0.1):
+    server = start_mock_api(delay, error_rate)
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    image = Image.new('RGB', (1024, 684), (200, 200, 200))
+    items = [(image, image, ("LClick", {'x': 100, 'y': 100})) for _ in range(n)]
+    try:
+        for concurrency in (1, 4, 16):
+            with CaptionClient(api_key="mock", url=url, concurrency=concurrency, backoff=0.05) as client:
+                start = time.perf_counter()
+                results = client.caption_pairs(items)
+                elapsed = time.perf_counter() - start
+            ok = sum(result['status'] == 'ok' for result in results)
+            attempts = sum(result['attempts'] for result in results)
+            print(f"[concurrency={concurrency}] {n} pairs in {elapsed:.2f}s, ok={ok} failed={n - ok} "
+                  f"requests={attempts}")
+    finally:
+        server.shutdown()
+
+
+# 同样的 n 对图片打两次 caption，对比没有缓存和缓存命中时的耗时，max_bytes 很小时可以看到淘汰
+def bench_response_cache(n=40, delay=0.5, max_bytes=1024 * 1024):
+    server = start_mock_api(delay, 0.0)
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    items = [(Image.new('RGB', (1024, 684), (i, 200, 200)), Image.new('RGB', (1024, 684), (200, i, 200)),
+              ("LClick", {'x': 100, 'y': 100})) for i in range(n)]
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for run in ("cold", "warm"):
+                cache = ResponseCache(tmp_dir, max_bytes)
+                with CaptionClient(api_key="mock", url=url, concurrency=4, cache=cache) as client:
+                    start = time.perf_counter()
+                    results = client.caption_pairs(items)
+                    elapsed = time.perf_counter() - start
+                requests_sent = sum(result['attempts'] for result in results)
+                print(f"[{run}] {n} pairs in {elapsed:.2f}s, requests={requests_sent} {cache.stats} "
+                      f"entries={len(cache)} bytes={cache.size}")
+    finally:
+        server.shutdown()
+
+
+# 对比以前的做法(原图大小、每次重新编码)和缩小到 detail 大小并缓存编码结果时，构造每个请求的 CPU 时间和请求大小
+# image_dir 为 cut_keyframe 截取的图片目录，crop 为 False 时不裁剪(每帧在相邻两对中的图片完全相同)
+def bench_payloads(image_dir, sequence_file, limit=200, crop=True, resolution="low"):
+    pairs = session_pairs(image_dir, load_sequence(sequence_file))[:limit]
+    for name, options in (("legacy", {'resize': False, 'image_cache': False}),
+                          ("resized", {'resize': True, 'image_cache': False}),
+                          ("resized+cache", {'resize': True, 'image_cache': ImageCache()})):
+        start, cpu_start = time.perf_counter(), time.process_time()
+        size = 0
+        for _, (image1, image2, action), cropped in pairs:
+            payload = build_payload(image1, image2, action, resolution=resolution, crop=crop and not cropped, **options)
+            size += len(json.dumps(payload))
+        elapsed, cpu = time.perf_counter() - start, time.process_time() - cpu_start
+        cache = options['image_cache']
+        print(f"[{name}] {len(pairs)} requests: {cpu / len(pairs) * 1000:.1f}ms CPU/request "
+              f"({elapsed:.2f}s wall), {size / len(pairs) / 1024:.1f}KB/request"
+              + (f", {cache.stats['hits']} hits {cache.stats['misses']} misses" if cache else ""))
+
+
+# 导入 n 行批处理结果(分布在 sessions 个会话中)的耗时，结果文件和数据库都是生成的，不需要网络
+def bench_batch_import(n=1000000, sessions=100):
+    per_session = n // sessions
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        with CaptionStore(os.path.join(tmp_dir, "captions.db")) as store:
+            for s in range(sessions):
+                store.put_many([(f"session_{s:04d}", idx, "gpt-4o-mini", "bench", {'status': 'pending'},
+                                 ["LClick", {'x': 100, 'y': 100}], None, None) for idx in range(1, per_session + 1)])
+            output_path = os.path.join(tmp_dir, "output.jsonl")
+            with open(output_path, 'w', encoding='utf-8') as f:
+                for s in range(sessions):
+                    for idx in range(1, per_session + 1):
+                        f.write(json.dumps({
+                            'id': f"batch_req_{s}_{idx}", 'custom_id': batch_custom_id(f"session_{s:04d}", idx, "gpt-4o-mini", "bench"),
+                            'response': {'status_code': 200, 'body': {'choices': [{'index': 0, 'message': {
+                                'role': 'assistant', 'content': "The user clicked the Save button to save the document."}}]}},
+                            'error': None}) + '\n')
+            size = os.path.getsize(output_path)
+            start = time.perf_counter()
+            summary = import_batch([output_path], store)
+            elapsed = time.perf_counter() - start
+            print(f"[import] {sessions * per_session} lines ({size / 1024 / 1024:.0f}MB) in {elapsed:.2f}s "
+                  f"({sessions * per_session / elapsed:.0f} lines/s) {summary} {store.counts()}")
+
+
+# n 对图片中 unchanged 比例的前后两张图完全相同(其余的在鼠标旁画一个小方块)，
+# 对比不检查、没有变化时用模板和改发单张图片请求时的耗时和请求数
+def bench_no_change(n=40, unchanged=0.3, delay=0.2):
+    server = start_mock_api(delay, 0.0)
+    url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    rng = random.Random(0)
+    items = []
+    for i in range(n):
+        before = Image.new('RGB', (1920, 1080), (230, 230, 230))
+        ImageDraw.Draw(before).rectangle((100 + i, 100, 900, 600), fill=(40, 90, 160))
+        after = before.copy()
+        x, y = rng.randrange(200, 1700), rng.randrange(200, 900)
+        if i >= n * unchanged:
+            ImageDraw.Draw(after).rectangle((x, y, x + 12, y + 12), fill=(0, 0, 0))
+        items.append((before, after, ("LClick", {'x': x, 'y': y})))
+    try:
+        for no_change, route in ((None, 'template'), (NO_CHANGE_RATIO, 'template'), (NO_CHANGE_RATIO, 'cheap')):
+            with CaptionClient(api_key="mock", url=url, concurrency=4, no_change=no_change, no_change_route=route) as client:
+                start = time.perf_counter()
+                results = client.caption_pairs(items, image_cache=False)
+                elapsed = time.perf_counter() - start
+            requests_sent = sum(result['attempts'] for result in results)
+            print(f"[{'off' if no_change is None else route}] {n} pairs in {elapsed:.2f}s, requests={requests_sent} "
+                  f"{client.stats}")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    # 用法: python benchmark.py key_frame video.mp4 [stride]
+    #       python benchmark.py timestamps [行数]
+    #       python benchmark.py events [动作数]
+    #       python benchmark.py compaction [动作数]
+    #       python benchmark.py sequence [动作数]
+    #       python benchmark.py extraction 视频目录 sequence.txt [跳转阈值]
+    #       python benchmark.py dataset 视频目录 sequence.txt [分片大小]
+    #       python benchmark.py captioning [图片对数]
+    #       python benchmark.py response_cache [图片对数]
+    #       python benchmark.py payloads 图片目录 sequence.txt [请求数]
+    #       python benchmark.py batch_import [行数]
+    #       python benchmark.py no_change [图片对数]
+    name, args = sys.argv[1], sys.argv[2:]
+    if name == "key_frame":
+        bench_find_key_frame(args[0], *map(int, args[1:]))
+    elif name == "timestamps":
+        bench_timestamps(*map(int, args))
+    elif name == "events":
+        bench_event_memory(*map(int, args))
+    elif name == "compaction":
+        bench_compaction(*map(int, args))
+    elif name == "sequence":
+        bench_sequence_load(*map(int, args))
+    elif name == "extraction":
+        bench_extraction(args[0], args[1], *map(int, args[2:]))
+    elif name == "dataset":
+        bench_dataset(args[0], args[1], *map(int, args[2:]))
+    elif name == "captioning":
+        bench_captioning(*map(int, args))
+    elif name == "response_cache":
+        bench_response_cache(*map(int, args))
+    elif name == "payloads":
+        bench_payloads(args[0], args[1], *map(int, args[2:]))
+    elif name == "batch_import":
+        bench_batch_import(*map(int, args))
+    elif name == "no_change":
+        bench_no_change(*map(int, args))
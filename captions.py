@@ -0,0 +1,320 @@
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from batch import list_subfolders
+from cut_keyframe import load_sequence
+from GPT_response import CONCURRENCY, PROMPT_VERSION, CaptionClient, build_payload, pair_options, session_pairs
+from response_cache import default_cache
+
+# 批量打 caption 的结果保存在 SQLite 数据库中，每完成一对图片就写入一条
+# 主键为 (会话, 动作序号, 模型, prompt 版本)，重新运行时已经成功的项直接跳过，失败的项会重试
+# 中途崩溃最多丢失正在进行的 concurrency 个请求
+CAPTION_DB_NAME = 'captions.db'
+
+# 离线批处理(Batch API)的请求文件: 每行一个 {"custom_id", "method", "url", "body"}，body 为 build_payload 的结果
+# 每个文件最多 BATCH_MAX_REQUESTS 个请求、BATCH_MAX_BYTES 字节，超过时写到下一个文件
+BATCH_URL = '/v1/chat/completions'
+BATCH_MAX_REQUESTS = 50000
+BATCH_MAX_BYTES = 190 * 1024 * 1024
+# 导入结果时每这么多行提交一次
+BATCH_COMMIT_ROWS = 10000
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS captions (
+    session TEXT NOT NULL,
+    action_idx INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    status TEXT NOT NULL,
+    action TEXT,
+    image1 TEXT,
+    image2 TEXT,
+    caption TEXT,
+    error TEXT,
+    attempts INTEGER,
+    seconds REAL,
+    updated REAL,
+    PRIMARY KEY (session, action_idx, model, prompt_version)
+)
+'''
+
+
+class CaptionStore:
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        # WAL 模式下每条结果单独提交也很快，读取(导出)不会阻塞写入
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(SCHEMA)
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    # 状态在 statuses 中(默认为已经成功)的动作序号
+    def done(self, session, model, prompt_version=PROMPT_VERSION, statuses=('ok',)):
+        rows = self.connection.execute(
+            f"SELECT action_idx FROM captions WHERE session = ? AND model = ? AND prompt_version = ? "
+            f"AND status IN ({', '.join('?' * len(statuses))})",
+            (session, model, prompt_version, *statuses))
+        return {row[0] for row in rows}
+
+    # 保存一条结果，同一个键的旧结果(例如之前失败的)会被替换
+    def put(self, session, action_idx, model, prompt_version, result, action=None, image1=None, image2=None):
+        self.put_many([(session, action_idx, model, prompt_version, result, action, image1, image2)])
+
+    # 在一个事务中保存多条结果，每条为 put 的参数 (session, action_idx, model, prompt_version, result, action, image1, image2)
+    def put_many(self, rows):
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO captions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(session, action_idx, model, prompt_version, result['status'],
+              json.dumps(action, ensure_ascii=False) if action is not None else None, image1, image2,
+              result.get('caption'), result.get('error'), result.get('attempts'), result.get('seconds'), now)
+             for session, action_idx, model, prompt_version, result, action, image1, image2 in rows])
+        self.connection.commit()
+
+    # 在一个事务中更新已有的行的结果，每条为 (session, action_idx, model, prompt_version, status, caption, error)
+    # 返回更新的行数，没有对应的行的结果被忽略
+    def update_results(self, rows):
+        now = time.time()
+        cursor = self.connection.executemany(
+            "UPDATE captions SET status = ?, caption = ?, error = ?, attempts = 1, updated = ? "
+            "WHERE session = ? AND action_idx = ? AND model = ? AND prompt_version = ?",
+            [(status, caption, error, now, session, action_idx, model, prompt_version)
+             for session, action_idx, model, prompt_version, status, caption, error in rows])
+        self.connection.commit()
+        return cursor.rowcount
+
+    # 按状态统计条数，返回 {状态: 条数}
+    def counts(self, model=None, prompt_version=None):
+        query, params = self._filter("SELECT status, COUNT(*) FROM captions", model, prompt_version)
+        return dict(self.connection.execute(query + " GROUP BY status", params).fetchall())
+
+    def _filter(self, query, model, prompt_version, status=None):
+        conditions, params = [], []
+        for column, value in (('model', model), ('prompt_version', prompt_version), ('status', status)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return query, params
+
+    # 把成功的结果按会话和动作序号的顺序导出为 JSONL，每行一个样本，返回导出的条数
+    # 逐行从数据库读取并写出，不会把所有结果都读进内存
+    def export_jsonl(self, output_path, model=None, prompt_version=None):
+        query, params = self._filter(
+            "SELECT session, action_idx, model, prompt_version, action, image1, image2, caption FROM captions",
+            model, prompt_version, status='ok')
+        count = 0
+        tmp_path = output_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for session, action_idx, row_model, row_version, action, image1, image2, caption in \
+                    self.connection.execute(query + " ORDER BY session, action_idx, model, prompt_version", params):
+                f.write(json.dumps({
+                    'session': session, 'action_idx': action_idx, 'model': row_model, 'prompt_version': row_version,
+                    'action': json.loads(action) if action else None, 'image1': image1, 'image2': image2,
+                    'caption': caption,
+                }, ensure_ascii=False) + '\n')
+                count += 1
+        os.replace(tmp_path, output_path)
+        return count
+
+
+# 给一个会话中每对相邻的帧打 caption，已经成功的跳过，每完成一项立即写入 store
+# session 为保存在 store 中的会话名，默认为文件夹名；options 为 build_payload 的参数，llm 决定保存的模型名
+# 裁剪模式截的图(before_XXXX/after_XXXX)已经裁剪好，自动使用 crop=False
+# 返回这次处理的 {'ok': 成功数, 'failed': 失败数, 'skipped': 跳过数}
+def caption_session(session_dir, store, client, session=None, image_name='save_image', sequence_name='sequence.txt',
+                    **options):
+    session = session or os.path.basename(os.path.normpath(session_dir))
+    model = options.get('llm', 'gpt-4o-mini')
+    pairs = session_pairs(os.path.join(session_dir, image_name), load_sequence(os.path.join(session_dir, sequence_name)))
+    done = store.done(session, model)
+    todo = [pair for pair in pairs if pair[0] not in done]
+    summary = {'ok': 0, 'failed': 0, 'skipped': len(pairs) - len(todo)}
+
+    def save(group, result):
+        idx, (image1, image2, action) = group[result['index']]
+        store.put(session, idx, model, PROMPT_VERSION, result, action=action,
+                  image1=os.path.relpath(image1, session_dir), image2=os.path.relpath(image2, session_dir))
+        summary[result['status']] += 1
+        if result['status'] == 'failed':
+            print(f"{session} 动作 {idx} 失败: {result['error']}")
+
+    for cropped in (False, True):
+        group = [(idx, item) for idx, item, pair_cropped in todo if pair_cropped == cropped]
+        if group:
+            client.caption_pairs([item for _, item in group], on_result=lambda result: save(group, result),
+                                 **pair_options(cropped, options))
+    print(f"{session}: 成功 {summary['ok']}，失败 {summary['failed']}，跳过 {summary['skipped']}")
+    return summary
+
+
+# base_folder 下所有有 sequence 文件的会话文件夹，返回 [(会话名, 文件夹)]，会话名为相对 base_folder 的路径
+def list_sessions(base_folder, sequence_name='sequence.txt'):
+    return [(os.path.relpath(session_dir, base_folder), session_dir) for session_dir in sorted(list_subfolders(base_folder))
+            if os.path.exists(os.path.join(session_dir, sequence_name))]
+
+
+# 处理 base_folder 下的所有会话文件夹，返回 {会话: 统计}
+def caption_tree(base_folder, store, client, sequence_name='sequence.txt', **options):
+    results = {}
+    for session, session_dir in list_sessions(base_folder, sequence_name):
+        results[session] = caption_session(session_dir, store, client, session=session, sequence_name=sequence_name,
+                                           **options)
+    return results
+
+
+# 批处理请求的 custom_id，同一个 (会话, 动作序号, 模型, prompt 版本) 每次导出都相同，导入时直接解析，不需要查表
+def batch_custom_id(session, action_idx, model, prompt_version=PROMPT_VERSION):
+    return f"{session}/{action_idx}/{model}/{prompt_version}"
+
+
+def parse_custom_id(custom_id):
+    session, action_idx, model, prompt_version = custom_id.rsplit('/', 3)
+    return session, int(action_idx), model, prompt_version
+
+
+# 按请求数和字节数分文件写出批处理请求，文件名为 <output_prefix>-00000.jsonl ...
+# 先写到 .tmp，写完一个文件并改名后才用这个文件中所有请求的 item 调用 on_finish(items)
+class BatchFiles:
+    def __init__(self, output_prefix, max_requests=BATCH_MAX_REQUESTS, max_bytes=BATCH_MAX_BYTES, on_finish=None):
+        self.output_prefix = output_prefix
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.on_finish = on_finish
+        self.paths = []
+        self._file = None
+        self._items = []
+        self._requests = 0
+        self._bytes = 0
+
+    def write(self, line, item=None):
+        data = (line + '\n').encode('utf-8')
+        if self._file is None or self._requests >= self.max_requests or \
+                (self._requests and self._bytes + len(data) > self.max_bytes):
+            self._finish()
+            self.paths.append(f"{self.output_prefix}-{len(self.paths):05d}.jsonl")
+            self._file = open(self.paths[-1] + '.tmp', 'wb')
+            self._requests = self._bytes = 0
+        self._file.write(data)
+        self._items.append(item)
+        self._requests += 1
+        self._bytes += len(data)
+
+    def _finish(self):
+        if self._file is not None:
+            self._file.close()
+            os.replace(self.paths[-1] + '.tmp', self.paths[-1])
+            self._file = None
+            items, self._items = self._items, []
+            if self.on_finish is not None:
+                self.on_finish(items)
+
+    # 返回写出的文件列表
+    def close(self):
+        self._finish()
+        return self.paths
+
+
+def _batch_line(session, model, pair, options):
+    idx, (image1, image2, action), cropped = pair
+    return json.dumps({'custom_id': batch_custom_id(session, idx, model), 'method': 'POST', 'url': BATCH_URL,
+                       'body': build_payload(image1, image2, action, **pair_options(cropped, options))},
+                      ensure_ascii=False)
+
+
+# 把 base_folder 下所有会话还没有结果的动作写成批处理请求文件，返回文件列表
+# 写出的动作在 store 中记为 pending，再次导出时跳过(已经成功的也跳过)，import_batch 导入结果后变为 ok 或 failed
+# 每个请求文件写完并改名后才把其中的动作记为 pending，中途崩溃时没写完的动作下次会重新导出
+# 请求内容在 threads 个线程中并行构造，options 为 build_payload 的参数，完全离线
+def export_batch(base_folder, store, output_prefix, image_name='save_image', sequence_name='sequence.txt',
+                 max_requests=BATCH_MAX_REQUESTS, max_bytes=BATCH_MAX_BYTES, threads=CONCURRENCY, **options):
+    model = options.get('llm', 'gpt-4o-mini')
+    files = BatchFiles(output_prefix, max_requests, max_bytes, on_finish=store.put_many)
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for session, session_dir in list_sessions(base_folder, sequence_name):
+            pairs = session_pairs(os.path.join(session_dir, image_name),
+                                  load_sequence(os.path.join(session_dir, sequence_name)))
+            skip = store.done(session, model, statuses=('ok', 'pending'))
+            todo = [pair for pair in pairs if pair[0] not in skip]
+            # 分块构造，内存中最多同时有 threads * 4 个请求
+            for start in range(0, len(todo), threads * 4):
+                chunk = todo[start:start + threads * 4]
+                lines = executor.map(lambda pair: _batch_line(session, model, pair, options), chunk)
+                for line, (idx, (image1, image2, action), _) in zip(lines, chunk):
+                    files.write(line, (session, idx, model, PROMPT_VERSION, {'status': 'pending'}, action,
+                                       os.path.relpath(image1, session_dir), os.path.relpath(image2, session_dir)))
+            print(f"{session}: 导出 {len(todo)} 个请求，跳过 {len(pairs) - len(todo)}")
+    return files.close()
+
+
+def _batch_result(record):
+    response = record.get('response') or {}
+    body = response.get('body') or {}
+    key = parse_custom_id(record['custom_id'])
+    if response.get('status_code') == 200:
+        try:
+            return (*key, 'ok', body['choices'][0]['message']['content'], None)
+        except (KeyError, IndexError, TypeError):
+            pass
+    error = record.get('error') or body.get('error') or body
+    return (*key, 'failed', None, f"HTTP {response.get('status_code')}: {json.dumps(error, ensure_ascii=False)[:200]}")
+
+
+# 把批处理的结果文件(每行一个 {"custom_id", "response": {"status_code", "body"}, "error"})导入 store
+# 逐行读取，每 BATCH_COMMIT_ROWS 行提交一次，返回结果文件中成功和失败的行数 {'ok', 'failed'}，
+# 以及其中 store 中没有对应请求(被忽略)的行数 'unmatched'
+def import_batch(paths, store):
+    summary = {'ok': 0, 'failed': 0, 'unmatched': 0}
+    rows = []
+
+    def flush():
+        summary['unmatched'] += len(rows) - store.update_results(rows)
+        rows.clear()
+
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = _batch_result(json.loads(line))
+                summary[row[4]] += 1
+                rows.append(row)
+                if len(rows) >= BATCH_COMMIT_ROWS:
+                    flush()
+    flush()
+    return summary
+
+
+if __name__ == "__main__":
+    # 用法: python captions.py save文件夹 [导出的 jsonl]
+    #       python captions.py batch save文件夹 请求文件前缀        写出批处理请求文件
+    #       python captions.py import save文件夹 结果文件 ...        导入批处理的结果
+    if sys.argv[1] in ('batch', 'import'):
+        with CaptionStore(os.path.join(sys.argv[2], CAPTION_DB_NAME)) as store:
+            if sys.argv[1] == 'batch':
+                print(f"写出 {export_batch(sys.argv[2], store, sys.argv[3])}")
+            else:
+                print(import_batch(sys.argv[3:], store))
+        sys.exit()
+    base_folder = sys.argv[1]
+    cache = default_cache()
+    with CaptionStore(os.path.join(base_folder, CAPTION_DB_NAME)) as store, CaptionClient(cache=cache) as client:
+        caption_tree(base_folder, store, client)
+        print(f"缓存: {cache.stats}")
+        if len(sys.argv) > 2:
+            print(f"导出 {store.export_jsonl(sys.argv[2])} 条到 {sys.argv[2]}")
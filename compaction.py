@@ -0,0 +1,214 @@
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+from events import FLAG_COORD_ELIDED, NO_COORD, split_kind
+
+
+# 动作合并规则引擎，align.py 和 align_2screen.py 共用
+# 每个动作先按标签分类(向量化，每种动作类型只判断一次)，然后从前往后扫描一遍:
+# 在每个位置按顺序尝试以该动作开头的规则，规则吞掉的动作不会再被扫描，所以总耗时是 O(n)
+# 增加规则只需要写一个新的规则类并放进规则列表，不需要改扫描的循环
+
+
+# 标签判断函数: 参数为动作表，返回每个动作是否带这个标签的布尔数组
+# 动作类型以 prefix 开头，prefix 中不能有 "(" 和 "'"，此时与完整动作 startswith(prefix) 等价
+def kind_prefix(*prefixes):
+    def match(actions):
+        return np.isin(actions.code, actions.codes_where(lambda kind: kind.startswith(prefixes)))
+    return match
+
+
+# 完整动作等于 action
+def exact(action):
+    kind, text = split_kind(action)
+
+    def match(actions):
+        matched = np.isin(actions.code, actions.codes_where(lambda k: k == kind))
+        matched &= (actions.flags & FLAG_COORD_ELIDED) == 0
+        matched &= actions.text_length == len(text)
+        if text:
+            for i in np.flatnonzero(matched):
+                matched[i] = actions.text(i) == text
+        return matched
+    return match
+
+
+# 单个字符的键入
+def single_char(actions):
+    kind_lengths = np.array([len(kind) for kind in actions.kinds] or [0], dtype=np.int64)
+    return ((kind_lengths[actions.code] + actions.text_length == 1)
+            & ((actions.flags & FLAG_COORD_ELIDED) == 0))
+
+
+def has_coords(actions):
+    return actions.x != NO_COORD
+
+
+LABELS = {
+    'heartbeat': exact("HEARTBEAT"),
+    'char': single_char,
+    'backspace': exact("<Backspace>"),
+    'coords': has_coords,
+    'lbutton_down': kind_prefix("<LButtonDown"),
+    'lbutton_up': kind_prefix("<LButtonUp"),
+    'lclick': kind_prefix("<LClick", "<LDblClick"),
+    'rbutton_down': kind_prefix("<RButtonDown"),
+    'rclick': kind_prefix("<RClick", "<RDblClick"),
+    'scroll': kind_prefix("<Scroll"),
+}
+
+
+# 扫描时传给规则的上下文，labels[i] 是第 i 个动作的标签位
+class CompactionContext:
+    def __init__(self, actions, labels, bits):
+        self.actions = actions
+        self.labels = labels
+        self.bits = bits
+        self.names = actions.actions()
+        self.x = actions.x.tolist()
+        self.y = actions.y.tolist()
+
+    def has(self, i, label):
+        return (self.labels[i] & self.bits[label]) != 0
+
+    def action(self, i):
+        return self.names[i]
+
+    def coords(self, i):
+        return self.x[i], self.y[i]
+
+
+# 规则: start 是开头动作需要的标签，labels 是规则额外用到的标签判断函数(可选)
+# apply(ctx, i, last) 在开头为第 i 个动作时调用，last 是最后一个动作的下标，
+# 返回 (结尾下标, 合并后的动作)，不适用时返回 None；动作为 None 表示丢弃这些动作
+class Rule(ABC):
+    start = None
+    labels = {}
+
+    @abstractmethod
+    def apply(self, ctx, i, last):
+        pass
+
+
+class DropRule(Rule):
+    def __init__(self, label):
+        self.start = label
+
+    def apply(self, ctx, i, last):
+        return i, None
+
+
+# 合并连续键入
+class TypeRule(Rule):
+    start = 'char'
+
+    def apply(self, ctx, i, last):
+        j = i
+        while j < last and ctx.has(j + 1, 'char'):
+            j += 1
+        return j, f"<Type '{''.join(ctx.names[i:j + 1])}'>"
+
+
+# 连续的同类动作只保留一个
+class CollapseRule(Rule):
+    def __init__(self, label):
+        self.start = label
+
+    def apply(self, ctx, i, last):
+        j = i
+        while j < last and ctx.has(j + 1, self.start):
+            j += 1
+        return j, ctx.action(i)
+
+
+# 按下后紧接着松开为拖拽
+class DragRule(Rule):
+    start = 'lbutton_down'
+
+    def apply(self, ctx, i, last):
+        if i < last and ctx.has(i, 'coords') and ctx.has(i + 1, 'lbutton_up') and ctx.has(i + 1, 'coords'):
+            return i + 1, f"<Drag From {ctx.coords(i)} To {ctx.coords(i + 1)}>"
+        return None
+
+
+# 按下后紧接着在同一位置单击或双击，只保留单击或双击
+class ClickRule(Rule):
+    def __init__(self, down_label, click_label):
+        self.start = down_label
+        self.click_label = click_label
+
+    def apply(self, ctx, i, last):
+        if (i < last and ctx.has(i, 'coords') and ctx.has(i + 1, self.click_label) and ctx.has(i + 1, 'coords')
+                and ctx.coords(i) == ctx.coords(i + 1)):
+            return i + 1, ctx.action(i + 1)
+        return None
+
+
+# 连续滚动合并为一个动作，记录第一次滚动的位置和次数，例如 "<Scroll (100, 200) x5>"
+class ScrollRunRule(Rule):
+    start = 'scroll'
+
+    def apply(self, ctx, i, last):
+        j = i
+        while j < last and ctx.has(j + 1, 'scroll'):
+            j += 1
+        if j == i:
+            return None
+        kind = ctx.actions.kind(i).rstrip()
+        if ctx.has(i, 'coords'):
+            return j, f"{kind} {ctx.coords(i)} x{j - i + 1}>"
+        return j, f"{kind} x{j - i + 1}>"
+
+
+# 与原来 generate_subtitles_and_sequence 中的合并顺序一致
+DEFAULT_RULES = [
+    DropRule('heartbeat'),
+    TypeRule(),
+    CollapseRule('backspace'),
+    DragRule(),
+    ClickRule('lbutton_down', 'lclick'),
+    ClickRule('rbutton_down', 'rclick'),
+]
+
+
+# 把动作表合并为 (开头下标, 结尾下标, 动作) 的列表
+# 与原来的循环一致，最后一个动作不会单独成为一条，只会被前面的规则合并
+def compact_events(actions, rules=DEFAULT_RULES):
+    labels = dict(LABELS)
+    for rule in rules:
+        labels.update(rule.labels)
+    bits = {name: 1 << k for k, name in enumerate(labels)}
+    row_labels = np.zeros(len(actions), dtype=np.int64)
+    for name, bit in bits.items():
+        row_labels[labels[name](actions)] |= bit
+    ctx = CompactionContext(actions, row_labels.tolist(), bits)
+
+    # 标签组合 -> 可能适用的规则，按需建立
+    dispatch = {}
+    entries = []
+    names = ctx.names
+    row_labels = ctx.labels
+    last = len(actions) - 1
+    i = 0
+    while i < last:
+        row = row_labels[i]
+        candidates = dispatch.get(row)
+        if candidates is None:
+            candidates = dispatch[row] = [rule for rule in rules if row & bits[rule.start]]
+        if not candidates:
+            entries.append((i, i, names[i]))
+            i += 1
+            continue
+        end, action = i, None
+        for rule in candidates:
+            result = rule.apply(ctx, i, last)
+            if result is not None:
+                end, action = result
+                break
+        else:
+            action = names[i]
+        if action is not None:
+            entries.append((i, end, action))
+        i = end + 1
+    return entries
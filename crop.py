@@ -0,0 +1,57 @@
+import cv2
+import numpy as np
+
+# 以鼠标为中心裁剪的大小，GPT_response.py 和 cut_keyframe.py 共用
+CROP_WIDTH = 1024
+CROP_HEIGHT = 684
+
+
+# 以 (mouse_x, mouse_y) 为中心、大小为 width x height 的裁剪框，超出图片时平移到图片内
+# 图片比裁剪框小时为整张图片，返回 (left, top, right, bottom)
+def crop_box(mouse_x, mouse_y, img_width, img_height, width=CROP_WIDTH, height=CROP_HEIGHT):
+    # Calculate the cropping box
+    left = mouse_x - width // 2
+    top = mouse_y - height // 2
+    right = mouse_x + width // 2
+    bottom = mouse_y + height // 2
+
+    # Adjust the cropping box to ensure it stays within image bounds
+    if left < 0:
+        left = 0
+        right = min(width, img_width)
+    if right > img_width:
+        right = img_width
+        left = max(0, img_width - width)
+    if top < 0:
+        top = 0
+        bottom = min(height, img_height)
+    if bottom > img_height:
+        bottom = img_height
+        top = max(0, img_height - height)
+    return left, top, right, bottom
+
+
+# 裁剪 PIL 图片
+def crop_image_to_mouse(image, mouse_x, mouse_y, width=CROP_WIDTH, height=CROP_HEIGHT):
+    img_width, img_height = image.size
+    # Crop the image with the adjusted box
+    return image.crop(crop_box(mouse_x, mouse_y, img_width, img_height, width, height))
+
+
+# 裁剪 OpenCV 的帧(NumPy 数组)，box 为 crop_box 的结果
+def crop_frame(frame, box):
+    left, top, right, bottom = box
+    return np.ascontiguousarray(frame[top:bottom, left:right])
+
+
+# 缩小到宽度不超过 max_width 的大小，保持宽高比
+def thumbnail_size(img_width, img_height, max_width):
+    if img_width <= max_width:
+        return img_width, img_height
+    return max_width, max(1, round(img_height * max_width / img_width))
+
+
+def resize_frame(frame, size):
+    if (frame.shape[1], frame.shape[0]) == tuple(size):
+        return frame
+    return cv2.resize(frame, tuple(size), interpolation=cv2.INTER_AREA)
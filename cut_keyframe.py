@@ -1,6 +1,21 @@
 import cv2
 import os
 import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from batch import init_worker, list_subfolders
+from crop import crop_box, crop_frame, resize_frame, thumbnail_size
+from frame_writer import FrameStore, FrameWriter
+from settle import SETTLE_MAX_FRAMES, SettleTracker, settle_buffer
+from shards import ShardWriter, build_dataset
+from video_probe import probe_video
+from events import NO_COORD, EventTable, split_kind
+from sequence_bin import describe_action, open_sequence_bin
+from time_utils import ms_to_seconds, parse_time_ms
+
+# sequence.txt 中时间无法解析的动作
+NO_TIME = -1
 
 # 解析视频文件名的函数
 def parse_video_filename(filename):
@@ -27,9 +42,8 @@ def get_video_list(video_dir):
             videos.append(video_info)
     return videos
 
-# 解析sequence.txt文件的函数
-def parse_sequence_file(sequence_file):
-    actions = []
+# 逐行拆分sequence.txt，返回 (动作描述, 时间戳字符串)
+def iter_sequence_lines(sequence_file):
     with open(sequence_file, 'r', encoding='utf-8') as f:
         for line in f:
             line = line.strip()
@@ -39,85 +53,118 @@ def parse_sequence_file(sequence_file):
             if ',' in line:
                 # 从最后一个逗号拆分
                 parts = line.rsplit(',', 1)
-                action_desc = parts[0].strip()
-                timestamp_str = parts[1].strip()
+                yield parts[0].strip(), parts[1].strip()
             else:
                 # 没有逗号，说明是时间戳，动作描述为空
-                action_desc = ''
-                timestamp_str = line.strip()
-            # 尝试从action_desc中提取坐标
-            coord_pattern = r'<[^>]*\((\d+),\s*(\d+)\)>'
-            coord_match = re.search(coord_pattern, action_desc)
-            if coord_match:
-                x = int(coord_match.group(1))
-                y = int(coord_match.group(2))
-                coords = {'x': x, 'y': y}
-                # 去掉坐标部分和尖括号的action_desc
-                action_desc = re.sub(r'<([^>]+)\s*\(\d+,\s*\d+\)>', r'\1', action_desc).strip()
-            else:
-                coords = None
-                # 去掉尖括号
-                action_desc = action_desc.strip('<>')
-            actions.append((timestamp_str, action_desc, coords))
+                yield '', line
+
+# 解析sequence.txt文件，得到按列存储的动作表
+# 动作文本为去掉坐标和尖括号后的描述，坐标保存在 x, y 列中，时间无法解析时为 NO_TIME
+def parse_sequence_table(sequence_file):
+    actions = EventTable()
+    for action_desc, timestamp_str in iter_sequence_lines(sequence_file):
+        try:
+            timestamp_ms = parse_time_ms(timestamp_str)
+        except ValueError:
+            print(f"解析时间戳出错：{timestamp_str}")
+            timestamp_ms = NO_TIME
+        # 从action_desc中提取坐标，并去掉坐标部分和尖括号
+        action_desc, x, y = describe_action(action_desc)
+        kind, text = split_kind(action_desc)
+        actions.append_fields(timestamp_ms, kind, text, x, y)
     return actions
 
+# 解析sequence.txt文件的函数，返回 (时间戳, 动作描述, 坐标) 列表
+# 时间戳保持文件中的字符串，不经过 EventTable，不需要解析和重新格式化时间
+def parse_sequence_file(sequence_file):
+    actions = []
+    for action_desc, timestamp_str in iter_sequence_lines(sequence_file):
+        action_desc, x, y = describe_action(action_desc)
+        coords = {'x': x, 'y': y} if x != NO_COORD else None
+        actions.append((timestamp_str, action_desc, coords))
+    return actions
+
+# 优先映射同名的 sequence.bin(不比 sequence.txt 旧时)，不需要解析整个文件，可以按下标直接访问
+# 每一项与 parse_sequence_file 的结果相同，没有 sequence.bin 时退回 parse_sequence_file
+def load_sequence(sequence_file):
+    sequence = open_sequence_bin(sequence_file)
+    if sequence is None:
+        return parse_sequence_file(sequence_file)
+    return sequence
+
 # 将时间戳字符串转换为秒的函数
 def timestamp_to_seconds(timestamp_str):
     try:
-        # 拆分时、分、秒和毫秒
-        time_parts = timestamp_str.split(':')
-        hours = int(time_parts[0])
-        minutes = int(time_parts[1])
-        seconds_parts = time_parts[2].split('.')
-        seconds = int(seconds_parts[0])
-        if len(seconds_parts) > 1:
-            milliseconds = int(seconds_parts[1].ljust(3, '0'))  # 确保毫秒有三位数
-        else:
-            milliseconds = 0
-        total_seconds = hours * 3600 + minutes * 60 + seconds + milliseconds / 1000.0
-        return total_seconds
-    except Exception as e:
+        return ms_to_seconds(parse_time_ms(timestamp_str))
+    except ValueError:
         print(f"解析时间戳出错：{timestamp_str}")
         return None
 
-# 处理视频并保存截取的帧的函数
-def process_videos(video_dir, sequence_file, output_dir):
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    actions = parse_sequence_file(sequence_file)
-    videos_info = get_video_list(video_dir)
-    if not videos_info:
-        print("在目录中未找到有效的视频文件")
-        return
-    # 创建每个视频的 VideoCapture 对象，并获取帧率
-    for video_info in videos_info:
+# 两个目标帧之间相差超过这么多帧时直接跳转，否则一直 grab() 到下一个目标帧
+# 跳转需要从前一个关键帧重新解码，所以只有间隔比一个 GOP 还大时才划算
+SEEK_THRESHOLD = 250
+
+# 读取视频列表中每个视频的帧率、总帧数和分辨率，无法打开的视频从列表中去掉
+def probe_video_list(video_dir, videos_info):
+    for video_info in list(videos_info):
         video_file = os.path.join(video_dir, video_info['filename'])
-        cap = cv2.VideoCapture(video_file)
-        if not cap.isOpened():
+        probe = probe_video(video_file, find_sync=False)
+        if probe is None:
             print(f"无法打开视频文件 {video_file}")
+            videos_info.remove(video_info)
             continue
-        video_info['cap'] = cap
-        # 获取帧率
-        fps = cap.get(cv2.CAP_PROP_FPS)
-        video_info['fps'] = fps
-        # 获取总帧数
-        frame_count = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        video_info['frame_count'] = frame_count
+        video_info['fps'] = probe['fps']
+        video_info['frame_count'] = probe['frame_count']
+        video_info['width'] = probe['width']
+        video_info['height'] = probe['height']
+    return videos_info
+
+# 时间对应的帧号，超出视频范围时返回 None
+def _frame_number(video_info, timestamp_ms):
+    # 将时间戳转换为秒
+    timestamp_sec = ms_to_seconds(timestamp_ms)
+    # 计算时间戳对应的帧号
+    fn = int(timestamp_sec * video_info['fps'])
+    if fn < 0 or fn >= video_info['frame_count']:
+        print(f"帧号 {fn} 超出范围，跳过")
+        return None
+    return fn
+
+# 确定每个动作对应的视频和帧号，以及要从这一帧保存哪些图片
+# 每张图片为 (处理方式, 文件名)，处理方式为 ('full',)、('crop', left, top, right, bottom) 或 ('thumb', 宽, 高):
+#   crop_size 为 None 时保存原始分辨率的 frame_XXXX
+#   crop_size 为 (宽, 高) 时只保存给 GPT 用的裁剪图: 第 XXXX 个动作前后的两帧 before_XXXX 和 after_XXXX，
+#   都来自该动作所在屏幕的视频，以该动作在屏幕内的坐标为中心裁剪(与 GPT_response 相同)，动作没有坐标时不裁剪
+#   thumbnail_width 不为 None 时另外保存宽度不超过 thumbnail_width 的缩略图 thumb_XXXX
+#   previous 为 True 时不裁剪也保存上一行时间(动作开始前)的帧 before_XXXX，见 README 中 Sequence.txt 的说明
+#   window 为 (N, M) 时另外保存动作时间对应的帧之前 N 帧和之后 M 帧，文件名为 frame_XXXX(裁剪时为 after_XXXX)
+#   加上 _m1、_m2 ... 和 _p1、_p2 ...，处理方式与该动作的帧相同
+#   settle_frames 不为 None 时 frame_XXXX(裁剪时为 after_XXXX)不直接用动作时间对应的帧，而是从这一帧往后找
+#   画面连续 settle_frames 帧不变的第一帧(见 settle.py)，最多找 SETTLE_MAX_FRAMES 帧且不超过下一行的时间，
+#   找不到时仍用原来的帧；处理方式为 ('settle', 最后一帧, settle_frames) 加上原来的处理方式
+# 所有帧都在同一次按帧号顺序的解码中得到，窗口内相邻的帧不需要跳转
+# 返回 {视频文件名: [(帧号, {处理方式: [文件名, ...]}), ...]}，帧号从小到大排列，同一帧只出现一次
+def plan_extraction(actions, videos_info, crop_size=None, thumbnail_width=None, window=(0, 0), previous=False,
+                    settle_frames=None):
     last_video = None
     default_video = None
     for video_info in videos_info:
         if video_info['filename'].startswith('l0_t0'):
             default_video = video_info
             break
-    for idx, (timestamp_str, action_desc, coords) in enumerate(actions):
-        # 将时间戳转换为秒
-        timestamp_sec = timestamp_to_seconds(timestamp_str)
-        if timestamp_sec is None:
+    plan = {}
+
+    def add(video_info, fn, transform, name):
+        plan.setdefault(video_info['filename'], {}).setdefault(fn, {}).setdefault(transform, []).append(name)
+
+    times, xs, ys = actions.ts.tolist(), actions.x.tolist(), actions.y.tolist()
+    for idx in range(len(actions)):
+        if times[idx] == NO_TIME:
             continue
         # 确定要使用的视频
-        if coords:
-            x = coords['x']
-            y = coords['y']
+        if xs[idx] != NO_COORD:
+            x = xs[idx]
+            y = ys[idx]
             # 找到包含该坐标的屏幕区域对应的视频
             video_to_use = None
             for video_info in videos_info:
@@ -136,36 +183,273 @@ def process_videos(video_dir, sequence_file, output_dir):
                 video_to_use = default_video
             else:
                 # 如果没有上一个视频，跳过该动作
-                print(f"动作 '{action_desc}' 没有坐标且没有默认视频可用，跳过")
+                print(f"动作 '{actions.action(idx)}' 没有坐标且没有默认视频可用，跳过")
+                continue
+        fn = _frame_number(video_to_use, times[idx])
+        if fn is None:
+            continue
+        transform = ('full',)
+        if crop_size is not None and xs[idx] != NO_COORD:
+            # 坐标换算到该屏幕内
+            transform = ('crop',) + crop_box(xs[idx] - video_to_use['l'], ys[idx] - video_to_use['t'],
+                                             video_to_use['width'], video_to_use['height'], *crop_size)
+        before_fn = None
+        if (crop_size is not None or previous) and idx > 0 and times[idx - 1] != NO_TIME:
+            before_fn = _frame_number(video_to_use, times[idx - 1])
+        # 裁剪时只保存前后两帧都有的动作
+        if crop_size is None or before_fn is not None:
+            name = f"frame_{idx:04d}" if crop_size is None else f"after_{idx:04d}"
+            main_transform = transform
+            if settle_frames:
+                limit = min(fn + SETTLE_MAX_FRAMES, video_to_use['frame_count'] - 1)
+                if idx + 1 < len(actions) and times[idx + 1] != NO_TIME:
+                    limit = min(limit, int(ms_to_seconds(times[idx + 1]) * video_to_use['fps']) - 1)
+                if limit > fn:
+                    main_transform = ('settle', limit, settle_frames) + transform
+            add(video_to_use, fn, main_transform, name)
+            if before_fn is not None:
+                add(video_to_use, before_fn, transform, f"before_{idx:04d}")
+            for offset in list(range(-window[0], 0)) + list(range(1, window[1] + 1)):
+                if 0 <= fn + offset < video_to_use['frame_count']:
+                    add(video_to_use, fn + offset, transform, f"{name}_{'m' if offset < 0 else 'p'}{abs(offset)}")
+        if thumbnail_width is not None:
+            size = thumbnail_size(video_to_use['width'], video_to_use['height'], thumbnail_width)
+            add(video_to_use, fn, ('thumb',) + size, f"thumb_{idx:04d}")
+    return {filename: sorted(frames.items()) for filename, frames in plan.items()}
+
+# 截帧的统计: grab、retrieve、跳转的次数，解码耗时，FrameWriter 的编码耗时和写出的文件数，
+# 直接复用之前保存的帧的数量，以及稳定检测换成了更晚的帧(settled)和没有找到稳定画面(unsettled)的次数
+def empty_extraction_stats():
+    return {'grabbed': 0, 'retrieved': 0, 'seeks': 0, 'decode_seconds': 0.0, 'reused': 0,
+            'frames': 0, 'files': 0, 'bytes': 0, 'encode_seconds': 0.0, 'wait_seconds': 0.0,
+            'settled': 0, 'unsettled': 0, 'failed': []}
+
+# 一张图片在 .frame_store 中的名字，原始分辨率的帧只用帧号
+def _store_key(fn, transform):
+    if transform[0] == 'settle':
+        return f"{_store_key(fn, transform[3:])}_settle_{transform[1]}_{transform[2]}"
+    if transform[0] == 'full':
+        return f"{fn:07d}"
+    return f"{fn:07d}_{transform[0]}_{'_'.join(map(str, transform[1:]))}"
+
+def _render(frame, transform):
+    if transform[0] == 'settle':
+        return _render(frame, transform[3:])
+    if transform[0] == 'crop':
+        return crop_frame(frame, transform[1:])
+    if transform[0] == 'thumb':
+        return resize_frame(frame, transform[1:])
+    return frame
+
+# 按帧号顺序从头到尾读一遍视频，不需要的帧只 grab() 不解码成图像，目标帧才 retrieve()
+# 与下一个目标帧的间隔超过 seek_threshold 帧时才跳转，seek_threshold 为负数时每个目标帧都跳转(原来的方式)
+# 解码出的帧交给后台的 FrameWriter 编码和写入，writer_options 为 FrameWriter 的参数(图片格式、质量等)
+# 每张不同的图片只编码一次，保存在 output_dir/.frame_store 中，输出的图片都是它的硬链接；
+# 视频没有变化时，重新运行会直接复用之前保存的图片，不再解码
+# targets 为 plan_extraction 中一个视频的 [(帧号, {处理方式: [文件名, ...]}), ...]，返回统计
+def extract_frames(video_path, targets, output_dir, seek_threshold=SEEK_THRESHOLD, writer_options=None,
+                   shard_size=None):
+    stats = empty_extraction_stats()
+    if shard_size:
+        # 打包模式: 图片追加到分片文件中，见 shards.py
+        writer = store = ShardWriter(output_dir, video_path, shard_size, **(writer_options or {}))
+    else:
+        writer = FrameWriter(**(writer_options or {}))
+        store = FrameStore(output_dir, video_path, writer)
+    with writer:
+        pending = []
+        for fn, outputs in targets:
+            if any(_store_key(fn, transform) not in store for transform in outputs):
+                pending.append((fn, outputs))
                 continue
-        # 获取帧率
-        fps = video_to_use['fps']
-        # 计算时间戳对应的帧号
-        frame_number = int(timestamp_sec * fps)
-        # 获取前3帧和当前帧的帧号列表
-        frame_indices = [frame_number]
-        # 遍历帧号列表，获取对应的帧
-        for i, fn in enumerate(frame_indices):
-            if fn < 0 or fn >= video_to_use['frame_count']:
-                print(f"帧号 {fn} 超出范围，跳过")
+            for transform, names in outputs.items():
+                store.link(_store_key(fn, transform), [os.path.join(output_dir, name) for name in names])
+            stats['reused'] += 1
+        if pending:
+            _decode_frames(video_path, pending, output_dir, seek_threshold, store, stats)
+    for name, value in writer.stats.items():
+        stats[name] += value
+    # 所有图片都写完后才记录，中途出错的图片下次会重新截取
+    store.save()
+    return stats
+
+def _decode_frames(video_path, targets, output_dir, seek_threshold, store, stats):
+    outputs_at = dict(targets)
+    # 稳定检测的帧也在同一次读视频中 retrieve，其中的目标帧不会重复解码
+    needed = set(outputs_at)
+    for fn, outputs in targets:
+        for transform in outputs:
+            if transform[0] == 'settle' and _store_key(fn, transform) not in store:
+                needed.update(range(fn + 1, transform[1] + 1))
+    trackers = []
+    cap = cv2.VideoCapture(video_path)
+    # 下一次 grab() 得到的帧号
+    position = 0
+    try:
+        for fn in sorted(needed):
+            # 稳定检测都已经确定时，后面的检测帧不需要再 retrieve
+            if fn not in outputs_at and not trackers:
                 continue
-            cap = video_to_use['cap']
-            # 设置视频到指定帧
-            cap.set(cv2.CAP_PROP_POS_FRAMES, fn)
-            ret, frame = cap.read()
+            start = time.perf_counter()
+            if fn < position or fn - position > seek_threshold:
+                # 设置视频到指定帧
+                cap.set(cv2.CAP_PROP_POS_FRAMES, fn)
+                stats['seeks'] += 1
+                position = fn
+            while position < fn and cap.grab():
+                stats['grabbed'] += 1
+                position += 1
+            ret = position == fn and cap.grab()
+            if ret:
+                stats['grabbed'] += 1
+                position += 1
+                ret, frame = cap.retrieve()
+                stats['retrieved'] += 1
+            stats['decode_seconds'] += time.perf_counter() - start
             if not ret:
-                print(f"无法读取视频 {video_to_use['filename']} 帧号 {fn}")
+                if fn in outputs_at:
+                    print(f"无法读取视频 {os.path.basename(video_path)} 帧号 {fn}")
                 continue
-            # 不调整尺寸，保留原始分辨率
-            # 保存帧
-            output_filename = os.path.join(output_dir, f"frame_{idx:04d}.jpg")
-            cv2.imwrite(output_filename, frame)
-            print(f"已保存帧到 {output_filename}")
-    # 释放所有的 VideoCapture 对象
-    for video_info in videos_info:
-        cap = video_info.get('cap')
-        if cap:
-            cap.release()
+            buffer = None
+            if trackers or any(transform[0] == 'settle' for transform in outputs_at.get(fn, ())):
+                buffer = settle_buffer(frame)
+            for tracker, transform, names in list(trackers):
+                chosen = tracker.update(fn, frame, buffer)
+                if chosen is not None:
+                    trackers.remove((tracker, transform, names))
+                    _save_settled(store, tracker, chosen, transform, names, output_dir, stats)
+            # 保存帧，frame_XXXX 不调整尺寸，保留原始分辨率
+            for transform, names in outputs_at.get(fn, {}).items():
+                key = _store_key(fn, transform)
+                paths = [os.path.join(output_dir, name) for name in names]
+                if key in store:
+                    store.link(key, paths)
+                    continue
+                if transform[0] == 'settle':
+                    trackers.append((SettleTracker(fn, frame, buffer, transform[1], transform[2]), transform, names))
+                    continue
+                for output_filename in store.submit(_render(frame, transform), key, paths):
+                    print(f"已保存帧到 {output_filename}")
+        # 视频提前结束时使用原来的帧
+        for tracker, transform, names in trackers:
+            _save_settled(store, tracker, tracker.finish(), transform, names, output_dir, stats)
+    finally:
+        cap.release()
+
+def _save_settled(store, tracker, chosen, transform, names, output_dir, stats):
+    fn, frame = chosen
+    if fn != tracker.start:
+        stats['settled'] += 1
+    elif tracker.stable < tracker.stable_frames:
+        stats['unsettled'] += 1
+    paths = [os.path.join(output_dir, name) for name in names]
+    for output_filename in store.submit(_render(frame, transform), _store_key(tracker.start, transform), paths):
+        print(f"已保存帧到 {output_filename}")
+
+# 确定一个会话中要截取的帧，每个视频一个截帧任务 (视频路径, 目标帧, 输出目录)
+def plan_session(video_dir, sequence_file, output_dir, crop_size=None, thumbnail_width=None, window=(0, 0),
+                 previous=False, settle_frames=None):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    # sequence.bin 和动作表都有 ts、x、y 列
+    actions = open_sequence_bin(sequence_file)
+    if actions is None:
+        actions = parse_sequence_table(sequence_file)
+    videos_info = get_video_list(video_dir)
+    if not videos_info:
+        print("在目录中未找到有效的视频文件")
+        return None
+    probe_video_list(video_dir, videos_info)
+    plan = plan_extraction(actions, videos_info, crop_size, thumbnail_width, window, previous, settle_frames)
+    return [(os.path.join(video_dir, filename), targets, output_dir) for filename, targets in plan.items()]
+
+# 每个截帧任务在单独的进程中运行，各自打开自己的 VideoCapture，最多同时运行 workers 个
+# jobs 为 (key, 视频路径, 目标帧, 输出目录) 的列表，返回 {key: 统计}，同一个 key 的统计会累加
+# 某个视频出错不影响其他视频，出错的视频记录在统计的 failed 中
+def run_extraction(jobs, workers=None, seek_threshold=SEEK_THRESHOLD, writer_options=None, shard_size=None):
+    results = {}
+
+    def finish(key, video_path, job_stats=None, error=None):
+        stats = results.setdefault(key, empty_extraction_stats())
+        if error:
+            print(f"截取 {video_path} 的帧时出错:\n{error}")
+            stats['failed'].append(video_path)
+            return
+        for name, value in job_stats.items():
+            stats[name] += value
+
+    # 要读的帧最多的视频先处理
+    jobs = sorted(jobs, key=lambda job: job[2][-1][0] if job[2] else 0, reverse=True)
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    if workers == 1:
+        for key, video_path, targets, output_dir in jobs:
+            try:
+                finish(key, video_path, extract_frames(video_path, targets, output_dir, seek_threshold, writer_options,
+                                                          shard_size))
+            except Exception:
+                finish(key, video_path, error=traceback.format_exc())
+        return results
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker) as executor:
+        futures = {executor.submit(extract_frames, video_path, targets, output_dir, seek_threshold, writer_options,
+                                   shard_size): (key, video_path) for key, video_path, targets, output_dir in jobs}
+        for future in as_completed(futures):
+            key, video_path = futures[future]
+            try:
+                finish(key, video_path, future.result())
+            except Exception:
+                finish(key, video_path, error=traceback.format_exc())
+    return results
+
+def _report(folder, stats):
+    print(f"{folder}: 解码 {stats['decode_seconds']:.2f}s，编码和写入 {stats['encode_seconds']:.2f}s"
+          f"(等待队列 {stats['wait_seconds']:.2f}s)，新截取 {stats['frames']} 帧，复用 {stats['reused']} 帧")
+
+# 处理视频并保存截取的帧的函数
+# 先确定所有动作要截取的帧，再对每个视频按帧号顺序读一遍，多屏时每个屏幕的视频在单独的进程中处理
+# writer_options 设置图片格式，例如 {'image_format': 'png'}、{'image_format': 'jpg', 'quality': 90}
+# crop_size、thumbnail_width、window、previous 和 settle_frames 见 plan_extraction，
+# 例如 crop_size=(CROP_WIDTH, CROP_HEIGHT) 只保存裁剪图，window=(3, 0) 另外保存每个动作之前的3帧，
+# settle_frames=3 时每个动作的帧换成之后画面连续3帧不变的第一帧
+# shard_size 不为 None 时不写单独的图片文件，而是写成打包的数据集(见 shards.py)，每个分片不超过 shard_size 字节
+# 返回统计，包括解码耗时和编码耗时
+def process_videos(video_dir, sequence_file, output_dir, seek_threshold=SEEK_THRESHOLD, workers=None,
+                   writer_options=None, crop_size=None, thumbnail_width=None, shard_size=None, window=(0, 0),
+                   previous=False, settle_frames=None):
+    jobs = plan_session(video_dir, sequence_file, output_dir, crop_size, thumbnail_width, window, previous,
+                        settle_frames)
+    if jobs is None:
+        return
+    jobs = [(video_dir, video_path, targets, job_output_dir) for video_path, targets, job_output_dir in jobs]
+    stats = run_extraction(jobs, workers, seek_threshold, writer_options, shard_size).get(
+        video_dir, empty_extraction_stats())
+    if shard_size:
+        build_dataset(output_dir, load_sequence(sequence_file))
+    _report(video_dir, stats)
+    return stats
+
+# 处理 base_folder 下的所有会话文件夹，所有会话的所有视频放进同一个进程池，最多同时运行 workers 个
+# 每个会话文件夹中的 sequence_name 对应的帧保存到该文件夹下的 output_name 中，返回 {会话文件夹: 统计}
+def process_sessions(base_folder, workers=None, sequence_name='sequence.txt', output_name='save_image',
+                     seek_threshold=SEEK_THRESHOLD, writer_options=None, crop_size=None, thumbnail_width=None,
+                     shard_size=None, window=(0, 0), previous=False, settle_frames=None):
+    jobs = []
+    sequences = {}
+    for session_dir in sorted(list_subfolders(base_folder)):
+        sequence_file = os.path.join(session_dir, sequence_name)
+        if not os.path.exists(sequence_file):
+            print(f"{session_dir} 中没有 {sequence_name}，跳过")
+            continue
+        session_jobs = plan_session(session_dir, sequence_file, os.path.join(session_dir, output_name), crop_size,
+                                    thumbnail_width, window, previous, settle_frames)
+        if session_jobs:
+            sequences[session_dir] = sequence_file
+            jobs += [(session_dir, video_path, targets, output_dir) for video_path, targets, output_dir in session_jobs]
+    results = run_extraction(jobs, workers, seek_threshold, writer_options, shard_size)
+    for session_dir, stats in sorted(results.items()):
+        if shard_size:
+            build_dataset(os.path.join(session_dir, output_name), load_sequence(sequences[session_dir]))
+        _report(session_dir, stats)
+    return results
 
 # 主程序
 if __name__ == '__main__':
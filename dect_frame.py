@@ -0,0 +1,159 @@
+import cv2
+import numpy as np
+
+# 定义目标颜色 (BGR格式)
+TARGET_COLOR = (231, 216, 173)  # 注意顺序是 BGR
+TOLERANCE = 30  # 允许的颜色误差范围
+SEARCH_SECONDS = 100  # 只检测前100秒
+# 稀疏搜索的步长(帧)，设为1即逐帧检测；色块比步长短、没有被采样到时会退回逐帧检测
+SEARCH_STRIDE = 8
+
+
+# 检测区域 (屏幕中心往上100像素为中心的20x20区域)
+def get_check_region(frame_width, frame_height):
+    center_x = frame_width // 2
+    center_y = frame_height // 2 - 100
+    return (slice(center_y - 10, center_y + 10), slice(center_x - 10, center_x + 10))
+
+
+# 判断当前帧检测区域的平均颜色是否在目标颜色范围内
+def block_in_frame(frame, check_region, target_color=TARGET_COLOR, tolerance=TOLERANCE):
+    region = frame[check_region]
+    average_color = region.mean(axis=(0, 1)).astype(int)
+    return bool(np.all(np.abs(average_color - np.array(target_color)) <= tolerance))
+
+
+def find_key_frame(video_path, stride=SEARCH_STRIDE, target_color=TARGET_COLOR, tolerance=TOLERANCE, stats=None):
+    cap = cv2.VideoCapture(video_path)
+    try:
+        return detect_key_frame(cap, stride=stride, target_color=target_color, tolerance=tolerance, stats=stats)
+    finally:
+        cap.release()
+
+
+# 在已经打开的视频上查找色块消失的帧，返回色块最后一次出现的帧号
+# stride > 1 时每隔 stride 帧才解码一次(其余帧只 grab 不 retrieve)，
+# 找到出现/消失的大致位置后再回退逐帧确认；采样帧上都没有色块时(色块比步长短)从头逐帧检测一遍，
+# 所以结果与逐帧检测相同，只是没有色块的视频要多解码一遍
+# stats 为字典时会记录 retrieved / grabbed / seeks 的次数
+def detect_key_frame(cap, stride=SEARCH_STRIDE, target_color=TARGET_COLOR, tolerance=TOLERANCE, stats=None):
+    if stats is None:
+        stats = {}
+    stats.update(retrieved=0, grabbed=0, seeks=0)
+
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    total_frames = int(fps * SEARCH_SECONDS)
+    frame_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    frame_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    check_region = get_check_region(frame_width, frame_height)
+
+    def check(frame):
+        return block_in_frame(frame, check_region, target_color, tolerance)
+
+    if stride <= 1:
+        appearance_frame, disappearance_frame, block_present = _scan_exact(cap, check, 0, total_frames, stats)
+    else:
+        appearance_frame, disappearance_frame, block_present = _scan_sparse(cap, check, total_frames, stride, stats)
+
+    if appearance_frame is not None:
+        print(f"色块首次出现于第 {appearance_frame} 帧")
+    if disappearance_frame is not None:
+        print(f"色块消失在第 {disappearance_frame} 帧")
+    elif block_present:
+        print("色块未在检测范围内消失")
+    else:
+        print("色块未出现在检测范围内")
+
+    return disappearance_frame
+
+
+# 从第 start+1 帧开始逐帧检测，与原来的逐帧循环一致
+# 返回 (出现帧, 消失帧, 结束时色块是否仍存在)，帧号从1开始计数
+def _scan_exact(cap, check, start, end, stats, block_present=False, appearance_frame=None):
+    frame_count = start
+    while frame_count < end:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        stats['retrieved'] += 1
+        frame_count += 1
+
+        present = check(frame)
+        if not block_present and present:
+            block_present = True
+            appearance_frame = frame_count
+        elif block_present and not present:
+            return appearance_frame, frame_count - 1, False
+
+    return appearance_frame, None, block_present
+
+
+# 定位到第 frame_count 帧之后(下一次读取得到第 frame_count+1 帧)
+def _seek(cap, frame_count, stats):
+    stats['seeks'] += 1
+    return cap.set(cv2.CAP_PROP_POS_FRAMES, frame_count)
+
+
+def _scan_sparse(cap, check, total_frames, stride, stats):
+    frame_count = 0
+    last_absent = 0  # 最近一次采样到色块不存在的帧
+    last_present = None  # 最近一次采样到色块存在的帧
+    appearance_frame = None
+
+    while frame_count < total_frames:
+        if not cap.grab():
+            break
+        stats['grabbed'] += 1
+        frame_count += 1
+        # 只在采样帧上解码
+        if (frame_count - 1) % stride and frame_count != total_frames:
+            continue
+        ret, frame = cap.retrieve()
+        if not ret:
+            break
+        stats['retrieved'] += 1
+
+        present = check(frame)
+        if appearance_frame is None:
+            if not present:
+                last_absent = frame_count
+                continue
+            # 色块在 (last_absent, frame_count] 之间首次出现，回退逐帧确认
+            appearance_frame = frame_count
+            if frame_count - last_absent > 1 and _seek(cap, last_absent, stats):
+                refined, disappearance_frame, _ = _scan_exact(cap, check, last_absent, frame_count, stats)
+                if disappearance_frame is not None:
+                    return refined, disappearance_frame, False
+                if refined is not None:
+                    appearance_frame = refined
+            last_present = frame_count
+            continue
+
+        if present:
+            last_present = frame_count
+            continue
+
+        # 色块在 (last_present, frame_count] 之间消失，回退逐帧确认
+        return appearance_frame, _refine_disappearance(cap, check, last_present, frame_count, stats), False
+
+    if appearance_frame is None:
+        # 色块可能在两个采样帧之间出现又消失，从头逐帧检测已经读过的范围
+        if frame_count and _seek(cap, 0, stats):
+            return _scan_exact(cap, check, 0, frame_count, stats)
+        return None, None, False
+
+    # 检测范围结束时色块仍存在，检查最后一次采样之后的帧
+    if frame_count > last_present and _seek(cap, last_present, stats):
+        _, disappearance_frame, block_present = _scan_exact(
+            cap, check, last_present, frame_count, stats, block_present=True, appearance_frame=appearance_frame)
+        return appearance_frame, disappearance_frame, block_present
+    return appearance_frame, None, True
+
+
+def _refine_disappearance(cap, check, last_present, first_absent, stats):
+    if first_absent - last_present > 1 and _seek(cap, last_present, stats):
+        _, disappearance_frame, _ = _scan_exact(
+            cap, check, last_present, first_absent, stats, block_present=True, appearance_frame=last_present)
+        if disappearance_frame is not None:
+            return disappearance_frame
+    return first_absent - 1
@@ -0,0 +1,188 @@
+import re
+from array import array
+
+import numpy as np
+
+# 没有坐标时 x, y 的取值
+NO_COORD = np.iinfo(np.int32).min
+# 坐标以 "(x, y)" 的形式保存在 x, y 列中，还原动作时需要插回去
+FLAG_COORD_ELIDED = 1
+
+COORD_PATTERN = re.compile(r"\((-?\d+),\s*(-?\d+)\)")
+KIND_END_PATTERN = re.compile(r"[(']")
+
+
+# 把动作拆成类型和其余文本，类型到第一个 "(" 或 "'" 为止
+def split_kind(action):
+    end = KIND_END_PATTERN.search(action)
+    split = end.start() if end else len(action)
+    return action[:split], action[split:]
+
+
+# 按列存储的动作表，每个动作只占几十个字节:
+#   ts      时间(毫秒, int64)
+#   code    动作类型编号(int32)，对应 kinds 中的字符串，例如 "<LClick "、"<Ctrl>"、"a"
+#   x, y    坐标(int32)，没有坐标时为 NO_COORD
+#   screen  屏幕编号(int8)
+#   flags   FLAG_COORD_ELIDED 表示坐标已经从文本中去掉
+#   text_offset, text_length  动作中类型之后的文本在共享文本缓冲区中的位置，例如 "'abc'>"
+# 动作类型到第一个 "(" 或 "'" 为止，同类动作共用一个编号
+# ts 等属性返回 NumPy 视图(可以原地修改)，拿到视图后不要再 append
+class EventTable:
+    def __init__(self):
+        self.kinds = []
+        self._kind_codes = {}
+        self._ts = array('q')
+        self._code = array('i')
+        self._x = array('i')
+        self._y = array('i')
+        self._screen = array('b')
+        self._flags = array('B')
+        self._text_offset = array('q')
+        self._text_length = array('i')
+        self._text_parts = []
+        self._text_size = 0
+        self._text = ''
+        self._text_dirty = False
+
+    def __len__(self):
+        return len(self._ts)
+
+    def kind_code(self, kind):
+        code = self._kind_codes.get(kind)
+        if code is None:
+            code = len(self.kinds)
+            self._kind_codes[kind] = code
+            self.kinds.append(kind)
+        return code
+
+    # 添加一个日志中的动作，坐标从动作文本中提取
+    def append(self, ts, action, screen=0):
+        x = y = NO_COORD
+        flags = 0
+        match = COORD_PATTERN.search(action)
+        if match:
+            x, y = int(match.group(1)), int(match.group(2))
+        kind, text = split_kind(action)
+        # 标准格式 "(x, y)" 的坐标直接去掉，还原时再插回去
+        if match and match.start() == len(kind) and match.group(0) == f"({x}, {y})":
+            text = action[match.end():]
+            flags = FLAG_COORD_ELIDED
+        self.append_fields(ts, kind, text, x, y, screen, flags)
+
+    # 直接按列添加，kind + text 即为完整的动作文本
+    def append_fields(self, ts, kind, text='', x=NO_COORD, y=NO_COORD, screen=0, flags=0):
+        self._ts.append(ts)
+        self._code.append(self.kind_code(kind))
+        self._x.append(x)
+        self._y.append(y)
+        self._screen.append(screen)
+        self._flags.append(flags)
+        self._text_offset.append(self._text_size)
+        self._text_length.append(len(text))
+        if text:
+            self._text_parts.append(text)
+            self._text_size += len(text)
+            self._text_dirty = True
+
+    @property
+    def text_buffer(self):
+        if self._text_dirty:
+            self._text = ''.join(self._text_parts)
+            self._text_parts = [self._text]
+            self._text_dirty = False
+        return self._text
+
+    @property
+    def ts(self):
+        return np.frombuffer(self._ts, dtype=np.int64)
+
+    @property
+    def code(self):
+        return np.frombuffer(self._code, dtype=np.int32)
+
+    @property
+    def x(self):
+        return np.frombuffer(self._x, dtype=np.int32)
+
+    @property
+    def y(self):
+        return np.frombuffer(self._y, dtype=np.int32)
+
+    @property
+    def screen(self):
+        return np.frombuffer(self._screen, dtype=np.int8)
+
+    @property
+    def flags(self):
+        return np.frombuffer(self._flags, dtype=np.uint8)
+
+    # 类型之后的文本长度
+    @property
+    def text_length(self):
+        return np.frombuffer(self._text_length, dtype=np.int32)
+
+    def kind(self, i):
+        return self.kinds[self._code[i]]
+
+    def text(self, i):
+        offset = self._text_offset[i]
+        return self.text_buffer[offset:offset + self._text_length[i]]
+
+    def coords(self, i):
+        if self._x[i] == NO_COORD:
+            return None
+        return self._x[i], self._y[i]
+
+    # 还原第 i 个动作的完整文本
+    def action(self, i):
+        kind = self.kinds[self._code[i]]
+        offset = self._text_offset[i]
+        text = self.text_buffer[offset:offset + self._text_length[i]]
+        if self._flags[i] & FLAG_COORD_ELIDED:
+            return f"{kind}({self._x[i]}, {self._y[i]}){text}"
+        return kind + text
+
+    def actions(self):
+        kinds = self.kinds
+        buffer = self.text_buffer
+        result = []
+        for code, x, y, flags, offset, length in zip(self._code, self._x, self._y, self._flags,
+                                                      self._text_offset, self._text_length):
+            if flags & FLAG_COORD_ELIDED:
+                result.append(f"{kinds[code]}({x}, {y}){buffer[offset:offset + length]}")
+            else:
+                result.append(kinds[code] + buffer[offset:offset + length])
+        return result
+
+    # 类型满足条件的编号，配合 np.isin(table.code, ...) 做向量化筛选
+    def codes_where(self, predicate):
+        return np.array([code for code, kind in enumerate(self.kinds) if predicate(kind)], dtype=np.int32)
+
+    # 按下标数组或布尔数组取出部分动作，返回新的表(共用类型和文本缓冲区)
+    def take(self, index):
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        else:
+            index = index.astype(np.intp, copy=False)
+        table = EventTable()
+        table.kinds = self.kinds
+        table._kind_codes = self._kind_codes
+        table._text = self.text_buffer
+        table._text_parts = [table._text] if table._text else []
+        table._text_size = self._text_size
+        for name, dtype in (('_ts', np.int64), ('_code', np.int32), ('_x', np.int32), ('_y', np.int32),
+                            ('_screen', np.int8), ('_flags', np.uint8), ('_text_offset', np.int64),
+                            ('_text_length', np.int32)):
+            column = getattr(self, name)
+            values = np.frombuffer(column, dtype=dtype)[index]
+            new_column = array(column.typecode)
+            new_column.frombytes(values.tobytes())
+            setattr(table, name, new_column)
+        return table
+
+    # 占用的内存(字节)，不含类型字符串
+    def nbytes(self):
+        columns = (self._ts, self._code, self._x, self._y, self._screen, self._flags, self._text_offset, self._text_length)
+        return sum(column.itemsize * len(column) for column in columns) + self._text_size
@@ -0,0 +1,344 @@
+import locale
+import os
+import sys
+import time
+
+import cv2
+
+from align import entry_span
+from compaction import compact_events
+from dect_frame import SEARCH_SECONDS, TARGET_COLOR, TOLERANCE, block_in_frame, get_check_region
+from events import EventTable
+from frame_writer import FrameStore, FrameWriter
+from manifest import find_session_files
+from sequence_bin import SequenceBinWriter, sequence_bin_path
+from time_utils import DAY_MS, format_time_ms, ms_to_seconds, parse_time_ms, subtract_offset_ms
+
+# 跟随模式: 录制还在进行时就开始处理单屏会话，不用等录制结束
+# 一边读取不断增长的日志和 MKV 视频，一边检测同步色块、写出 sequence.txt 和 subtitles.srt、截取关键帧
+# 结果与录制结束后运行 align.py 和 cut_keyframe.py 相同；录制中只能读取 MKV(MP4 在录制结束前无法打开，会提示)
+# 内存中只保留还没有确定的动作和还没有截取的帧号；已经写出的行同时追加到 sequence.bin 的临时文件中，
+# 不留在内存里。随会话变长的只有 FrameStore 中已保存帧的 key(每帧一个短字符串)
+POLL_SECONDS = 1.0
+# 日志和视频都这么久没有变化时认为录制已经结束
+IDLE_SECONDS = 30.0
+
+
+# 读取不断增长的日志，每次返回新增的完整的行(不含空行)，写了一半的行等下次再读
+class LogTail:
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+        # 与 open(path, 'r') 的默认编码相同
+        self.encoding = locale.getpreferredencoding(False)
+
+    def read_lines(self):
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            data = f.read()
+        end = data.rfind(b'\n')
+        if end < 0:
+            return []
+        self.offset += end + 1
+        text = data[:end + 1].decode(self.encoding, errors='replace').replace('\r\n', '\n')
+        return [line + '\n' for line in text.split('\n')[:-1] if line.strip()]
+
+
+# 读取不断增长的视频，记住已经读到的帧号，文件变大后重新打开并跳转到该帧继续读
+class VideoTail:
+    def __init__(self, path):
+        self.path = path
+        # 下一次读到的帧号
+        self.position = 0
+        self.fps = None
+        self.width = None
+        self.height = None
+        # 上次读到文件末尾时的文件大小，文件没有变大时不需要重新打开
+        self._exhausted_size = None
+        # 是否已经提示过无法打开(录制刚开始时文件头可能还没写完，只提示一次)
+        self.open_failed = False
+
+    # 从 position 开始读到文件当前的末尾或 until 帧之前，wanted(帧号) 为 True 的帧才 retrieve，
+    # 依次返回 (帧号, 帧)
+    def frames(self, wanted, until=None):
+        size = os.path.getsize(self.path)
+        if size == self._exhausted_size or (until is not None and self.position >= until):
+            return
+        cap = cv2.VideoCapture(self.path)
+        try:
+            if not cap.isOpened():
+                if not self.open_failed:
+                    print(f"Failed to open video: {self.path} ({size} bytes)，等待更多数据")
+                    self.open_failed = True
+                return
+            if self.fps is None:
+                self.fps = cap.get(cv2.CAP_PROP_FPS)
+                self.width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+                self.height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            if self.position:
+                cap.set(cv2.CAP_PROP_POS_FRAMES, self.position)
+            while until is None or self.position < until:
+                if not cap.grab():
+                    self._exhausted_size = size
+                    break
+                fn = self.position
+                self.position += 1
+                if wanted(fn):
+                    ret, frame = cap.retrieve()
+                    if ret:
+                        yield fn, frame
+        finally:
+            cap.release()
+
+
+# 逐帧检测同步色块，与 dect_frame.find_key_frame(stride=1) 的结果相同
+class SyncDetector:
+    def __init__(self, fps, width, height, target_color=TARGET_COLOR, tolerance=TOLERANCE):
+        self.limit = int(fps * SEARCH_SECONDS)
+        self.check_region = get_check_region(width, height)
+        self.target_color = target_color
+        self.tolerance = tolerance
+        self.present = False
+        self.key_frame = None
+
+    # 传入第 fn 帧(从0开始)，返回是否已经确定结果
+    def update(self, fn, frame):
+        if block_in_frame(frame, self.check_region, self.target_color, self.tolerance):
+            if not self.present:
+                print(f"色块首次出现于第 {fn + 1} 帧")
+            self.present = True
+        elif self.present:
+            # 色块最后一次出现的帧(从1开始计数)
+            self.key_frame = fn
+            print(f"色块消失在第 {self.key_frame} 帧")
+            return True
+        return fn + 1 >= self.limit
+
+    @property
+    def failed(self):
+        return self.key_frame is None
+
+
+# 一个正在录制的会话，反复调用 poll() 处理新增的日志和视频，录制结束后调用 finish()
+class FollowSession:
+    def __init__(self, folder_path, log_path=None, video_path=None, output_name='save_image', writer_options=None):
+        if log_path is None or video_path is None:
+            video_files, txt_files = find_session_files(folder_path)
+            log_path = log_path or (txt_files[0] if txt_files else None)
+            video_path = video_path or (video_files[0] if video_files else None)
+        if not log_path or not video_path:
+            raise FileNotFoundError(f"No video or txt files found in {folder_path}")
+        if os.path.splitext(video_path)[1].lower() != '.mkv':
+            print(f"警告: {video_path} 不是 MKV，录制中的 MP4 等格式无法读取，要等录制结束后才能处理")
+        self.log = LogTail(log_path)
+        self.sync_video = VideoTail(video_path)
+        self.video = VideoTail(video_path)
+        self.detector = None
+        self.first_time = None
+        self.ctrl_time = None
+        self.offset = None
+        # 找到偏移之前的日志 (相对时间, 行)，色块在视频开头，这里最多只有开头一段的日志
+        self.early_entries = []
+        # 还没有确定合并结果的动作 (时间, 动作)，以及它们之前一个动作的时间
+        self.pending = []
+        self.previous_time = None
+
+        self.subtitles_path = os.path.join(folder_path, "subtitles.srt")
+        self.sequence_path = os.path.join(folder_path, "sequence.txt")
+        for path in (self.subtitles_path, self.sequence_path):
+            open(path, 'w').close()
+        # 与 sequence.txt 每一行对应的 (时间, 动作, 屏幕)，逐行追加到临时文件，结束时拼成 sequence.bin
+        self.records = SequenceBinWriter(sequence_bin_path(self.sequence_path))
+        self.subtitle_index = 1
+
+        self.output_dir = os.path.join(folder_path, output_name)
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.writer = FrameWriter(**(writer_options or {}))
+        self.store = FrameStore(self.output_dir, video_path, self.writer)
+        # 等待截取的帧号 -> 文件名
+        self.targets = {}
+        self.finished = False
+
+    # 处理新增的日志和视频，返回这次写出的 sequence 行数
+    def poll(self):
+        for line in self.log.read_lines():
+            self._read_line(line)
+        if self.offset is None:
+            self._detect_sync()
+        if self.offset is None:
+            return 0
+        emitted = self._compact(final=False)
+        self._extract(self._frontier())
+        return emitted
+
+    # 录制结束: 处理剩下的动作和帧，写出 sequence.bin，返回写出的文件列表
+    def finish(self):
+        self.poll()
+        if self.offset is None:
+            self.writer.close()
+            self.records.discard()
+            if self.ctrl_time is None:
+                print("No <Ctrl> action found in the log file.")
+                return None
+            if self.sync_video.fps is None:
+                raise RuntimeError(f"Failed to open video: {self.video.path}")
+            raise RuntimeError(f"No sync marker found in {self.video.path}")
+        self._compact(final=True)
+        self._extract(None)
+        for fn, names in sorted(self.targets.items()):
+            print(f"帧号 {fn} 超出范围，跳过")
+        self.targets = {}
+        self.writer.close()
+        self.store.save()
+        sequence_bin_file = self.records.close()
+        self.finished = True
+        print(f"Subtitles file saved as {self.subtitles_path}")
+        print(f"Sequence file saved as {self.sequence_path} and {sequence_bin_file}")
+        return [self.subtitles_path, self.sequence_path, sequence_bin_file]
+
+    def _read_line(self, line):
+        timestamp = parse_time_ms(line.split()[1])
+        first_line = self.first_time is None
+        if first_line:
+            self.first_time = timestamp
+        relative_time = (timestamp - self.first_time) % DAY_MS
+        if self.ctrl_time is None and "<Ctrl>" in line:
+            self.ctrl_time = relative_time
+        if first_line:
+            # 第一行只作为相对时间的起点，与 align.adjust_timestamps 一致
+            return
+        if self.offset is None:
+            self.early_entries.append((relative_time, line))
+        else:
+            self._add_action(relative_time, line)
+
+    def _add_action(self, relative_time, line):
+        if relative_time <= self.offset:
+            return
+        parts = line.strip().split(" ")
+        if len(parts) >= 3:
+            self.pending.append((subtract_offset_ms(relative_time, self.offset), " ".join(parts[2:])))
+
+    # 读取视频开头检测同步色块，找到色块和 <Ctrl> 后计算偏移
+    # 与 align.process_folder 一样先看有没有 <Ctrl>，日志中还没有 <Ctrl> 时找不到色块也先不报错
+    def _detect_sync(self):
+        if self.detector is None or (self.detector.key_frame is None
+                                     and self.sync_video.position < self.detector.limit):
+            for fn, frame in self.sync_video.frames(lambda fn: True):
+                if self.detector is None:
+                    self.detector = SyncDetector(self.sync_video.fps, self.sync_video.width, self.sync_video.height)
+                if self.detector.update(fn, frame):
+                    break
+            if self.detector is None or (self.detector.key_frame is None
+                                         and self.sync_video.position < self.detector.limit):
+                return
+        if self.ctrl_time is None:
+            return
+        if self.detector.failed:
+            raise RuntimeError(f"No sync marker found in {self.video.path}")
+        key_frame_time = self.detector.key_frame / self.sync_video.fps * 1000
+        self.offset = self.ctrl_time - key_frame_time
+        print(f"Calculated OFFSET: {self.offset} ms")
+        for relative_time, line in self.early_entries:
+            self._add_action(relative_time, line)
+        self.early_entries = []
+
+    # 合并动作，写出已经确定的 sequence 行
+    # 规则只会往后看到第一个不能合并的动作，所以结尾不是最后一个动作的合并结果不会再变；
+    # final 为 True 时(录制结束)与 align.generate_subtitles_and_sequence 相同，处理所有动作
+    def _compact(self, final):
+        if not self.pending:
+            return 0
+        actions = EventTable()
+        for timestamp, action in self.pending:
+            actions.append(timestamp, action)
+        times = actions.ts.tolist()
+        last = len(actions) - 1
+        emitted = 0
+        # 下一次从这个动作开始重新合并
+        cut = last
+        for start, end, action in compact_events(actions):
+            if end == last and not final:
+                cut = start
+                break
+            previous_time = times[start - 1] if start > 0 else self.previous_time
+            next_time = times[end + 1] if end < last else None
+            before_time, after_time = entry_span(times[start], times[end], previous_time, next_time)
+            self._emit(before_time, after_time, action)
+            emitted += 1
+        if final:
+            self.pending = []
+            return emitted
+        if cut > 0:
+            self.previous_time = times[cut - 1]
+            self.pending = self.pending[cut:]
+        return emitted
+
+    def _emit(self, before_time, after_time, action):
+        with open(self.subtitles_path, 'a') as f:
+            f.write(f"{self.subtitle_index}\n{format_time_ms(before_time, sep=',')} --> "
+                    f"{format_time_ms(after_time, sep=',')}\n{action}\n")
+        self.subtitle_index += 1
+        with open(self.sequence_path, 'a') as f:
+            if not self.records:
+                f.write(f"{format_time_ms(before_time)}\n")
+                self._add_target(before_time)
+                self.records.append(before_time, '', 0)
+            f.write(f"{action}, {format_time_ms(after_time)}\n")
+        self._add_target(after_time)
+        self.records.append(after_time, action, 0)
+
+    # 与 cut_keyframe 相同，sequence 的第 idx 行对应 frame_{idx:04d}
+    def _add_target(self, timestamp_ms):
+        fn = int(ms_to_seconds(timestamp_ms) * self.sync_video.fps)
+        name = f"frame_{len(self.records):04d}"
+        if fn < self.video.position:
+            print(f"帧号 {fn} 已经读过，跳过 {name}")
+            return
+        self.targets.setdefault(fn, []).append(name)
+
+    # 以后的 sequence 行的时间都不早于第一个未确定的动作，这之前的帧可以放心地读过去
+    # 还没有写出任何一行时，第一行还要截取动作开始前的帧(entry_span 中最多提前 150ms)
+    def _frontier(self):
+        if not self.pending:
+            return self.video.position
+        first_time = self.pending[0][0]
+        if not self.records:
+            first_time = min(first_time, (first_time - 150) % DAY_MS)
+        return int(ms_to_seconds(first_time) * self.sync_video.fps)
+
+    def _extract(self, until):
+        for fn, frame in self.video.frames(lambda fn: fn in self.targets, until):
+            names = self.targets.pop(fn)
+            key = f"{fn:07d}"
+            paths = [os.path.join(self.output_dir, name) for name in names]
+            if key in self.store:
+                self.store.link(key, paths)
+                continue
+            for output_filename in self.store.submit(frame, key, paths):
+                print(f"已保存帧到 {output_filename}")
+
+
+# 跟随一个正在录制的会话，直到日志和视频都 idle_seconds 没有变化(或 Ctrl+C)，返回写出的文件列表
+def follow_session(folder_path, poll_seconds=POLL_SECONDS, idle_seconds=IDLE_SECONDS, **kwargs):
+    session = FollowSession(folder_path, **kwargs)
+    last_change = time.monotonic()
+    last_sizes = None
+    try:
+        while True:
+            session.poll()
+            sizes = (os.path.getsize(session.log.path), os.path.getsize(session.video.path))
+            if sizes != last_sizes:
+                last_sizes = sizes
+                last_change = time.monotonic()
+            elif time.monotonic() - last_change >= idle_seconds:
+                break
+            time.sleep(poll_seconds)
+    except KeyboardInterrupt:
+        print("停止跟随，处理剩下的动作")
+    return session.finish()
+
+
+if __name__ == "__main__":
+    # 用法: python follow.py 会话文件夹
+    follow_session(sys.argv[1])
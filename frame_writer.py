@@ -0,0 +1,163 @@
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from video_probe import file_signature
+
+# 图片格式: 扩展名和编码参数，quality 为 None 时使用默认值
+# jpg 的 quality 为 0-100(默认 95，与 cv2.imwrite 相同)，png 为压缩级别 0-9，webp 固定为无损
+IMAGE_FORMATS = {
+    'jpg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 95),
+    'png': ('.png', cv2.IMWRITE_PNG_COMPRESSION, 3),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 101),
+}
+ENCODE_THREADS = 2
+# 最多有这么多帧在等待编码，超过时解码线程等待，内存占用有上限
+MAX_PENDING = 8
+# 输出目录下保存每个不同的帧的目录，frame_XXXX 都是指向其中文件的硬链接
+FRAME_STORE_NAME = '.frame_store'
+
+
+# 把 dst 替换为 src 的硬链接，文件系统不支持硬链接时复制
+def link_frame(src, dst):
+    # 已经是同一个文件时 os.replace 什么都不做，会留下临时文件
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return
+    tmp_path = dst + '.tmp'
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+# 在后台线程中编码并写入图片，解码可以同时进行，编码时 OpenCV 会释放 GIL
+# 同一帧只编码一次，写入第一个路径，其余路径为它的硬链接
+# 先写临时文件再替换，不会改动之前已经链接到同一个文件的其他图片
+# stats 中的 encode_seconds 为编码和写入的总耗时，wait_seconds 为解码线程等待队列空位的时间
+class FrameWriter:
+    def __init__(self, image_format='jpg', quality=None, threads=ENCODE_THREADS, max_pending=MAX_PENDING):
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"unsupported image format: {image_format}")
+        self.extension, param, default_quality = IMAGE_FORMATS[image_format]
+        if image_format == 'webp':
+            quality = None
+        self.params = [param, default_quality if quality is None else quality]
+        self.stats = {'frames': 0, 'files': 0, 'bytes': 0, 'encode_seconds': 0.0, 'wait_seconds': 0.0}
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._executor = ThreadPoolExecutor(max_workers=threads)
+        self._futures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # 编码参数，用于判断之前保存的帧是否还能用
+    @property
+    def key(self):
+        return [self.extension] + self.params
+
+    # paths 为不带扩展名的输出路径
+    def submit(self, frame, paths):
+        self._enqueue(self._write, frame, paths)
+        return [path + self.extension for path in paths]
+
+    # 在后台线程中运行 fn(*args)，队列满时等待
+    def _enqueue(self, fn, *args):
+        start = time.perf_counter()
+        self._slots.acquire()
+        self.stats['wait_seconds'] += time.perf_counter() - start
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def _encode(self, frame, name):
+        ok, encoded = cv2.imencode(self.extension, frame, self.params)
+        if not ok:
+            raise RuntimeError(f"failed to encode {name}{self.extension}")
+        return encoded.tobytes()
+
+    def _record(self, files, size, start):
+        with self._lock:
+            self.stats['frames'] += 1
+            self.stats['files'] += files
+            self.stats['bytes'] += size
+            self.stats['encode_seconds'] += time.perf_counter() - start
+
+    def _write(self, frame, paths):
+        start = time.perf_counter()
+        data = self._encode(frame, paths[0])
+        first = paths[0] + self.extension
+        with open(first + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(first + '.tmp', first)
+        for path in paths[1:]:
+            link_frame(first, path + self.extension)
+        self._record(len(paths), len(data), start)
+
+    # 等待所有图片写完，编码或写入出错时抛出第一个异常
+    def close(self):
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        return self.stats
+
+
+# 一个视频在输出目录中已经保存过的图片，每张图片用一个字符串 key 表示(例如帧号)
+# 记录在 .frame_store/<视频文件名>.json 中，视频的大小、修改时间和编码参数都没变时才能复用
+class FrameStore:
+    def __init__(self, output_dir, video_path, writer):
+        self.directory = os.path.join(output_dir, FRAME_STORE_NAME)
+        os.makedirs(self.directory, exist_ok=True)
+        self.video_name = os.path.basename(video_path)
+        self.writer = writer
+        self.extension = writer.extension
+        self.cache_path = os.path.join(self.directory, self.video_name + '.json')
+        self.entry = {'signature': file_signature(video_path), 'writer': writer.key, 'frames': []}
+        try:
+            with open(self.cache_path, 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            cached = None
+        self.frames = set()
+        if cached and cached.get('signature') == self.entry['signature'] and cached.get('writer') == self.entry['writer']:
+            self.frames = {key for key in cached.get('frames', []) if os.path.exists(self.path(key) + self.extension)}
+
+    # 图片保存的路径(不带扩展名)
+    def path(self, key):
+        return os.path.join(self.directory, f"{os.path.splitext(self.video_name)[0]}_{key}")
+
+    def __contains__(self, key):
+        return key in self.frames
+
+    def add(self, key):
+        self.frames.add(key)
+
+    # 把已经保存的图片 key 链接到 paths(不带扩展名)
+    def link(self, key, paths):
+        for path in paths:
+            link_frame(self.path(key) + self.extension, path + self.extension)
+
+    # 交给 writer 编码保存为图片 key，并链接到 paths，返回输出的文件名
+    def submit(self, frame, key, paths):
+        filenames = self.writer.submit(frame, [self.path(key)] + paths)[1:]
+        self.add(key)
+        return filenames
+
+    def save(self):
+        self.entry['frames'] = sorted(self.frames)
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entry, f)
+        os.replace(tmp_path, self.cache_path)
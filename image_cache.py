@@ -0,0 +1,152 @@
+import base64
+import hashlib
+import io
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from PIL import Image
+
+from crop import crop_box
+
+# 发给 GPT 的图片: 裁剪、缩小到 detail 实际使用的大小、编码为 JPEG 再转成 base64
+# detail 为 low 时 API 把图片缩到 512x512 以内；high 时先缩到 2048x2048 以内，再把短边缩到 768
+# 比这更大的图片只会增加上传的大小和编码的时间，API 看到的内容是一样的
+DETAIL_LOW_SIZE = 512
+DETAIL_HIGH_MAX_SIZE = 2048
+DETAIL_HIGH_SHORT_SIDE = 768
+# 缩小后的图片用的 JPEG 质量(PIL 默认为 75)
+JPEG_QUALITY = 85
+# 缩小时先用整数倍快速缩小到目标大小的这么多倍，再用 LANCZOS 缩到目标大小
+DETAIL_REDUCING_GAP = 3.0
+# 内存中最多保存这么多字节的 base64 图片，每帧在相邻的两对图片中各用一次，只编码一次
+IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+# detail 实际使用的图片大小，保持宽高比，只缩小不放大；auto 等其他值时不缩小
+def detail_size(img_width, img_height, detail):
+    if detail == 'low':
+        scale = min(1.0, DETAIL_LOW_SIZE / max(img_width, img_height))
+    elif detail == 'high':
+        scale = min(1.0, DETAIL_HIGH_MAX_SIZE / max(img_width, img_height), DETAIL_HIGH_SHORT_SIDE / min(img_width, img_height))
+    else:
+        return img_width, img_height
+    return max(1, round(img_width * scale)), max(1, round(img_height * scale))
+
+
+# quality 为 None 时使用 PIL 的默认质量
+def encode_jpeg(image, quality=None):
+    buffered = io.BytesIO()
+    if quality is None:
+        image.save(buffered, format="JPEG")
+    else:
+        image.save(buffered, format="JPEG", quality=quality)
+    return base64.b64encode(buffered.getvalue()).decode('utf-8')
+
+
+# 读取 JPEG 文件时让解码器直接解码出缩小 2/4/8 倍的图片(不小于需要的大小)，返回缩小后图片中的裁剪框
+def _draft(source, box, scale):
+    width, height = source.size
+    source.draft('RGB', (math.ceil(width * scale), math.ceil(height * scale)))
+    if box is None or source.size == (width, height):
+        return box
+    ratio_x, ratio_y = source.size[0] / width, source.size[1] / height
+    return (round(box[0] * ratio_x), round(box[1] * ratio_y), round(box[2] * ratio_x), round(box[3] * ratio_y))
+
+
+# 图片来源的 key: 文件路径用路径、大小和修改时间(不需要读图片)，PIL 图片用像素内容的摘要
+def _source_key(image):
+    if isinstance(image, str):
+        st = os.stat(image)
+        return os.path.abspath(image), st.st_size, st.st_mtime_ns
+    return image.mode, image.size, hashlib.blake2b(image.tobytes(), digest_size=16).hexdigest()
+
+
+# 按 (图片, 裁剪框, 输出大小, 质量) 缓存编码好的 base64 图片，总大小超过 max_bytes 时删除最久没用过的
+# 可以在多个线程中共用，stats: hits 命中、misses 未命中、evictions 淘汰、encode_seconds 读取裁剪缩小编码的总耗时、
+# bytes 编码出的 base64 总字节数(未命中时才计算)
+class ImageCache:
+    def __init__(self, max_bytes=IMAGE_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'encode_seconds': 0.0, 'bytes': 0}
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def get(self, key):
+        with self._lock:
+            data = self._entries.get(key)
+            if data is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats['hits'] += 1
+            return data
+
+    def put(self, key, data, seconds=0.0):
+        with self._lock:
+            self.stats['encode_seconds'] += seconds
+            self.stats['bytes'] += len(data)
+            if key in self._entries:
+                return
+            self._entries[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False)
+                self._bytes -= len(old)
+                self.stats['evictions'] += 1
+
+
+# 一张图片的 base64 JPEG，image 为 PIL 图片或文件路径
+# mouse 为 (x, y) 时以鼠标为中心裁剪(crop.crop_box)；resize 为 False 时不缩小，并使用 PIL 的默认质量(以前的行为)
+# cache 为 ImageCache 时同一张图片、同样的裁剪框和大小只编码一次，文件路径命中时只读取图片的文件头
+def image_payload(image, mouse=None, detail='low', resize=True, cache=None):
+    start = time.perf_counter()
+    source = Image.open(image) if isinstance(image, str) else image
+    try:
+        box = crop_box(mouse[0], mouse[1], *source.size) if mouse is not None else None
+        key = None
+        if cache is not None:
+            key = (_source_key(image), box, detail if resize else None)
+            data = cache.get(key)
+            if data is not None:
+                return data
+        if resize:
+            width, height = (box[2] - box[0], box[3] - box[1]) if box is not None else source.size
+            size = detail_size(width, height, detail)
+            if source is not image and size != (width, height):
+                box = _draft(source, box, size[0] / width)
+        result = source.crop(box) if box is not None else source
+        if resize and size != result.size:
+            result = result.resize(size, Image.LANCZOS, reducing_gap=DETAIL_REDUCING_GAP)
+            if result.mode != 'RGB':
+                result = result.convert('RGB')
+        data = encode_jpeg(result, JPEG_QUALITY if resize else None)
+    finally:
+        if source is not image:
+            source.close()
+    if cache is not None:
+        cache.put(key, data, time.perf_counter() - start)
+    return data
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+# build_payload 默认使用的缓存，所有调用共用
+def default_image_cache():
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ImageCache()
+        return _default_cache
@@ -0,0 +1,102 @@
+import glob
+import hashlib
+import json
+import os
+import re
+
+# 记录每个文件夹输入指纹和输出文件的清单，放在 base_folder 下
+# 每处理完一个文件夹追加一行，中途中断后已完成的文件夹不会丢失
+MANIFEST_NAME = 'align_manifest.jsonl'
+
+# 对齐脚本自己生成的 txt 文件，不能当作日志
+GENERATED_TXT_SUFFIXES = ('_relative.txt', '_adjusted.txt')
+GENERATED_TXT_NAMES = ('sequence.txt', 'adjusted_log.txt')
+# align_2screen 为每个屏幕写出的 sequence_k.txt(以及 subtitles_k.txt，如果以后写成 txt)
+GENERATED_TXT_PATTERN = re.compile(r'(sequence|subtitles)_\d+\.txt$')
+
+
+# 返回文件夹中的视频文件和日志文件(按文件名排序，排除对齐生成的 txt)
+def find_session_files(folder_path):
+    video_files = sorted(glob.glob(os.path.join(folder_path, "*.mp4")) + glob.glob(os.path.join(folder_path, "*.mkv")))
+    txt_files = sorted(
+        f for f in glob.glob(os.path.join(folder_path, "*.txt"))
+        if not f.endswith(GENERATED_TXT_SUFFIXES) and os.path.basename(f) not in GENERATED_TXT_NAMES
+        and not GENERATED_TXT_PATTERN.match(os.path.basename(f))
+    )
+    return video_files, txt_files
+
+
+# 根据输入文件(日志、视频)的大小和修改时间以及处理参数计算指纹，只调用 stat，不读取文件内容
+def folder_fingerprint(folder_path, params):
+    video_files, txt_files = find_session_files(folder_path)
+    inputs = []
+    for path in video_files + txt_files:
+        st = os.stat(path)
+        inputs.append([os.path.basename(path), st.st_size, st.st_mtime])
+    data = json.dumps({'inputs': inputs, 'params': params}, sort_keys=True, default=list)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def _manifest_path(base_folder):
+    return os.path.join(base_folder, MANIFEST_NAME)
+
+
+# 读取清单，同一个文件夹以最后一条记录为准
+def load_manifest(base_folder):
+    entries = {}
+    try:
+        with open(_manifest_path(base_folder), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 写到一半被中断的最后一行
+                    continue
+                entries[entry['folder']] = entry
+    except OSError:
+        pass
+    return entries
+
+
+# 指纹一致并且记录的输出文件都还在时，认为该文件夹不需要重新处理
+def is_up_to_date(entry, fingerprint, folder_path):
+    if entry is None or entry.get('fingerprint') != fingerprint:
+        return False
+    return all(os.path.exists(os.path.join(folder_path, name)) for name in entry.get('outputs', []))
+
+
+def record_folder(base_folder, folder_path, fingerprint, outputs):
+    entry = {
+        'folder': os.path.basename(os.path.normpath(folder_path)),
+        'fingerprint': fingerprint,
+        'outputs': [os.path.relpath(path, folder_path) for path in outputs or []],
+    }
+    with open(_manifest_path(base_folder), 'a', encoding='utf-8') as f:
+        f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    return entry
+
+
+# 去掉重复的旧记录后重写清单
+def compact_manifest(base_folder):
+    entries = load_manifest(base_folder)
+    manifest_path = _manifest_path(base_folder)
+    tmp_path = manifest_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for folder in sorted(entries):
+            f.write(json.dumps(entries[folder], ensure_ascii=False) + '\n')
+    os.replace(tmp_path, manifest_path)
+
+
+# 把 base_folder 下的文件夹分成需要处理的和已经是最新的两部分
+# 返回 (需要处理的文件夹列表, {文件夹: 指纹})
+def split_stale_folders(base_folder, folders, params):
+    entries = load_manifest(base_folder)
+    stale = []
+    fingerprints = {}
+    for folder in folders:
+        fingerprint = folder_fingerprint(folder, params)
+        fingerprints[folder] = fingerprint
+        entry = entries.get(os.path.basename(os.path.normpath(folder)))
+        if not is_up_to_date(entry, fingerprint, folder):
+            stale.append(folder)
+    return stale, fingerprints
@@ -0,0 +1,42 @@
+import numpy as np
+from PIL import Image
+
+from crop import crop_box
+from settle import changed_ratio
+
+# 发请求前检查动作前后两张图是否有变化: 与发送的图片一样以鼠标为中心裁剪，转成灰度并缩小 NO_CHANGE_SCALE 倍后逐像素比较
+# 变化的像素比例(灰度差超过 settle.SETTLE_PIXEL_DELTA)不超过阈值时认为画面没有变化
+# 比 settle.py 缩小得少一些，勾选框、光标位置等小的变化也能看到
+NO_CHANGE_SCALE = 4
+# 默认阈值，1024x684 的裁剪缩小后约 44000 个像素，0.00005 约为 2 个像素，JPEG 噪声已经被灰度差的阈值忽略
+# 13x13 的勾选框变化约为 0.0003，阈值调大可以忽略光标闪烁等，但也会漏掉这样小的变化
+NO_CHANGE_RATIO = 0.00005
+
+
+# 缩小后的灰度图，image 为 PIL 图片或文件路径；读取 JPEG 文件时直接按缩小后的大小解码
+def change_buffer(image, mouse=None, scale=NO_CHANGE_SCALE):
+    source = Image.open(image) if isinstance(image, str) else image
+    try:
+        width, height = source.size
+        box = crop_box(mouse[0], mouse[1], width, height) if mouse is not None else (0, 0, width, height)
+        if source is not image:
+            source.draft('L', (width // scale, height // scale))
+        ratio = source.size[0] / width
+        box = tuple(round(v * ratio) for v in box)
+        gray = source.crop(box).convert('L')
+        factor = max(1, round(scale * ratio))
+        if factor > 1:
+            gray = gray.reduce(factor)
+        return np.asarray(gray)
+    finally:
+        if source is not image:
+            source.close()
+
+
+# 两张图以 mouse 为中心裁剪后变化的像素比例，大小不同时为 1
+def change_ratio(image1, image2, mouse=None, scale=NO_CHANGE_SCALE):
+    a = change_buffer(image1, mouse, scale)
+    b = change_buffer(image2, mouse, scale)
+    if a.shape != b.shape:
+        return 1.0
+    return changed_ratio(a, b)
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+# GPT 回复的磁盘缓存，同样的请求(图片编码后的内容、prompt、模型、max_tokens、temperature、分辨率都相同)只花一次钱
+# 每个回复一个文件 <目录>/<key>.json，key 为请求内容的 sha256
+# 总大小超过 max_bytes 时删除最久没有用过的回复，命中时更新文件的修改时间，重新打开时按修改时间恢复顺序
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'data_process_gui', 'responses')
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+CACHE_SUFFIX = '.json'
+
+
+# 请求内容的 key，payload 为 GPT_response.build_payload 的结果
+def payload_key(payload):
+    data = json.dumps(payload, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+# 可以在多个线程中共用；多个进程共用一个目录时也不会出错，只是各自按自己看到的大小淘汰
+# stats: hits 命中、misses 未命中、writes 写入、evictions 淘汰的回复数
+class ResponseCache:
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+        # key -> 文件大小，按最近使用的顺序，最久没用的在前面
+        self._entries = OrderedDict()
+        self._bytes = 0
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(CACHE_SUFFIX) and entry.is_file():
+                st = entry.stat()
+                entries.append((st.st_mtime, entry.name[:-len(CACHE_SUFFIX)], st.st_size))
+        for _, key, size in sorted(entries):
+            self._entries[key] = size
+            self._bytes += size
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def size(self):
+        return self._bytes
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + CACHE_SUFFIX)
+
+    # 返回缓存的回复，没有时返回 None
+    def get(self, key):
+        try:
+            with open(self._path(key), 'r', encoding='utf-8') as f:
+                caption = json.load(f)['caption']
+            os.utime(self._path(key))
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.stats['misses'] += 1
+            return None
+        with self._lock:
+            self.stats['hits'] += 1
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return caption
+
+    def put(self, key, caption):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'caption': caption}, f, ensure_ascii=False)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self.stats['writes'] += 1
+            while self._bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._bytes -= old_size
+                self.stats['evictions'] += 1
+                try:
+                    os.remove(self._path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        with self._lock:
+            for key in self._entries:
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+            self._entries.clear()
+            self._bytes = 0
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+# gpt4_chat_2images 默认使用的缓存，在 CACHE_DIR 中，第一次用到时才打开
+def default_cache():
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            _default_cache = ResponseCache()
+        return _default_cache
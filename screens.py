@@ -0,0 +1,75 @@
+import os
+import re
+
+import numpy as np
+
+from events import NO_COORD
+
+SCREEN_PATTERN = re.compile(r'l(-?\d+)_t(-?\d+)_r(-?\d+)_b(-?\d+)')
+
+
+def extract_coordinates(video_path):
+    # 提取文件名
+    file_name = os.path.basename(video_path)
+
+    # 使用正则表达式提取坐标
+    match = SCREEN_PATTERN.search(file_name)
+    if match:
+        left = int(match.group(1))
+        top = int(match.group(2))
+        right = int(match.group(3))
+        bottom = int(match.group(4))
+        return [left, top, right, bottom]
+    else:
+        return None
+
+
+# 按屏幕排序: 主屏(l0_t0)在前，其余按从上到下、从左到右
+def sort_screen_videos(video_paths):
+    def key(path):
+        left, top, _, _ = extract_coordinates(path)
+        return (left, top) != (0, 0), top, left
+    return sorted(video_paths, key=key)
+
+
+# 屏幕区域的索引，把所有屏幕的边界切成网格，预先算好每个格子属于哪个屏幕
+# 查询时对 x、y 分别二分查找，一次处理所有坐标
+# inclusive 为 True 时右边界和下边界也算在屏幕内(与 align 一致)，否则不算(与 cut_keyframe 一致)
+# 屏幕编号从1开始，和 rects 的顺序对应，区域重叠时靠前的屏幕优先，不在任何屏幕内为0
+class ScreenIndex:
+    def __init__(self, rects, inclusive=True):
+        self.rects = [tuple(rect) for rect in rects]
+        end = 1 if inclusive else 0
+        self.x_edges = np.unique([edge for l, _, r, _ in self.rects for edge in (l, r + end)])
+        self.y_edges = np.unique([edge for _, t, _, b in self.rects for edge in (t, b + end)])
+        self.grid = np.zeros((max(len(self.x_edges) - 1, 0), max(len(self.y_edges) - 1, 0)), dtype=np.int16)
+        for screen_id in range(len(self.rects), 0, -1):
+            l, t, r, b = self.rects[screen_id - 1]
+            x0, x1 = np.searchsorted(self.x_edges, [l, r + end])
+            y0, y1 = np.searchsorted(self.y_edges, [t, b + end])
+            self.grid[x0:x1, y0:y1] = screen_id
+
+    def __len__(self):
+        return len(self.rects)
+
+    def lookup(self, x, y):
+        x = np.asarray(x, dtype=np.int64)
+        y = np.asarray(y, dtype=np.int64)
+        ix = np.searchsorted(self.x_edges, x, side='right') - 1
+        iy = np.searchsorted(self.y_edges, y, side='right') - 1
+        valid = (ix >= 0) & (ix < self.grid.shape[0]) & (iy >= 0) & (iy < self.grid.shape[1])
+        valid &= (x != NO_COORD)
+        screens = np.zeros(x.shape, dtype=np.int16)
+        screens[valid] = self.grid[ix[valid], iy[valid]]
+        return screens
+
+
+# 给动作表中的每个动作分配屏幕，有坐标的动作按坐标判断，
+# 没有坐标或坐标不在任何屏幕内的动作沿用上一个动作的屏幕，最开始为 default
+def assign_screens(actions, screen_index, default=1):
+    assigned = screen_index.lookup(actions.x, actions.y)
+    if len(actions):
+        last_assigned = np.maximum.accumulate(np.where(assigned > 0, np.arange(len(actions)), 0))
+        assigned = assigned[last_assigned]
+    actions.screen[:] = np.where(assigned > 0, assigned, default)
+    return actions
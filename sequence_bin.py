@@ -0,0 +1,200 @@
+import os
+import re
+import shutil
+
+import numpy as np
+
+from events import NO_COORD
+from time_utils import format_time_ms
+
+# sequence.txt 的二进制版本 sequence.bin，与 sequence.txt 逐行对应(包括第一行只有时间的行)
+# 文件结构: 文件头 | 定长记录表 | 字符串池(UTF-8 的动作文本)
+# 读取时用 np.memmap 映射，不需要解析整个文件，可以直接访问第 i 个动作
+SEQUENCE_MAGIC = b'SEQB'
+SEQUENCE_VERSION = 1
+
+HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', '<u4'), ('count', '<u8'),
+                         ('records_offset', '<u8'), ('pool_offset', '<u8'), ('pool_size', '<u8')])
+# ts: 时间(毫秒)，x, y: 动作中的坐标(没有时为 NO_COORD)，screen: 屏幕编号(单屏为0)
+# text_offset, text_length: 动作文本在字符串池中的位置(字节)
+RECORD_DTYPE = np.dtype([('ts', '<i8'), ('text_offset', '<u8'), ('text_length', '<u4'),
+                         ('x', '<i4'), ('y', '<i4'), ('screen', '<i2'), ('reserved', '<u2')])
+
+SEQUENCE_COORD_PATTERN = re.compile(r'<[^>]*\((\d+),\s*(\d+)\)>')
+SEQUENCE_STRIP_PATTERN = re.compile(r'<([^>]+)\s*\(\d+,\s*\d+\)>')
+
+
+# 从 sequence.txt 中的动作提取坐标，返回 (去掉坐标和尖括号的描述, x, y)，没有坐标时 x, y 为 NO_COORD
+def describe_action(action_desc):
+    coord_match = SEQUENCE_COORD_PATTERN.search(action_desc)
+    if coord_match:
+        x = int(coord_match.group(1))
+        y = int(coord_match.group(2))
+        # 去掉坐标部分和尖括号的action_desc
+        return SEQUENCE_STRIP_PATTERN.sub(r'\1', action_desc).strip(), x, y
+    # 去掉尖括号
+    return action_desc.strip('<>'), NO_COORD, NO_COORD
+
+
+def sequence_bin_path(sequence_file):
+    return os.path.splitext(sequence_file)[0] + '.bin'
+
+
+def _header(count, pool_size):
+    header = np.zeros(1, dtype=HEADER_DTYPE)
+    header['magic'] = SEQUENCE_MAGIC
+    header['version'] = SEQUENCE_VERSION
+    header['count'] = count
+    header['records_offset'] = HEADER_DTYPE.itemsize
+    header['pool_offset'] = HEADER_DTYPE.itemsize + count * RECORD_DTYPE.itemsize
+    header['pool_size'] = pool_size
+    return header
+
+
+# records 为 (时间毫秒, 动作文本, 屏幕编号) 的列表，与 sequence.txt 的每一行对应，第一行的动作文本为空
+def write_sequence_bin(file_path, records):
+    encoded = [action.encode('utf-8') for _, action, _ in records]
+    table = np.zeros(len(records), dtype=RECORD_DTYPE)
+    lengths = np.fromiter((len(text) for text in encoded), dtype=np.int64, count=len(encoded))
+    table['ts'] = [ts for ts, _, _ in records]
+    table['text_offset'] = np.cumsum(lengths) - lengths
+    table['text_length'] = lengths
+    table['screen'] = [screen for _, _, screen in records]
+    coords = [describe_action(action)[1:] for _, action, _ in records]
+    table['x'] = [x for x, _ in coords]
+    table['y'] = [y for _, y in coords]
+
+    header = _header(len(records), int(lengths.sum()))
+
+    # 先写临时文件再替换，避免读到写了一半的文件
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header.tobytes())
+        f.write(table.tobytes())
+        f.write(b''.join(encoded))
+    os.replace(tmp_path, file_path)
+    return file_path
+
+
+# 逐条写出 sequence.bin，内存中不保留记录: 记录表和字符串池先分别追加到两个临时文件中，
+# close() 时再拼成 sequence.bin，结果与用同样的记录调用 write_sequence_bin 相同
+class SequenceBinWriter:
+    def __init__(self, file_path):
+        self.path = file_path
+        self.count = 0
+        self.pool_size = 0
+        self._records = open(file_path + '.records.tmp', 'wb')
+        self._pool = open(file_path + '.pool.tmp', 'wb')
+
+    def __len__(self):
+        return self.count
+
+    def append(self, ts, action, screen=0):
+        text = action.encode('utf-8')
+        record = np.zeros(1, dtype=RECORD_DTYPE)
+        record['ts'] = ts
+        record['text_offset'] = self.pool_size
+        record['text_length'] = len(text)
+        record['screen'] = screen
+        _, record['x'], record['y'] = describe_action(action)
+        self._records.write(record.tobytes())
+        self._pool.write(text)
+        self.count += 1
+        self.pool_size += len(text)
+
+    # 只删除临时文件，不写出 sequence.bin
+    def discard(self):
+        for f in (self._records, self._pool):
+            f.close()
+            try:
+                os.remove(f.name)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self._records.close()
+        self._pool.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(_header(self.count, self.pool_size).tobytes())
+            for part in (self._records.name, self._pool.name):
+                with open(part, 'rb') as src:
+                    shutil.copyfileobj(src, f)
+        os.replace(tmp_path, self.path)
+        self.discard()
+        return self.path
+
+
+# 映射 sequence.bin，每一项与 cut_keyframe.parse_sequence_file 返回的 (时间戳, 动作描述, 坐标) 相同
+# ts、x、y、screen 是映射到文件的 NumPy 数组，action(i) 返回 sequence.txt 中原始的动作文本
+class SequenceFile:
+    def __init__(self, file_path):
+        self.path = file_path
+        header = np.fromfile(file_path, dtype=HEADER_DTYPE, count=1)
+        if len(header) != 1 or header['magic'][0] != SEQUENCE_MAGIC or header['version'][0] != SEQUENCE_VERSION:
+            raise ValueError(f"not a sequence.bin file: {file_path}")
+        header = header[0]
+        self.count = int(header['count'])
+        if self.count:
+            self.records = np.memmap(file_path, dtype=RECORD_DTYPE, mode='r',
+                                     offset=int(header['records_offset']), shape=(self.count,))
+        else:
+            self.records = np.zeros(0, dtype=RECORD_DTYPE)
+        if header['pool_size']:
+            self.pool = np.memmap(file_path, dtype=np.uint8, mode='r',
+                                  offset=int(header['pool_offset']), shape=(int(header['pool_size']),))
+        else:
+            self.pool = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def ts(self):
+        return self.records['ts']
+
+    @property
+    def x(self):
+        return self.records['x']
+
+    @property
+    def y(self):
+        return self.records['y']
+
+    @property
+    def screen(self):
+        return self.records['screen']
+
+    def action(self, i):
+        record = self.records[i]
+        offset = int(record['text_offset'])
+        return self.pool[offset:offset + int(record['text_length'])].tobytes().decode('utf-8')
+
+    # 第 i 个动作的 (时间戳, 动作描述, 坐标)
+    def row(self, i):
+        desc, x, y = describe_action(self.action(i))
+        coords = {'x': x, 'y': y} if x != NO_COORD else None
+        return format_time_ms(int(self.records[i]['ts'])), desc, coords
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.row(k) for k in range(*i.indices(self.count))]
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        return self.row(i)
+
+    def __iter__(self):
+        return (self.row(i) for i in range(self.count))
+
+
+# sequence.txt 对应的 sequence.bin 存在且不比 sequence.txt 旧时打开它，否则返回 None
+def open_sequence_bin(sequence_file):
+    bin_file = sequence_bin_path(sequence_file)
+    try:
+        if os.path.exists(sequence_file) and os.path.getmtime(bin_file) < os.path.getmtime(sequence_file):
+            return None
+        return SequenceFile(bin_file)
+    except (OSError, ValueError):
+        return None
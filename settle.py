@@ -0,0 +1,55 @@
+import cv2
+import numpy as np
+
+# 画面稳定检测: 从动作的 "after" 帧开始往后看，找到之后画面保持不变的第一帧
+# 每帧先缩小并转成灰度，只比较相邻两帧的小图，每帧的开销与分辨率无关
+SETTLE_SCALE = 8
+# 小图中灰度变化超过 SETTLE_PIXEL_DELTA 的像素比例不超过 SETTLE_CHANGED_RATIO 时认为两帧相同(忽略光标闪烁等)
+SETTLE_PIXEL_DELTA = 12
+SETTLE_CHANGED_RATIO = 0.002
+# 最多往后看这么多帧，超过时仍使用原来的帧
+SETTLE_MAX_FRAMES = 30
+
+
+# 缩小后的灰度图
+def settle_buffer(frame, scale=SETTLE_SCALE):
+    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    size = (max(1, gray.shape[1] // scale), max(1, gray.shape[0] // scale))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+
+# 两张小图中变化的像素比例
+def changed_ratio(a, b, delta=SETTLE_PIXEL_DELTA):
+    return np.count_nonzero(np.abs(a.astype(np.int16) - b) > delta) / a.size
+
+
+# 一个动作的稳定检测，从 start 帧开始依次传入之后的每一帧，最多到 limit 帧
+# 连续 stable_frames 帧都和前一帧相同时，选择这段稳定画面的第一帧；到 limit 还没稳定时选择 start 帧
+# 只保留候选帧和 start 帧两张原始分辨率的图，内存占用固定
+class SettleTracker:
+    def __init__(self, start, frame, buffer, limit, stable_frames):
+        self.start = start
+        self.fallback = frame
+        self.limit = limit
+        self.stable_frames = stable_frames
+        self.candidate = (start, frame)
+        self.previous = buffer
+        self.stable = 0
+
+    # 传入下一帧，确定后返回选中的 (帧号, 帧)，否则返回 None
+    def update(self, fn, frame, buffer):
+        if changed_ratio(self.previous, buffer) <= SETTLE_CHANGED_RATIO:
+            self.stable += 1
+            if self.stable >= self.stable_frames:
+                return self.candidate
+        else:
+            self.candidate = (fn, frame)
+            self.stable = 0
+        self.previous = buffer
+        if fn >= self.limit:
+            return self.finish()
+        return None
+
+    # 没有找到稳定的画面(或视频提前结束)，使用原来的帧
+    def finish(self):
+        return self.start, self.fallback
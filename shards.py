@@ -0,0 +1,233 @@
+import json
+import os
+import re
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from frame_writer import FrameWriter
+from screens import extract_coordinates
+
+# 打包的帧数据集: 不再为每个动作写一个图片文件，而是把编码后的图片依次追加到分片文件中
+# 目录结构(都在 cut_keyframe 的输出目录中):
+#   <视频名>-00000.shard ...   每个视频自己的分片，每个分片不超过 shard_size 字节(单张图片更大时单独一个分片)
+#   <视频名>.part.json          截帧时每个视频写出的样本位置，build_dataset 合并后不再需要
+#   dataset.json                分片文件列表、图片扩展名和样本数
+#   index.npy                   每个样本在哪个分片、偏移和长度，读取时映射，不需要读整个文件
+#   meta.jsonl                  每个样本一行: 文件名、动作、时间、坐标、屏幕
+SHARD_SIZE = 256 * 1024 * 1024
+SHARD_SUFFIX = '.shard'
+PART_SUFFIX = '.part.json'
+DATASET_NAME = 'dataset.json'
+INDEX_NAME = 'index.npy'
+META_NAME = 'meta.jsonl'
+DATASET_VERSION = 1
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4'), ('shard', '<u4')])
+# 样本名: 类型_动作序号，窗口中的帧另外带 _m1(前1帧)、_p1(后1帧) 等
+SAMPLE_PATTERN = re.compile(r'([a-z]+)_(\d+)(?:_([mp])(\d+))?$')
+# 同一个动作的样本在数据集中的顺序
+SAMPLE_KINDS = ['before', 'after', 'frame', 'thumb']
+
+
+# 与 FrameWriter 相同，在后台线程中编码，但图片追加到分片文件中
+# 同时充当 cut_keyframe.extract_frames 使用的 FrameStore: 同一张图片只写一次，多个样本指向同一位置
+# 每次运行都重新写这个视频的分片，不复用上次的结果
+class ShardWriter(FrameWriter):
+    def __init__(self, output_dir, video_path, shard_size=SHARD_SIZE, **writer_options):
+        super().__init__(**writer_options)
+        self.directory = output_dir
+        self.video_name = os.path.basename(video_path)
+        self.prefix = os.path.splitext(self.video_name)[0]
+        self.shard_size = shard_size
+        self.part_path = os.path.join(output_dir, self.prefix + PART_SUFFIX)
+        for name in os.listdir(output_dir):
+            if name == os.path.basename(self.part_path) or (name.startswith(self.prefix + '-')
+                                                            and name.endswith(SHARD_SUFFIX)):
+                os.remove(os.path.join(output_dir, name))
+        self.shards = []
+        # 图片 key -> (分片下标, 偏移, 长度)
+        self.frames = {}
+        # 样本名(例如 frame_0001) -> 图片 key
+        self.samples = {}
+        self._file = None
+
+    def __contains__(self, key):
+        return key in self.frames
+
+    def link(self, key, paths):
+        for path in paths:
+            self.samples[os.path.basename(path)] = key
+
+    def submit(self, frame, key, paths):
+        self.link(key, paths)
+        self._enqueue(self._append, frame, key)
+        return paths
+
+    def _append(self, frame, key):
+        start = time.perf_counter()
+        data = self._encode(frame, key)
+        with self._lock:
+            if self._file is None or (self._file.tell() and self._file.tell() + len(data) > self.shard_size):
+                if self._file is not None:
+                    self._file.close()
+                self.shards.append(f"{self.prefix}-{len(self.shards):05d}{SHARD_SUFFIX}")
+                self._file = open(os.path.join(self.directory, self.shards[-1]), 'wb')
+            self.frames[key] = (len(self.shards) - 1, self._file.tell(), len(data))
+            self._file.write(data)
+        self._record(1, len(data), start)
+
+    def close(self):
+        try:
+            return super().close()
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    # 所有图片写完后记录样本的位置
+    def save(self):
+        samples = {}
+        for name, key in self.samples.items():
+            if key in self.frames:
+                shard, offset, length = self.frames[key]
+                samples[name] = [self.shards[shard], offset, length]
+        part = {'video': self.video_name, 'extension': self.extension, 'samples': samples}
+        tmp_path = self.part_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(part, f)
+        os.replace(tmp_path, self.part_path)
+
+
+# 返回 (类型, 动作序号, 相对该动作的帧的偏移)
+def parse_sample_name(name):
+    kind, idx, sign, offset = SAMPLE_PATTERN.match(name).groups()
+    offset = int(offset) * (-1 if sign == 'm' else 1) if offset else 0
+    return kind, int(idx), offset
+
+
+def _sample_order(name):
+    kind, idx, offset = parse_sample_name(name)
+    return idx, SAMPLE_KINDS.index(kind) if kind in SAMPLE_KINDS else len(SAMPLE_KINDS), kind, offset
+
+
+# 合并 output_dir 中所有视频的 .part.json，写出 dataset.json、index.npy 和 meta.jsonl
+# sequence 为 cut_keyframe.load_sequence 的结果，用于每个样本的动作、时间和坐标
+# before_XXXX 的时间为上一个动作的时间(截取的帧)，动作和坐标都是第 XXXX 个动作的
+# 窗口中的帧 offset 为相对动作时间对应的帧的帧数，time 仍为动作的时间
+def build_dataset(output_dir, sequence):
+    parts = []
+    for name in sorted(os.listdir(output_dir)):
+        if name.endswith(PART_SUFFIX):
+            with open(os.path.join(output_dir, name), 'r') as f:
+                parts.append(json.load(f))
+    shards = sorted({shard for part in parts for shard, _, _ in part['samples'].values()})
+    shard_ids = {shard: k for k, shard in enumerate(shards)}
+    samples = sorted(((name, part) for part in parts for name in part['samples']),
+                     key=lambda sample: _sample_order(sample[0]))
+
+    index = np.zeros(len(samples), dtype=INDEX_DTYPE)
+    meta_lines = []
+    for i, (name, part) in enumerate(samples):
+        shard, offset, length = part['samples'][name]
+        index[i] = (offset, length, shard_ids[shard])
+        kind, idx, offset = parse_sample_name(name)
+        timestamp, action, coords = sequence[idx]
+        if kind == 'before':
+            timestamp = sequence[idx - 1][0]
+        meta_lines.append(json.dumps({
+            'name': name, 'kind': kind, 'idx': idx, 'offset': offset, 'time': timestamp, 'action': action,
+            'x': coords['x'] if coords else None, 'y': coords['y'] if coords else None,
+            'screen': extract_coordinates(part['video']), 'video': part['video'],
+        }, ensure_ascii=False))
+
+    extension = parts[0]['extension'] if parts else None
+    dataset = {'version': DATASET_VERSION, 'extension': extension, 'shards': shards, 'count': len(samples)}
+    # 先写 index 和 meta，最后写 dataset.json，读到 dataset.json 时其他文件都已经写好
+    with open(os.path.join(output_dir, INDEX_NAME + '.tmp'), 'wb') as f:
+        np.save(f, index)
+    os.replace(os.path.join(output_dir, INDEX_NAME + '.tmp'), os.path.join(output_dir, INDEX_NAME))
+    with open(os.path.join(output_dir, META_NAME + '.tmp'), 'w', encoding='utf-8') as f:
+        f.writelines(line + '\n' for line in meta_lines)
+    os.replace(os.path.join(output_dir, META_NAME + '.tmp'), os.path.join(output_dir, META_NAME))
+    with open(os.path.join(output_dir, DATASET_NAME + '.tmp'), 'w') as f:
+        json.dump(dataset, f)
+    os.replace(os.path.join(output_dir, DATASET_NAME + '.tmp'), os.path.join(output_dir, DATASET_NAME))
+    return dataset
+
+
+# 读取打包的帧数据集，按下标或样本名直接定位到分片中的偏移，不需要列目录或打开单独的图片文件
+# dataset[i] 返回 (图片, meta)，read(i) 返回编码后的字节，pair(idx) 返回第 idx 个动作前后的两帧
+class ShardDataset:
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, DATASET_NAME), 'r') as f:
+            self.info = json.load(f)
+        if self.info.get('version') != DATASET_VERSION:
+            raise ValueError(f"unsupported dataset version in {directory}")
+        self.shards = self.info['shards']
+        self.index = np.load(os.path.join(directory, INDEX_NAME), mmap_mode='r')
+        with open(os.path.join(directory, META_NAME), 'r', encoding='utf-8') as f:
+            self.meta = [json.loads(line) for line in f]
+        self.names = {meta['name']: i for i, meta in enumerate(self.meta)}
+        # 分片 -> 文件描述符，用 os.pread 按偏移读取，不移动共用的文件位置，
+        # 多个线程或 fork 出的 worker(例如 DataLoader)共用时也不会读错
+        self._fds = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.meta)
+
+    def __getitem__(self, i):
+        return self.image(i), self.meta[i]
+
+    def find(self, name):
+        return self.names[name]
+
+    def _fd(self, shard):
+        fd = self._fds.get(shard)
+        if fd is None:
+            with self._lock:
+                fd = self._fds.get(shard)
+                if fd is None:
+                    fd = self._fds[shard] = os.open(os.path.join(self.directory, self.shards[shard]), os.O_RDONLY)
+        return fd
+
+    def read(self, i):
+        offset, length, shard = self.index[i].tolist()
+        return os.pread(self._fd(shard), length, offset)
+
+    def image(self, i):
+        return cv2.imdecode(np.frombuffer(self.read(i), dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    # 第 idx 个动作前后的两帧: 有 before_XXXX 时用它和 after_XXXX(不裁剪时为 frame_XXXX)，
+    # 否则为上一个动作和这个动作的 frame_XXXX
+    def pair(self, idx):
+        after = f"after_{idx:04d}" if f"after_{idx:04d}" in self.names else f"frame_{idx:04d}"
+        before = f"before_{idx:04d}" if f"before_{idx:04d}" in self.names else f"frame_{idx - 1:04d}"
+        return self.image(self.find(before)), self.image(self.find(after))
+
+    # 第 idx 个动作的帧及其窗口中的帧，按时间顺序排列
+    def stack(self, idx):
+        base = f"after_{idx:04d}" if f"after_{idx:04d}" in self.names else f"frame_{idx:04d}"
+        before = []
+        while f"{base}_m{len(before) + 1}" in self.names:
+            before.append(f"{base}_m{len(before) + 1}")
+        after = []
+        while f"{base}_p{len(after) + 1}" in self.names:
+            after.append(f"{base}_p{len(after) + 1}")
+        return [self.image(self.find(name)) for name in before[::-1] + [base] + after]
+
+    def close(self):
+        with self._lock:
+            for fd in self._fds.values():
+                os.close(fd)
+            self._fds = {}
@@ -0,0 +1,48 @@
+import os
+import random
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dect_frame import TARGET_COLOR
+
+
+# 合成的录屏: 每帧左上角写帧号，sync_on 到 sync_off 之间(不含)在屏幕中心往上 100 像素处显示同步色块
+def make_video(path, width=640, height=480, fps=30, frames=200, sync_on=40, sync_off=70):
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    cx, cy = width // 2, height // 2 - 100
+    for i in range(frames):
+        frame = np.full((height, width, 3), (i * 3) % 200, np.uint8)
+        if sync_on <= i < sync_off:
+            frame[cy - 30:cy + 30, cx - 30:cx + 30] = TARGET_COLOR
+        cv2.putText(frame, str(i), (10, 40), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 255), 2)
+        writer.write(frame)
+    writer.release()
+
+
+# 合成的日志行，第 ctrl_index 行为同步用的 <Ctrl>，返回行的列表
+def make_log_lines(count=40, x_max=639, ctrl_index=0, seed=0, start_ms=36001234):
+    rng = random.Random(seed)
+    t = start_ms
+    lines = []
+    for i in range(count):
+        t += rng.randint(50, 600)
+        x, y = rng.randint(0, x_max), rng.randint(0, 479)
+        action = '<Ctrl>' if i == ctrl_index else rng.choice(['a', 'b', '<Enter>', f'<LClick ({x}, {y})>',
+                                                              f'<Scroll ({x}, {y})>'])
+        lines.append(f"2024-01-01 {t // 3600000:02d}:{t // 60000 % 60:02d}:{t // 1000 % 60:02d}.{t % 1000:03d} {action}\n")
+    return lines
+
+
+@pytest.fixture
+def dual_session(tmp_path):
+    folder = tmp_path / 'save' / 's1'
+    folder.mkdir(parents=True)
+    make_video(str(folder / 'l0_t0_r640_b480_a.mp4'))
+    make_video(str(folder / 'l640_t0_r1280_b480_a.mp4'), fps=25, sync_on=30, sync_off=55)
+    (folder / 'log.txt').write_text(''.join(make_log_lines(x_max=1279)))
+    return folder
@@ -0,0 +1,60 @@
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MOCK_CAPTION = 'The user clicked a button.'
+
+
+# 本地的模拟 API: 每个请求等待 delay 秒后返回固定的 caption MOCK_CAPTION，
+# 按 error_rate 的概率返回 429(带 Retry-After)或 503，用于测试重试
+# script 为前几个请求依次使用的回复，每项为 {'status', 'headers', 'body', 'delay'}(都可以省略，默认为成功的回复)
+# server.requests 中按顺序记录每个请求到达的时间(time.monotonic())和请求内容
+def start_mock_api(delay=0.2, error_rate=0.0, seed=0, script=None):
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    script = list(script or [])
+
+    def next_response(payload):
+        with lock:
+            server.requests.append((time.monotonic(), payload))
+            if script:
+                step = script.pop(0)
+                return (step.get('status', 200), step.get('headers', {}), step.get('body'),
+                        step.get('delay', delay))
+            r = rng.random()
+        if r < error_rate / 2:
+            return 429, {'Retry-After': '0.1'}, {'error': 'rate limited'}, delay
+        if r < error_rate:
+            return 503, {}, {'error': 'unavailable'}, delay
+        return 200, {}, None, delay
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+            status, headers, body, wait = next_response(payload)
+            if body is None:
+                body = {'choices': [{'message': {'content': MOCK_CAPTION}}]} if status == 200 else {'error': status}
+            data = json.dumps(body).encode()
+            time.sleep(wait)
+            try:
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                # 客户端已经超时断开
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.requests = []
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/v1/chat/completions"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
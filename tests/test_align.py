@@ -0,0 +1,22 @@
+import pytest
+
+import align
+import align_2screen
+from conftest import make_log_lines, make_video
+
+
+# 日志中没有 <Ctrl> 时与以前一样只提示，不因为视频中没有同步色块而报错
+@pytest.mark.parametrize('module', [align, align_2screen])
+def test_log_without_ctrl_is_reported_before_missing_sync(tmp_path, capsys, module):
+    make_video(str(tmp_path / 'l0_t0_r640_b480_a.mp4'), sync_on=1000)
+    (tmp_path / 'log.txt').write_text(''.join(make_log_lines(ctrl_index=-1)))
+    assert module.process_folder(str(tmp_path)) is None
+    assert "No <Ctrl> action found" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize('module', [align, align_2screen])
+def test_missing_sync_marker_raises(tmp_path, module):
+    make_video(str(tmp_path / 'l0_t0_r640_b480_a.mp4'), sync_on=1000)
+    (tmp_path / 'log.txt').write_text(''.join(make_log_lines()))
+    with pytest.raises(RuntimeError, match="No sync marker"):
+        module.process_folder(str(tmp_path))
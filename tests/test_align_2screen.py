@@ -0,0 +1,45 @@
+import random
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from align import entry_span
+from align_2screen import adjust_timestamps
+from events import EventTable
+from time_utils import format_time_ms
+
+
+# 以前用 datetime 计算的结果: 减去 offset 后保留微秒，中点为 a + (b - a) / 2，写文件时截断到毫秒
+def reference_spans(times_ms, offset):
+    base = datetime(1900, 1, 1)
+    times = [base + timedelta(milliseconds=t) - timedelta(milliseconds=offset) for t in times_ms]
+    spans = []
+    for i, t in enumerate(times):
+        before = (t - timedelta(milliseconds=150)).time()
+        if i > 0:
+            before = max((times[i - 1] + (t - times[i - 1]) / 2).time(), before)
+        after = max((t + (times[i + 1] - t) / 2).time(), (times[i + 1] - timedelta(milliseconds=150)).time()) \
+            if i < len(times) - 1 else t.time()
+        spans.append((before.strftime('%H:%M:%S.%f')[:-3], after.strftime('%H:%M:%S.%f')[:-3]))
+    return spans
+
+
+def test_spans_keep_sub_millisecond_offset():
+    rng = random.Random(0)
+    for _ in range(200):
+        times_ms, t = [], 3_600_000
+        for _ in range(30):
+            t += rng.randint(1, 400)
+            times_ms.append(t)
+        offset = rng.uniform(-3000.0, 3000.0)
+        actions = EventTable()
+        for timestamp in times_ms:
+            actions.append(timestamp, 'a', 1)
+        times_us = adjust_timestamps(actions, [offset]).tolist()
+        spans = []
+        for i in range(len(times_us)):
+            before, after = entry_span(times_us[i], times_us[i], times_us[i - 1] if i else None,
+                                       times_us[i + 1] if i < len(times_us) - 1 else None, unit=1000)
+            spans.append((format_time_ms(before // 1000), format_time_ms(after // 1000)))
+        assert spans == reference_spans(times_ms, offset)
+        assert np.array_equal(actions.ts, np.array(times_us) // 1000)
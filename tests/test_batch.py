@@ -0,0 +1,22 @@
+import align_2screen
+from batch import run_batch
+from manifest import find_session_files
+
+PARAMS = {'aligner': 'align_2screen'}
+
+
+def test_generated_txt_files_are_not_inputs(dual_session):
+    for name in ('sequence.txt', 'sequence_1.txt', 'sequence_2.txt', 'subtitles_1.txt', 'adjusted_log.txt'):
+        (dual_session / name).write_text('')
+    _, txt_files = find_session_files(str(dual_session))
+    assert [f.rsplit('/', 1)[-1] for f in txt_files] == ['log.txt']
+
+
+def test_rerun_skips_up_to_date_dual_screen_folder(dual_session):
+    base_folder = str(dual_session.parent)
+    first = run_batch(base_folder, align_2screen.process_folder, workers=1, params=PARAMS)
+    assert [status['status'] for status in first] == ['ok']
+    assert (dual_session / 'sequence_1.txt').exists()
+
+    second = run_batch(base_folder, align_2screen.process_folder, workers=1, params=PARAMS)
+    assert second == []
@@ -0,0 +1,109 @@
+import email.utils
+import threading
+import time
+
+import pytest
+from PIL import Image
+
+from GPT_response import CaptionClient, CaptionError
+from mock_api import MOCK_CAPTION, start_mock_api
+
+PAYLOAD = {'model': 'mock', 'messages': []}
+
+
+@pytest.fixture
+def mock_api():
+    servers = []
+
+    def start(script=None, delay=0.0):
+        server = start_mock_api(delay=delay, script=script)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_client(server, **options):
+    options = dict({'concurrency': 1, 'timeout': 5, 'max_retries': 2, 'backoff': 0.01}, **options)
+    return CaptionClient(api_key='mock', url=server.url, **options)
+
+
+def request_gaps(server):
+    times = [t for t, _ in server.requests]
+    return [b - a for a, b in zip(times, times[1:])]
+
+
+def test_retry_after_seconds(mock_api):
+    server = mock_api([{'status': 429, 'headers': {'Retry-After': '0.3'}}])
+    with make_client(server) as client:
+        assert client.request(PAYLOAD) == (MOCK_CAPTION, 2)
+    assert request_gaps(server)[0] >= 0.3
+
+
+def test_retry_after_http_date(mock_api):
+    # HTTP 日期只精确到秒，等待时间在 1 到 2 秒之间
+    retry_at = email.utils.formatdate(time.time() + 2, usegmt=True)
+    server = mock_api([{'status': 429, 'headers': {'Retry-After': retry_at}}])
+    with make_client(server) as client:
+        assert client.request(PAYLOAD) == (MOCK_CAPTION, 2)
+    assert 0.9 <= request_gaps(server)[0] < 3
+
+
+# 一个线程收到 429 后其他线程也暂停，暂停期间不发新的请求
+def test_rate_limit_pauses_all_threads(mock_api):
+    server = mock_api([{'status': 429, 'headers': {'Retry-After': '0.5'}, 'delay': 0.1}])
+    with make_client(server, concurrency=2) as client:
+        first = threading.Thread(target=client.request, args=(PAYLOAD,))
+        first.start()
+        # 第一个请求已经收到 429，正在等待 Retry-After
+        time.sleep(0.3)
+        assert client.request(PAYLOAD) == (MOCK_CAPTION, 1)
+        first.join()
+    times = [t for t, _ in server.requests]
+    assert len(times) == 3
+    assert min(times[1:]) - times[0] >= 0.55
+
+
+def test_server_error_is_retried(mock_api):
+    server = mock_api([{'status': 500}])
+    with make_client(server) as client:
+        assert client.request(PAYLOAD) == (MOCK_CAPTION, 2)
+    assert len(server.requests) == 2
+
+
+def test_client_error_is_not_retried(mock_api):
+    server = mock_api([{'status': 400, 'body': {'error': 'bad request'}}])
+    image = Image.new('RGB', (64, 48))
+    with make_client(server) as client:
+        result, = client.caption_pairs([(image, image, ('LClick', {'x': 10, 'y': 10}))])
+    assert result['status'] == 'failed'
+    assert result['attempts'] == 1
+    assert result['error'].startswith('CaptionError: HTTP 400')
+    assert len(server.requests) == 1
+
+
+def test_timeout_is_retried_then_fails(mock_api):
+    server = mock_api(delay=1.0)
+    with make_client(server, timeout=0.2, max_retries=1) as client:
+        with pytest.raises(CaptionError) as excinfo:
+            client.request(PAYLOAD)
+    assert excinfo.value.attempts == 2
+    assert 'Timeout' in str(excinfo.value)
+    assert len(server.requests) == 2
+
+
+# 某一项失败不影响其他项，结果按 items 的顺序返回
+def test_failed_item_does_not_affect_others(mock_api):
+    server = mock_api([{}, {'status': 400}, {}])
+    items = [(Image.new('RGB', (64, 48), (i * 50, 0, 0)), Image.new('RGB', (64, 48)), ('LClick', {'x': i, 'y': i}))
+             for i in range(1, 4)]
+    seen = []
+    with make_client(server) as client:
+        results = client.caption_pairs(items, on_result=seen.append)
+    assert [result['status'] for result in results] == ['ok', 'failed', 'ok']
+    assert [result['index'] for result in results] == [0, 1, 2]
+    assert results[0]['caption'] == results[2]['caption'] == MOCK_CAPTION
+    assert sorted(result['index'] for result in seen) == [0, 1, 2]
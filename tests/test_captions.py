@@ -0,0 +1,97 @@
+import json
+
+import pytest
+from PIL import Image
+
+import captions
+from captions import CaptionStore, caption_session, export_batch
+from GPT_response import build_payload
+
+MODEL = 'gpt-4o-mini'
+
+
+# cut_keyframe 输出的会话: save_image/frame_XXXX.jpg 和 sequence.txt，共 count 个动作
+# cropped 为 True 时为裁剪模式，第 i 个动作保存 before_XXXX/after_XXXX
+def make_caption_session(folder, count=5, cropped=False):
+    (folder / 'save_image').mkdir(parents=True)
+    lines = ['10:00:00.000']
+    for i in range(count + 1):
+        if not cropped:
+            Image.new('RGB', (320, 240), (i * 40, 0, 0)).save(folder / 'save_image' / f'frame_{i:04d}.jpg')
+        if i:
+            lines.append(f'<LClick ({i * 10}, {i * 20})>,10:00:0{i}.000')
+            if cropped:
+                for name in ('before', 'after'):
+                    Image.new('RGB', (64, 48), (i * 40, 0, 0)).save(folder / 'save_image' / f'{name}_{i:04d}.jpg')
+    (folder / 'sequence.txt').write_text('\n'.join(lines) + '\n')
+    return folder
+
+
+@pytest.fixture
+def caption_session_dir(tmp_path):
+    return make_caption_session(tmp_path / 'save' / 's1')
+
+
+# 只记录每次 caption_pairs 的参数，不发请求
+class RecordingClient:
+    def __init__(self):
+        self.calls = []
+
+    def caption_pairs(self, items, on_result=None, **options):
+        self.calls.append((items, options))
+        results = [{'index': index, 'status': 'ok', 'caption': 'c', 'error': None} for index in range(len(items))]
+        for result in results:
+            on_result(result)
+        return results
+
+
+def _custom_ids(paths):
+    ids = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            ids.extend(json.loads(line)['custom_id'] for line in f)
+    return ids
+
+
+def test_export_batch_marks_pending_only_after_file_is_finished(caption_session_dir, tmp_path, monkeypatch):
+    base_folder = str(caption_session_dir.parent)
+    prefix = str(tmp_path / 'requests')
+    batch_line = captions._batch_line
+
+    # 构造第 5 个请求(第二块)时崩溃，第一个文件(动作 1、2)已经写完，动作 3、4 还在第二个文件的 .tmp 中
+    def crash(session, model, pair, options):
+        if pair[0] == 5:
+            raise RuntimeError('crash')
+        return batch_line(session, model, pair, options)
+
+    with CaptionStore(str(tmp_path / 'captions.db')) as store:
+        monkeypatch.setattr(captions, '_batch_line', crash)
+        with pytest.raises(RuntimeError):
+            export_batch(base_folder, store, prefix, max_requests=2, threads=1)
+        assert store.done('s1', MODEL, statuses=('pending',)) == {1, 2}
+        assert _custom_ids([prefix + '-00000.jsonl']) == [f's1/{i}/{MODEL}/{captions.PROMPT_VERSION}' for i in (1, 2)]
+
+        monkeypatch.setattr(captions, '_batch_line', batch_line)
+        paths = export_batch(base_folder, store, prefix + '-retry', max_requests=2, threads=1)
+        assert [int(custom_id.split('/')[1]) for custom_id in _custom_ids(paths)] == [3, 4, 5]
+        assert store.done('s1', MODEL, statuses=('pending',)) == {1, 2, 3, 4, 5}
+
+
+def test_pre_cropped_pairs_are_not_cropped_again(tmp_path, monkeypatch):
+    folder = make_caption_session(tmp_path / 'save' / 's1', count=3, cropped=True)
+    client = RecordingClient()
+    crops = []
+
+    def recording_payload(image1, image2, action, **options):
+        crops.append(options['crop'])
+        return build_payload(image1, image2, action, **options)
+
+    monkeypatch.setattr(captions, 'build_payload', recording_payload)
+    with CaptionStore(str(tmp_path / 'captions.db')) as store:
+        summary = caption_session(str(folder), store, client, crop=True)
+        assert summary == {'ok': 3, 'failed': 0, 'skipped': 0}
+        assert [options['crop'] for _, options in client.calls] == [False]
+        assert all('before_' in item[0] for item in client.calls[0][0])
+
+        export_batch(str(folder.parent), store, str(tmp_path / 'requests'), llm='other-model', crop=True)
+        assert crops == [False, False, False]
@@ -0,0 +1,15 @@
+import pytest
+
+from conftest import make_video
+from dect_frame import SEARCH_STRIDE, find_key_frame
+
+
+# 色块比稀疏搜索的步长短时也要与逐帧检测的结果相同
+@pytest.mark.parametrize('sync_on, sync_off', [(41, 44), (10, 13), (17, 18), (9, 12), (40, 70), (0, 5), (190, 200), (300, 300)])
+def test_sparse_search_matches_per_frame_search(tmp_path, sync_on, sync_off):
+    path = str(tmp_path / 'rec.mp4')
+    make_video(path, sync_on=sync_on, sync_off=sync_off)
+    expected = find_key_frame(path, stride=1)
+    if sync_off - sync_on < SEARCH_STRIDE and sync_off < 200:
+        assert expected is not None
+    assert find_key_frame(path) == expected
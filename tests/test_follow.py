@@ -0,0 +1,51 @@
+import os
+
+import pytest
+
+from conftest import make_log_lines, make_video
+from follow import FollowSession
+
+
+def test_first_frame_kept_when_lines_arrive_after_sync(tmp_path):
+    make_video(str(tmp_path / 'rec.mp4'))
+    lines = make_log_lines(ctrl_index=1)
+    log_path = tmp_path / 'log.txt'
+    # 检测到同步色块时日志中只有第一行和 <Ctrl>
+    log_path.write_text(''.join(lines[:2]))
+    session = FollowSession(str(tmp_path))
+    session.poll()
+    assert session.offset is not None
+    with open(log_path, 'a') as f:
+        f.writelines(lines[2:])
+    session.poll()
+    session.finish()
+    assert os.path.exists(tmp_path / 'save_image' / 'frame_0000.jpg')
+    assert os.path.exists(tmp_path / 'sequence.bin')
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+def test_log_without_ctrl_is_reported_before_missing_sync(tmp_path, capsys):
+    make_video(str(tmp_path / 'rec.mp4'), sync_on=1000)
+    (tmp_path / 'log.txt').write_text(''.join(make_log_lines(ctrl_index=-1)))
+    session = FollowSession(str(tmp_path))
+    session.poll()
+    assert session.finish() is None
+    assert "No <Ctrl> action found" in capsys.readouterr().out
+    assert not [name for name in os.listdir(tmp_path) if name.endswith('.tmp')]
+
+
+# 录制中的 MP4 打不开时提示，而不是等到最后报找不到同步色块
+def test_unreadable_mp4_is_reported(tmp_path, capsys):
+    path = tmp_path / 'rec.mp4'
+    make_video(str(path))
+    data = path.read_bytes()
+    path.write_bytes(data[:len(data) // 2])
+    (tmp_path / 'log.txt').write_text(''.join(make_log_lines()))
+    session = FollowSession(str(tmp_path))
+    session.poll()
+    session.poll()
+    out = capsys.readouterr().out
+    assert "不是 MKV" in out
+    assert out.count("Failed to open video") == 1
+    with pytest.raises(RuntimeError, match="Failed to open video"):
+        session.finish()
@@ -0,0 +1,16 @@
+from sequence_bin import SequenceBinWriter, write_sequence_bin
+
+RECORDS = [(36000000, '', 0), (36001000, '<LClick (10, 20)>', 0), (36002000, '输入 abc', 1),
+           (36003000, '<Scroll (5, 6)>', 2)]
+
+
+# 逐条写出的 sequence.bin 与一次写出的完全相同，临时文件在结束后删除
+def test_writer_matches_write_sequence_bin(tmp_path):
+    write_sequence_bin(str(tmp_path / 'expected.bin'), RECORDS)
+    writer = SequenceBinWriter(str(tmp_path / 'sequence.bin'))
+    for record in RECORDS:
+        writer.append(*record)
+    assert len(writer) == len(RECORDS)
+    writer.close()
+    assert (tmp_path / 'sequence.bin').read_bytes() == (tmp_path / 'expected.bin').read_bytes()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['expected.bin', 'sequence.bin']
@@ -0,0 +1,36 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from conftest import make_video
+from cut_keyframe import process_videos
+from shards import ShardDataset
+
+
+def make_dataset(tmp_path, count=20):
+    make_video(str(tmp_path / 'l0_t0_r640_b480_a.mp4'))
+    lines = ['00:00:00.000'] + [f'<LClick ({i * 20}, {i * 10})>,00:00:0{i // 4}.{i % 4 * 250:03d}'
+                                for i in range(1, count + 1)]
+    (tmp_path / 'sequence.txt').write_text('\n'.join(lines) + '\n')
+    output_dir = str(tmp_path / 'save_image')
+    # 分片很小，样本分布在多个分片中
+    process_videos(str(tmp_path), str(tmp_path / 'sequence.txt'), output_dir, workers=1, shard_size=64 * 1024)
+    return output_dir
+
+
+# 多个线程和 fork 出的子进程共用一个 ShardDataset 时读出的内容与单独读取相同
+def test_shared_dataset_reads_from_threads_and_forked_workers(tmp_path):
+    output_dir = make_dataset(tmp_path)
+    with ShardDataset(output_dir) as dataset:
+        assert len(dataset.shards) > 1
+        expected = [dataset.read(i) for i in range(len(dataset))]
+        order = list(range(len(dataset))) * 20
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            assert list(executor.map(dataset.read, order)) == [expected[i] for i in order]
+
+        pid = os.fork()
+        if pid == 0:
+            ok = all(dataset.read(i) == expected[i] for i in order[::-1])
+            os._exit(0 if ok else 1)
+        for i in order:
+            assert dataset.read(i) == expected[i]
+        assert os.waitpid(pid, 0)[1] == 0
@@ -0,0 +1,21 @@
+import video_probe
+from conftest import make_video
+from video_probe import probe_video
+
+
+# 换一个步长时不能直接用缓存的 key_frame，同样的步长再次探测时用缓存
+def test_cached_key_frame_depends_on_stride(tmp_path, monkeypatch):
+    path = str(tmp_path / 'rec.mp4')
+    make_video(path)
+    calls = []
+    detect_key_frame = video_probe.detect_key_frame
+
+    def recording_detect(cap, stride, **kwargs):
+        calls.append(stride)
+        return detect_key_frame(cap, stride=stride, **kwargs)
+
+    monkeypatch.setattr(video_probe, 'detect_key_frame', recording_detect)
+    first = probe_video(path, stride=8)['key_frame']
+    assert probe_video(path, stride=1)['key_frame'] == first
+    assert probe_video(path, stride=1)['key_frame'] == first
+    assert calls == [8, 1]
@@ -0,0 +1,64 @@
+import numpy as np
+
+# 时间统一用整数毫秒表示，只在写文件时才格式化成 HH:MM:SS.fff
+DAY_MS = 24 * 3600 * 1000
+DAY_US = DAY_MS * 1000
+
+
+# 解析 HH:MM:SS.fff 为毫秒，小数部分按微秒解析后截断到毫秒(与 strptime 的 %f 一致)
+# 小数部分可以省略，格式不对时抛出 ValueError
+def parse_time_ms(timestamp_str):
+    if len(timestamp_str) == 12 and timestamp_str[2] == ':' and timestamp_str[5] == ':' and timestamp_str[8] == '.':
+        return (int(timestamp_str[0:2]) * 3600000 + int(timestamp_str[3:5]) * 60000
+                + int(timestamp_str[6:8]) * 1000 + int(timestamp_str[9:12]))
+    hours, minutes, seconds = timestamp_str.split(':')
+    seconds, _, fraction = seconds.partition('.')
+    if len(fraction) > 6 or not fraction.isdigit() and fraction:
+        raise ValueError(f"invalid timestamp: {timestamp_str}")
+    return int(hours) * 3600000 + int(minutes) * 60000 + int(seconds) * 1000 + int(fraction.ljust(6, '0')) // 1000
+
+
+# 一次解析一组时间戳，返回 int64 数组
+# 全部是 HH:MM:SS.fff 格式时用 NumPy 按字节计算，否则逐个解析
+def parse_times_ms(timestamp_strs):
+    count = len(timestamp_strs)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    raw = np.array(timestamp_strs, dtype='S12')
+    digits = np.frombuffer(raw.tobytes(), dtype=np.uint8).reshape(count, 12).astype(np.int64) - ord('0')
+    separators_ok = ((digits[:, 2] == ord(':') - ord('0')) & (digits[:, 5] == ord(':') - ord('0'))
+                     & (digits[:, 8] == ord('.') - ord('0')))
+    digit_columns = digits[:, [0, 1, 3, 4, 6, 7, 9, 10, 11]]
+    digits_ok = ((digit_columns >= 0) & (digit_columns <= 9)).all(axis=1)
+    lengths_ok = np.fromiter((len(s) == 12 for s in timestamp_strs), dtype=bool, count=count)
+    result = ((digits[:, 0] * 10 + digits[:, 1]) * 3600000 + (digits[:, 3] * 10 + digits[:, 4]) * 60000
+              + (digits[:, 6] * 10 + digits[:, 7]) * 1000
+              + digits[:, 9] * 100 + digits[:, 10] * 10 + digits[:, 11])
+    for i in np.flatnonzero(~(separators_ok & digits_ok & lengths_ok)):
+        result[i] = parse_time_ms(timestamp_strs[i])
+    return result
+
+
+# 格式化为 HH:MM:SS.fff，超过一天的部分会被去掉(与 datetime.time() 一致)
+def format_time_ms(ms, sep='.'):
+    ms %= DAY_MS
+    seconds, ms = divmod(ms, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}{sep}{ms:03d}"
+
+
+# 毫秒转为秒，整数秒加上毫秒部分，与按时、分、秒、毫秒逐项相加的浮点结果一致
+def ms_to_seconds(ms):
+    return ms // 1000 + ms % 1000 / 1000.0
+
+
+# 时间减去浮点数毫秒的偏移，结果截断到毫秒
+# 与 datetime - timedelta(milliseconds=offset) 后只保留毫秒的结果一致
+def subtract_offset_ms(ms, offset):
+    return (ms * 1000 - round(offset * 1000)) // 1000 % DAY_MS
+
+
+# 时间减去浮点数毫秒的偏移，结果为微秒(与 datetime - timedelta(milliseconds=offset) 一样保留微秒)
+def subtract_offset_us(ms, offset):
+    return (ms * 1000 - round(offset * 1000)) % DAY_US
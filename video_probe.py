@@ -0,0 +1,97 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+from dect_frame import SEARCH_STRIDE, TARGET_COLOR, TOLERANCE, detect_key_frame
+
+# 每个视频目录下的缓存文件，按文件名记录视频的元信息和同步帧
+PROBE_CACHE_NAME = '.video_probe.json'
+
+_cache_lock = threading.Lock()
+
+
+# 用文件大小和修改时间判断视频是否变化
+def file_signature(path):
+    st = os.stat(path)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def _cache_path(video_path):
+    return os.path.join(os.path.dirname(os.path.abspath(video_path)), PROBE_CACHE_NAME)
+
+
+def _load_cache(cache_path):
+    try:
+        with open(cache_path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_entry(video_path, entry):
+    cache_path = _cache_path(video_path)
+    with _cache_lock:
+        cache = _load_cache(cache_path)
+        cache[os.path.basename(video_path)] = entry
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(cache, f, indent=1)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            print(f"Failed to write probe cache {cache_path}: {e}")
+
+
+# 检测参数(包括步长)不同时缓存的 key_frame 不能用
+def _sync_params(target_color, tolerance, stride):
+    return [list(map(int, target_color)), tolerance, stride]
+
+
+# 读取视频的 fps、分辨率、总帧数，find_sync 为 True 时同时检测同步色块消失的帧(key_frame)
+# 结果缓存在视频所在目录，视频大小和修改时间不变时直接返回缓存，不再打开视频
+# 视频无法打开时返回 None
+def probe_video(video_path, find_sync=True, stride=SEARCH_STRIDE, target_color=TARGET_COLOR, tolerance=TOLERANCE,
+                use_cache=True):
+    signature = file_signature(video_path)
+    sync_params = _sync_params(target_color, tolerance, stride)
+
+    entry = None
+    if use_cache:
+        entry = _load_cache(_cache_path(video_path)).get(os.path.basename(video_path))
+        if entry is not None and (entry.get('size'), entry.get('mtime')) != (signature['size'], signature['mtime']):
+            entry = None
+    if entry is not None and (not find_sync or entry.get('sync_params') == sync_params):
+        return entry
+
+    cap = cv2.VideoCapture(video_path)
+    if not cap.isOpened():
+        print(f"Failed to open video: {video_path}")
+        return None
+    try:
+        if entry is None:
+            entry = dict(signature)
+            entry['fps'] = cap.get(cv2.CAP_PROP_FPS)
+            entry['width'] = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            entry['height'] = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            entry['frame_count'] = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        if find_sync:
+            entry['key_frame'] = detect_key_frame(cap, stride=stride, target_color=target_color, tolerance=tolerance)
+            entry['sync_params'] = sync_params
+    finally:
+        cap.release()
+
+    if use_cache:
+        _save_entry(video_path, entry)
+    return entry
+
+
+# 同时探测多个视频(例如多屏录屏的每个屏幕)，解码时 OpenCV 会释放 GIL，用线程即可并行
+# 返回与 video_paths 顺序一致的结果列表，其余参数同 probe_video
+def probe_videos(video_paths, workers=None, **kwargs):
+    if len(video_paths) <= 1 or workers == 1:
+        return [probe_video(video_path, **kwargs) for video_path in video_paths]
+    with ThreadPoolExecutor(max_workers=workers or len(video_paths)) as executor:
+        return list(executor.map(lambda video_path: probe_video(video_path, **kwargs), video_paths))